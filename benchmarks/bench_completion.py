@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Tab completion latency.
+
+Fills a temporary directory with files, then times completing a path in
+it (first Tab scans, later Tabs reuse the cached listing) and completing
+a command name over the PATH index.
+
+Usage: python3 benchmarks/bench_completion.py [files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mikush import CommandHash, Completer
+
+
+def timed(label, fn, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<36} {elapsed * 1000:8.3f} ms  ({len(result)} matches)")
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    completer = Completer(CommandHash(), lambda: ())
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(count):
+            open(os.path.join(tmp, f"file_{i:07d}.txt"), 'w').close()
+        os.mkdir(os.path.join(tmp, 'subdir'))
+        prefix = os.path.join(tmp, 'file_00001')
+        print(f"{count} files")
+        timed('path, first Tab', lambda: completer.complete_path(prefix))
+        timed('path, cached', lambda: completer.complete_path(prefix), repeat=100)
+        timed('path, cached, unique', lambda: completer.complete_path(os.path.join(tmp, 'sub')), repeat=100)
+    timed('command, first Tab', lambda: completer.complete_command('py'))
+    timed('command, cached', lambda: completer.complete_command('py'), repeat=100)
+
+
+if __name__ == '__main__':
+    main()
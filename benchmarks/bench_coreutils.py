@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+In-process coreutils against the real binaries.
+
+First checks that each command line prints the same thing (stdout and exit
+status) with the builtin as with `enable -n`, globs and braces included,
+and again as forked pipeline stages with an empty PATH. Then times both
+ways. Exits 1 if any output differed.
+
+Usage: python3 benchmarks/bench_coreutils.py [count]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from mikush import MikuShell
+
+CASES = [('cat', 'cat *.txt'),
+         ('cat', 'cat "*.txt" b?.txt'),
+         ('wc', 'wc -l *.txt'),
+         ('head', 'head -1 a1.{txt,nope}'),
+         ('tail', 'tail -n 1 [ab]*.txt')]
+
+
+def run(line, env=None):
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'mikush.py'), '-c', line],
+                            capture_output=True, env=env)
+    return result.stdout, result.returncode
+
+
+def check():
+    failures = 0
+    no_path = dict(os.environ, PATH='')
+    for name, line in CASES:
+        real = run(f"enable -n {name}; {line}")
+        for label, got in (('builtin', run(line)),
+                           ('forked', run(f"{line} | cat", no_path))):
+            ok = got == real
+            failures += not ok
+            print(f"{'ok' if ok else 'DIFFERS':<8} {label:<8} {line}")
+            if not ok:
+                print(f"    builtin: {got!r}\n    real:    {real!r}")
+    return failures
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory(prefix='mikush-bench-') as workdir:
+        os.environ['HOME'] = workdir
+        os.chdir(workdir)
+        for name in ('a1', 'a2', 'b1'):
+            with open(f"{name}.txt", 'w') as f:
+                f.write(''.join(f"{name} line {i}\n" for i in range(100)))
+        failures = check()
+
+        shell = MikuShell(interactive=False)
+        for label, setup in (('builtin', 'enable cat'), ('real', 'enable -n cat')):
+            shell.execute_command(setup)
+            start = time.perf_counter()
+            for _ in range(count):
+                shell.execute_command('cat *.txt > /dev/null')
+            each = (time.perf_counter() - start) / count
+            print(f"cat *.txt, {label:<8} {1 / each:10.0f} cmds/s  ({each * 1e6:7.1f} us each)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+History search at scale.
+
+Writes a synthetic history file (a quarter million distinct commands,
+repeated four times over on average), builds a HistoryIndex over it and
+times a handful of queries, plus the same queries done as a plain
+substring scan over every record for comparison.
+
+Usage: python3 benchmarks/bench_history.py [records]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mikush import HistoryIndex, HistoryStore
+
+COMMANDS = ['git status', 'git commit -m', 'git push origin', 'make', 'make test', 'ls -la',
+            'cd', 'vim', 'python3 -m pytest', 'docker run --rm', 'ssh', 'grep -rn', 'cargo build']
+QUERIES = ['git', 'pytest tests', 'docker run', 'grep -rn todo', 'ssh host_17', 'zzz']
+
+
+def write_history(path, count, seed=47):
+    rng = random.Random(seed)
+    store = HistoryStore(path)
+    now = time.time()
+    words = ['src', 'tests', 'todo', 'main.py', 'README.md'] + [f"host_{i}" for i in range(200)]
+    for i in range(count):
+        command = f"{rng.choice(COMMANDS)} {rng.choice(words)} {rng.randrange(100)}"
+        store.append(command, f"/home/miku/project{rng.randrange(50)}", rng.random(),
+                     rng.choice((0, 0, 0, 1)), timestamp=now - (count - i))
+    return store
+
+
+def timed(label, fn, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<34} {elapsed * 1000:10.2f} ms")
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'history')
+        store = timed(f"write {count} records", lambda: write_history(path, count))
+        store.load_tail()
+        records = timed('read all records', lambda: list(store.load_all()))
+
+        index = HistoryIndex()
+
+        def build():
+            for record in records:
+                index.add(record)
+        timed('build index', build)
+        print(f"{len(index)} distinct commands, {len(index.postings)} trigrams")
+
+        for query in QUERIES:
+            timed(f"  index   '{query}'", lambda: index.search(query), repeat=5)
+            terms = query.lower().split()
+            timed(f"  scan    '{query}'",
+                  lambda: [r for r in records if all(t in r.command.lower() for t in terms)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for file icon lookup.
+
+Compares the old split/endswith lookup against IconIndex (uncached and
+LRU-cached) over a million synthetic filenames, once with mostly unique
+names (one big listing) and once drawn from a small working set (the same
+directories listed again and again).
+
+Usage: python3 benchmarks/bench_icons.py [count]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mikush import FileIcons, IconIndex
+
+
+def legacy_icon(filename):
+    """get_file_icon as it was before IconIndex"""
+    filename_lower = filename.lower()
+    if filename_lower in FileIcons.ICONS:
+        return FileIcons.ICONS[filename_lower]
+    if '.' in filename:
+        ext = '.' + filename.split('.')[-1].lower()
+        if ext in FileIcons.ICONS:
+            return FileIcons.ICONS[ext]
+    if filename.endswith('.tar.gz'):
+        return FileIcons.ICONS['.tar.gz']
+    elif filename.endswith('.tar.xz'):
+        return FileIcons.ICONS['.tar.xz']
+    elif filename.endswith('.pkg.tar.xz'):
+        return FileIcons.ICONS['.pkg.tar.xz']
+    return FileIcons.ICONS['default']
+
+
+def make_names(count, unique, seed=47):
+    """Synthetic names: known and unknown extensions, compound suffixes, exact names"""
+    rng = random.Random(seed)
+    suffixes = [key for key in FileIcons.ICONS if key.startswith('.')]
+    suffixes += ['.o', '.log', '.bak', '.tmp', '']
+    exact = [key for key in FileIcons.ICONS if not key.startswith('.') and key != 'default']
+    names = []
+    for i in range(count):
+        if rng.random() < 0.05:
+            names.append(rng.choice(exact))
+        else:
+            names.append(f"file_{rng.randrange(unique)}{rng.choice(suffixes)}")
+    return names
+
+
+def bench(label, fn, names):
+    start = time.perf_counter()
+    for name in names:
+        fn(name)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<26} {elapsed:8.3f} s  {len(names) / elapsed / 1e6:6.2f} M lookups/s")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    for workload, unique in (('mostly unique', count), ('working set', 20)):
+        names = make_names(count, unique)
+        index = IconIndex(FileIcons.ICONS)
+        print(f"{count} synthetic filenames, {workload}")
+        bench('  legacy', legacy_icon, names)
+        bench('  IconIndex.resolve', index.resolve, names)
+        bench('  IconIndex.lookup (LRU)', index.lookup, names)
+
+
+if __name__ == '__main__':
+    main()
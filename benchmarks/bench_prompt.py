@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Per-prompt cost: the old f-string get_prompt against the compiled template.
+
+Both are fed the same, already collected segment values so only the
+prompt building itself is measured.
+
+Usage: python3 benchmarks/bench_prompt.py [iterations]
+"""
+
+import os
+import socket
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mikush import Colors, MikuShell
+
+
+def legacy_prompt(shell, segment_values):
+    """get_prompt as it was before PromptTemplate"""
+    current_path = os.getcwd()
+    home_path = os.path.expanduser("~")
+    if current_path.startswith(home_path):
+        current_path = current_path.replace(home_path, "~", 1)
+
+    user = os.environ.get('USER', 'unknown')
+    hostname = socket.gethostname()
+    prompt_char = '#' if os.geteuid() == 0 else '$'
+
+    now = datetime.now()
+    time_str = now.strftime("%H:%M:%S")
+    date_str = now.strftime("%Y-%m-%d")
+
+    first_line = f"{Colors.CYAN}→ {Colors.RESET}"
+    first_line += f"{Colors.DIM}[{time_str} {date_str}]{Colors.RESET} - "
+    first_line += f"{Colors.GREEN}[{user} - {hostname}]{Colors.RESET}"
+    first_line += shell.segments.render(segment_values)
+    second_line = f"{Colors.CYAN}→ {Colors.PINK}nya~({current_path}){prompt_char}>{Colors.RESET} "
+    return f"{first_line}\n{second_line}"
+
+
+def bench(label, fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / iterations * 1e6:8.2f} us/prompt")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    shell = MikuShell()
+    cwd = os.getcwd()
+    values = shell.segments.collect(cwd)
+    time.sleep(0.2)
+    values = shell.segments.collect(cwd)
+
+    print(f"{iterations} prompts in {cwd}")
+    bench('legacy f-strings', lambda: legacy_prompt(shell, values), iterations)
+    bench('compiled template', lambda: shell.render_prompt(os.getcwd(), values), iterations)
+    bench('get_prompt (with segments)', shell.get_prompt, iterations // 10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+External command launch rate: posix_spawn against the Popen path.
+
+Runs the real `true` by path (plain `true` is an in-process builtin, which
+would start no process at all), and `true > /dev/null`, which needs a
+redirection, through execute_command with os.posix_spawn and again with the Popen fallback,
+plus bare subprocess.run for reference. --rss MB grows the interpreter's
+heap first: a plain fork() would copy page tables for all of it, while
+both paths here should stay flat.
+
+Usage: python3 benchmarks/bench_spawn.py [count] [--rss MB]
+"""
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mikush import MikuShell
+
+
+def run_rounds(cases, count, rounds=9):
+    """Median time per launch for each case; rounds alternate between cases so drift hits them all alike"""
+    samples = {label: [] for label, _ in cases}
+    per_round = max(1, count // rounds)
+    for _ in range(rounds):
+        for label, fn in cases:
+            fn()
+            start = time.perf_counter()
+            for _ in range(per_round):
+                fn()
+            samples[label].append((time.perf_counter() - start) / per_round)
+    for label, _ in cases:
+        each = statistics.median(samples[label])
+        print(f"{label:<34} {1 / each:10.0f} cmds/s  ({each * 1e6:7.1f} us each)")
+
+
+def with_spawn(shell, use_posix_spawn, command):
+    def run():
+        shell.use_posix_spawn = use_posix_spawn
+        shell.execute_command(command)
+    return run
+
+
+def main():
+    args = sys.argv[1:]
+    ballast = None
+    if '--rss' in args:
+        i = args.index('--rss')
+        ballast = bytearray(int(args[i + 1]) * 1024 * 1024)
+        ballast[::4096] = b'x' * len(ballast[::4096])  # Touch every page
+        del args[i:i + 2]
+    count = int(args[0]) if args else 2000
+
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='mikush-bench-')
+    shell = MikuShell(interactive=False)
+    true = shutil.which('true') or '/bin/true'
+    print(f"{count} launches each, posix_spawn {'available' if shell.use_posix_spawn else 'missing'}"
+          f"{f', {len(ballast) >> 20} MiB ballast' if ballast else ''}")
+    run_rounds([('subprocess.run', lambda: subprocess.run([true])),
+                ('execute_command, Popen', with_spawn(shell, False, true)),
+                ('execute_command, posix_spawn', with_spawn(shell, True, true)),
+                ('  > /dev/null, Popen', with_spawn(shell, False, f"{true} > /dev/null")),
+                ('  > /dev/null, posix_spawn', with_spawn(shell, True, f"{true} > /dev/null"))], count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Headless benchmark suite for mikush's hot paths.
+
+Everything runs against a throwaway HOME in a temp directory: synthetic
+directories, history and rc file are generated there, stdout goes to
+/dev/null while timing and input() is fed from a list instead of the
+terminal. Results are printed as a table on stderr and as JSON on stdout
+(or into --json FILE); --compare OLD.json shows the change against an
+earlier run.
+
+Usage: python3 benchmarks/suite.py [--quick] [--sizes 10000,100000,1000000]
+                                   [--only NAME,...] [--json FILE] [--compare FILE]
+"""
+
+import builtins
+import json
+import os
+import platform
+import pty
+import random
+import re
+import select
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import mikush
+
+
+class Quiet:
+    """Send fd 1 (and so sys.stdout and children) to /dev/null"""
+
+    def __enter__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.close(null)
+
+    def __exit__(self, *exc):
+        sys.stdout.flush()
+        os.dup2(self.saved, 1)
+        os.close(self.saved)
+
+
+class Suite:
+    def __init__(self, workdir, sizes, only=None, quick=False):
+        self.workdir = workdir
+        self.sizes = sizes
+        self.only = only
+        self.scale = 0.1 if quick else 1.0
+        self.results = {}
+
+    def wanted(self, name):
+        return not self.only or any(name.startswith(prefix) for prefix in self.only)
+
+    def record(self, name, unit, better, samples, per=1):
+        """Store the median of samples (seconds for per operations) converted to unit"""
+        if unit.endswith('/s'):
+            values = [per / sample for sample in samples]
+        elif unit == 'us':
+            values = [sample / per * 1e6 for sample in samples]
+        else:
+            values = [sample / per * 1e3 for sample in samples]
+        value = statistics.median(values)
+        self.results[name] = {'value': value, 'unit': unit, 'better': better, 'samples': values}
+        print(f"{name:<28} {value:14.3f} {unit}", file=sys.stderr)
+
+    def timed(self, fn, repeat):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    def count(self, n):
+        return max(1, int(n * self.scale))
+
+    def make_shell(self):
+        with Quiet():
+            shell = mikush.MikuShell()
+            shell.wait_for_history()
+        return shell
+
+    # Synthetic data
+
+    def make_dir(self, count):
+        path = os.path.join(self.workdir, f"tree_{count}")
+        if not os.path.isdir(path):
+            os.mkdir(path)
+            suffixes = ['.py', '.rs', '.txt', '.tar.gz', '.md', '', '.log', '.json']
+            rng = random.Random(count)
+            for i in range(count):
+                fd = os.open(os.path.join(path, f"f{i:07d}{rng.choice(suffixes)}"), os.O_CREAT | os.O_WRONLY, 0o644)
+                os.close(fd)
+        return path
+
+    def make_history(self, count):
+        store = mikush.HistoryStore(os.path.join(self.workdir, '.miku_history'))
+        rng = random.Random(7)
+        commands = ['git status', 'git commit -m wip', 'make test', 'ls -la', 'cd src', 'vim main.py',
+                    'python3 -m pytest', 'grep -rn TODO', 'docker ps', 'ssh build']
+        now = time.time()
+        for i in range(count):
+            store.append(f"{rng.choice(commands)} {rng.randrange(500)}", f"/home/miku/p{rng.randrange(20)}",
+                         rng.random(), rng.choice((0, 0, 1)), timestamp=now - count + i)
+
+    def make_rc(self, lines):
+        with open(os.path.join(self.workdir, '.mikurc'), 'w') as f:
+            for i in range(lines):
+                f.write(f"alias a{i}='ls -la'\n" if i % 2 else f"export MIKU_BENCH_{i}=value_{i}\n")
+
+    # Benchmarks
+
+    # The second line of the default prompt template
+    PROMPT = re.compile(rb'nya~\(.*?\)[$#]>')
+
+    def bench_startup(self):
+        """Interactive cold start up to the first prompt, in a pty: a pipe on stdin
+        would take the script path and skip readline, history, rc and segments"""
+        cmd = [sys.executable, os.path.join(ROOT, 'mikush.py')]
+        env = dict(os.environ, HOME=self.workdir, TERM=os.environ.get('TERM', 'xterm'))
+
+        def run():
+            start = time.perf_counter()
+            pid, fd = pty.fork()
+            if pid == 0:
+                os.execve(cmd[0], cmd, env)
+            out = b''
+            try:
+                while not self.PROMPT.search(out):
+                    if not select.select([fd], [], [], 10)[0]:
+                        raise RuntimeError(f"no prompt after 10s, got {out[-200:]!r}")
+                    out += os.read(fd, 65536)
+                elapsed = time.perf_counter() - start
+                os.write(fd, b'exit\n')
+                try:
+                    while select.select([fd], [], [], 5)[0] and os.read(fd, 65536):
+                        pass
+                except OSError:
+                    pass  # EIO: the shell is gone and the pty closed
+            finally:
+                os.close(fd)
+                os.waitpid(pid, 0)
+            return elapsed
+        run()
+        self.record('startup', 'ms', 'lower', [run() for _ in range(10)])
+
+    def bench_prompt(self):
+        shell = self.make_shell()
+        n = self.count(20000)
+        shell.get_prompt()
+        time.sleep(0.2)  # let the first segment values land
+        self.record('prompt.get_prompt', 'us', 'lower', self.timed(lambda: [shell.get_prompt() for _ in range(n)], 5), n)
+
+        # The whole prompt step with readline's input() mocked
+        real_input = builtins.input
+        builtins.input = lambda prompt='': 'true'
+        try:
+            with Quiet():
+                samples = self.timed(lambda: [shell.show_prompt() for _ in range(n)], 5)
+        finally:
+            builtins.input = real_input
+        self.record('prompt.show_prompt', 'us', 'lower', samples, n)
+
+    def bench_commands(self):
+        shell = self.make_shell()
+        # 'true' itself is a builtin now; the real one by path still forks
+        true = shutil.which('true') or '/bin/true'
+        for name, command, n in (('command.builtin', 'pwd', 20000),
+                                 ('command.builtin_redirect', 'echo hi > /dev/null', 20000),
+                                 ('command.coreutil', '[ -d / ]', 20000),
+                                 ('command.external', true, 500),
+                                 ('command.pipeline', f"{true} | {true}", 300),
+                                 ('command.substitution', 'echo $(pwd) $(pwd)', 300)):
+            n = self.count(n)
+            with Quiet():
+                samples = self.timed(lambda: [shell.execute_command(command) for _ in range(n)], 3)
+            self.record(name, 'cmds/s', 'higher', samples, n)
+
+    def bench_icons(self):
+        shell = self.make_shell()
+        names = sorted(os.listdir(self.make_dir(self.count(10000))))
+        n = len(names)
+
+        def lookup():
+            for _ in range(10):
+                for name in names:
+                    shell.get_file_icon(name)
+        self.record('icons.get_file_icon', 'lookups/s', 'higher', self.timed(lookup, 5), n * 10)
+
+    def bench_ls(self):
+        shell = self.make_shell()
+        for size in self.sizes:
+            path = self.make_dir(size)
+            repeat = 3 if size <= 100000 else 1
+            # -r keeps the sort on directories past STREAM_THRESHOLD, where a
+            # plain listing would stream instead
+            for label, args in (('sorted', ['-r', path]), ('long', ['-lr', path]), ('stream', ['-U', path])):
+                with Quiet():
+                    samples = self.timed(lambda: shell.builtin_ls(args), repeat)
+                self.record(f"ls.{label}.{size}", 'entries/s', 'higher', samples, size)
+
+            # Quiet stdout is no tty, so builtin_ls always prints one per line;
+            # drive the column layout on the lister directly
+            lister = mikush.DirectoryLister(shell.icon_index)
+
+            def columns():
+                lister.render(lister.sort(lister.scan(path)), 120)
+            self.record(f"ls.columns.{size}", 'entries/s', 'higher', self.timed(columns, repeat), size)
+
+    def bench_rc(self):
+        lines = self.count(2000)
+        self.make_rc(lines)
+        shell = self.make_shell()
+        with Quiet():
+            samples = self.timed(shell.load_rc_file, 5)
+        os.remove(shell.rc_file)
+        self.record('rc.load', 'ms', 'lower', samples)
+        self.record('rc.line', 'us', 'lower', samples, lines)
+
+    def bench_history(self):
+        history_path = os.path.join(self.workdir, '.miku_history')
+        records = self.count(200000)
+        self.make_history(records)
+        store = mikush.HistoryStore(history_path)
+        self.record('history.load_tail', 'ms', 'lower', self.timed(store.load_tail, 5))
+        index = mikush.HistoryIndex()
+
+        def build():
+            for record in store.load_all():
+                index.add(record)
+        self.record('history.index_build', 'ms', 'lower', self.timed(build, 1))
+        for query in ('git', 'make test 4', 'zzz'):
+            self.record(f"history.search.{query.replace(' ', '_')}", 'ms', 'lower',
+                        self.timed(lambda: index.search(query), 10))
+        os.remove(history_path)
+
+    def run(self):
+        for name in ('startup', 'prompt', 'commands', 'icons', 'ls', 'rc', 'history'):
+            if self.wanted(name) or (name == 'commands' and self.wanted('command')):
+                getattr(self, f"bench_{name}")()
+
+
+def compare(old, new):
+    print(f"\n{'benchmark':<28} {'old':>14} {'new':>14} {'change':>9}", file=sys.stderr)
+    for name, result in new.items():
+        if name not in old:
+            continue
+        before, after = old[name]['value'], result['value']
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change > 0 if result['better'] == 'lower' else change < 0
+        flag = ' worse' if worse and abs(change) >= 5 else ''
+        print(f"{name:<28} {before:14.3f} {after:14.3f} {change:+8.1f}%{flag}", file=sys.stderr)
+
+
+def main():
+    args = sys.argv[1:]
+    options = {'--sizes': '10000,100000,1000000', '--only': '', '--json': '', '--compare': ''}
+    quick = False
+    i = 0
+    while i < len(args):
+        if args[i] == '--quick':
+            quick = True
+        elif args[i] in options and i + 1 < len(args):
+            options[args[i]] = args[i + 1]
+            i += 1
+        else:
+            sys.exit(__doc__.split('\n\n')[-1].strip())
+        i += 1
+    sizes = [int(size) for size in options['--sizes'].split(',') if size]
+    if quick and options['--sizes'] == '10000,100000,1000000':
+        sizes = [1000, 10000]
+    only = [name for name in options['--only'].split(',') if name]
+
+    with tempfile.TemporaryDirectory(prefix='mikush-bench-') as workdir:
+        os.environ['HOME'] = workdir
+        os.chdir(workdir)
+        suite = Suite(workdir, sizes, only, quick)
+        suite.run()
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'quick': quick,
+        },
+        'results': suite.results,
+    }
+    if options['--compare']:
+        with open(options['--compare']) as f:
+            compare(json.load(f)['results'], suite.results)
+    data = json.dumps(report, indent=2)
+    if options['--json']:
+        with open(options['--json'], 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,21 +9,190 @@ Ko-fi: MalikHw47
 MIT License
 """
 
+import time
+STARTUP_T0 = time.perf_counter()
+
 import os
 import sys
-import subprocess
-import shlex
-import readline
-import atexit
+import importlib
 import signal
+import stat
+import errno
+import threading
+import queue
 import random
-from datetime import datetime
-import pwd
-import socket
-import glob
-import re
-from pathlib import Path
-import argparse
+import marshal
+
+class LazyModule:
+    """Import a module on first attribute access to keep startup fast"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+subprocess = LazyModule('subprocess')
+# Only the interactive shell needs line editing
+readline = LazyModule('readline')
+shlex = LazyModule('shlex')
+glob = LazyModule('glob')
+pwd = LazyModule('pwd')
+grp = LazyModule('grp')
+heapq = LazyModule('heapq')
+itertools = LazyModule('itertools')
+selectors = LazyModule('selectors')
+termios = LazyModule('termios')
+tty = LazyModule('tty')
+functools = LazyModule('functools')
+bisect = LazyModule('bisect')
+array = LazyModule('array')
+math = LazyModule('math')
+collections = LazyModule('collections')
+json = LazyModule('json')
+
+class StartupProfile:
+    """Per-phase startup timings, printed with --startup-profile"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.last = STARTUP_T0
+        self.phases = []
+
+    def mark(self, phase):
+        """Record the time spent since the previous mark under phase"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled or not self.phases:
+            return
+        total = sum(elapsed for _, elapsed in self.phases)
+        print(f"{Colors.CYAN}Startup profile (it's not like I care how fast I am...):{Colors.RESET}")
+        for phase, elapsed in self.phases:
+            print(f"  {phase:<14} {elapsed * 1000:8.2f} ms")
+        print(f"  {Colors.BOLD}{'total':<14} {total * 1000:8.2f} ms{Colors.RESET}")
+        # Only the first prompt is part of startup
+        self.enabled = False
+
+class LatencyHistogram:
+    """Fixed-size log-scale histogram of nanosecond durations.
+
+    Eight buckets per power of two, so any percentile read back is within
+    about 12% of the real value, whatever the number of samples.
+    """
+
+    SUB_BITS = 3
+    BUCKETS = 64 << 3
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def bucket(self, ns):
+        if ns < (1 << self.SUB_BITS):
+            return ns
+        exp = ns.bit_length() - 1 - self.SUB_BITS
+        return min(self.BUCKETS - 1, ((exp + 1) << self.SUB_BITS) + ((ns >> exp) & ((1 << self.SUB_BITS) - 1)))
+
+    def lower_bound(self, index):
+        if index < (1 << self.SUB_BITS):
+            return index
+        exp = (index >> self.SUB_BITS) - 1
+        return ((1 << self.SUB_BITS) + (index & ((1 << self.SUB_BITS) - 1))) << exp
+
+    def add(self, ns):
+        self.counts[self.bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, pct):
+        """Duration in ns at or below which pct percent of the samples fall"""
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(self.count * pct / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # Middle of the bucket, but never beyond the largest sample
+                return min(self.max, (self.lower_bound(index) + self.lower_bound(index + 1)) // 2)
+        return self.max
+
+class LatencyProfile:
+    """Where the shell's own time goes: per-phase histograms plus a trace.
+
+    Off by default; MIKU_PROFILE=1 or 'profile on' enables it. Callers do
+    t = profile.start() ... profile.stop('phase', t); while disabled both
+    are a single attribute check. The last TRACE_EVENTS timings are also
+    kept, in order, for Chrome trace export.
+    """
+
+    TRACE_EVENTS = 100000
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.events = None
+
+    def start(self):
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def stop(self, phase, started):
+        if not started or not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = LatencyHistogram()
+        histogram.add(now - started)
+        if self.events is None:
+            self.events = collections.deque(maxlen=self.TRACE_EVENTS)
+        self.events.append((phase, started, now - started))
+
+    def reset(self):
+        self.histograms = {}
+        self.events = None
+
+    def summary(self):
+        """{phase: {count, mean/p50/p95/p99/max in ms}}"""
+        out = {}
+        for phase, histogram in self.histograms.items():
+            out[phase] = {
+                'count': histogram.count,
+                'mean_ms': histogram.total / histogram.count / 1e6,
+                'p50_ms': histogram.percentile(50) / 1e6,
+                'p95_ms': histogram.percentile(95) / 1e6,
+                'p99_ms': histogram.percentile(99) / 1e6,
+                'max_ms': histogram.max / 1e6,
+            }
+        return out
+
+    def to_json(self):
+        return json.dumps({
+            'phases': self.summary(),
+            'histograms': {phase: {'counts': {str(histogram.lower_bound(i)): n
+                                              for i, n in enumerate(histogram.counts) if n}}
+                           for phase, histogram in self.histograms.items()},
+        }, indent=2)
+
+    def to_chrome_trace(self):
+        """Chrome trace event format (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        events = [{'name': phase, 'ph': 'X', 'ts': started / 1000, 'dur': duration / 1000,
+                   'pid': pid, 'tid': 0}
+                  for phase, started, duration in (self.events or ())]
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
 
 class Colors:
     # ANSI color codes
@@ -202,6 +371,62 @@ class FileIcons:
         'default': '\uf15b'
     }
 
+class IconIndex:
+    """Icon and colour lookup compiled once from FileIcons.ICONS.
+
+    Exact filenames go in one table and suffixes in another. A name is
+    probed at each of its dots from the left, so the longest suffix always
+    wins ('.pkg.tar.xz' before '.tar.xz' before '.xz'). Results are
+    memoized in a bounded LRU cache.
+    """
+
+    def __init__(self, icons, cache_size=4096):
+        self.default = icons['default']
+        self.names = {}     # exact lowercase filename -> (icon, color)
+        self.suffixes = {}  # lowercase suffix, starting with '.' -> (icon, color)
+        for key, icon in icons.items():
+            if key == 'default':
+                continue
+            table = self.suffixes if key.startswith('.') else self.names
+            table[key] = (icon, None)
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self.resolve)
+
+    def resolve(self, filename):
+        """Return (icon, color) for filename; color is None unless a user rule set one"""
+        name = filename.lower()
+        hit = self.names.get(name)
+        if hit:
+            return hit
+        i = name.find('.')
+        while i != -1:
+            hit = self.suffixes.get(name[i:])
+            if hit:
+                return hit
+            i = name.find('.', i + 1)
+        return (self.default, None)
+
+    def add_rule(self, pattern, icon=None, sgr=None):
+        """Add or update a rule for '*.ext' or an exact filename"""
+        if pattern.startswith('*'):
+            key = pattern[1:].lower()
+            if not key.startswith('.') or '*' in key:
+                raise ValueError(f"Unsupported pattern: {pattern}")
+            table = self.suffixes
+        else:
+            key = pattern.lower()
+            table = self.names
+        old_icon, old_color = table.get(key, (self.default, None))
+        color = f"\033[{sgr}m" if sgr else old_color
+        table[key] = (icon or old_icon, color)
+        self.lookup.cache_clear()
+
+    def load_ls_colors(self, spec):
+        """Apply the '*.ext=SGR' entries of an LS_COLORS-style string"""
+        for item in spec.split(':'):
+            pattern, _, sgr = item.partition('=')
+            if pattern.startswith('*.') and sgr:
+                self.add_rule(pattern, sgr=sgr)
+
 class TsundereMessages:
     """Collection of tsundere messages"""
     
@@ -257,333 +482,4509 @@ class TsundereMessages:
             return message.format(*args)
         return message
 
-class MikuShell:
+class GitHeadResolver:
+    """Resolve the current git branch in-process, without spawning git"""
+
     def __init__(self):
-        self.history_file = os.path.expanduser("~/.miku_history")
-        self.rc_file = os.path.expanduser("~/.mikurc")
-        self.builtins = {
-            'cd': self.builtin_cd,
-            'ls': self.builtin_ls,
-            'pwd': self.builtin_pwd,
-            'exit': self.builtin_exit,
-            'history': self.builtin_history,
-            'clear': self.builtin_clear,
-            'help': self.builtin_help,
-            'echo': self.builtin_echo,
-            'export': self.builtin_export,
-            'unset': self.builtin_unset,
-            'alias': self.builtin_alias,
-            'which': self.builtin_which,
-        }
-        self.aliases = {}
-        self.last_exit_code = 0
-        self.setup_history()
-        self.setup_signals()
-        self.load_rc_file()
-        
-        # Check if thefuck is available
-        self.thefuck_available = self.check_thefuck()
+        # git dir -> (HEAD mtime, branch)
+        self.cache = {}
 
-    def setup_history(self):
-        """Setup readline history"""
+    def find_git_dir(self, start):
+        """Walk up from start looking for .git (dir, or gitdir file for worktrees/submodules)"""
+        path = start
+        while True:
+            dot_git = os.path.join(path, '.git')
+            try:
+                st = os.stat(dot_git)
+            except OSError:
+                st = None
+            if st is not None:
+                if stat.S_ISDIR(st.st_mode):
+                    return dot_git
+                try:
+                    with open(dot_git, 'r') as f:
+                        line = f.readline().strip()
+                except OSError:
+                    line = ''
+                if line.startswith('gitdir:'):
+                    git_dir = line[len('gitdir:'):].strip()
+                    if not os.path.isabs(git_dir):
+                        git_dir = os.path.normpath(os.path.join(path, git_dir))
+                    return git_dir
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def read_head(self, git_dir):
+        """Parse HEAD into a branch name; a detached HEAD shows as its short SHA, like git does"""
         try:
-            readline.read_history_file(self.history_file)
-        except FileNotFoundError:
+            with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+                head = f.readline().strip()
+        except OSError:
+            return None
+        if head.startswith('ref:'):
+            ref = head[len('ref:'):].strip()
+            if ref.startswith('refs/heads/'):
+                return ref[len('refs/heads/'):]
+            return ref
+        if not head:
+            return None
+        # Only a symbolic HEAD is on a branch; another ref at the same commit isn't checked out
+        return f"detached@{head[:7]}"
+
+    def get_branch(self, cwd):
+        """Current branch for cwd, cached per repo on the mtime of HEAD (all the answer depends on)"""
+        git_dir = self.find_git_dir(cwd)
+        if git_dir is None:
+            return None
+        try:
+            head_mtime = os.stat(os.path.join(git_dir, 'HEAD')).st_mtime_ns
+        except OSError:
+            return None
+        cached = self.cache.get(git_dir)
+        if cached and cached[0] == head_mtime:
+            return cached[1]
+        branch = self.read_head(git_dir)
+        self.cache[git_dir] = (head_mtime, branch)
+        return branch
+
+class CommandHash:
+    """bash-style hash table mapping command names to resolved paths.
+
+    PATH directories are indexed lazily (names only) the first time a lookup
+    misses; a hit costs no syscalls at all. The table is dropped when PATH
+    changes, and a miss rescans any PATH directory whose mtime moved.
+    """
+
+    def __init__(self):
+        self.table = {}      # name -> resolved path
+        self.hits = {}       # name -> hit count
+        self.dir_index = {}  # dir -> (mtime, set of names)
+        self.path_value = None
+
+    def clear(self):
+        self.table.clear()
+        self.hits.clear()
+        self.dir_index.clear()
+
+    def path_dirs(self):
+        path_value = os.environ.get('PATH', os.defpath)
+        if path_value != self.path_value:
+            self.clear()
+            self.path_value = path_value
+        return [d or '.' for d in path_value.split(os.pathsep)]
+
+    def dir_names(self, directory):
+        """Names in a PATH directory, rescanned only when its mtime changes"""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.dir_index.pop(directory, None)
+            return ()
+        cached = self.dir_index.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with os.scandir(directory) as it:
+                names = {entry.name for entry in it}
+        except OSError:
+            names = set()
+        self.dir_index[directory] = (mtime, names)
+        return names
+
+    def search(self, name):
+        """Walk PATH in order for an executable called name"""
+        for directory in self.path_dirs():
+            if name in self.dir_names(directory):
+                candidate = os.path.join(directory, name)
+                if os.access(candidate, os.X_OK) and not os.path.isdir(candidate):
+                    return candidate
+        return None
+
+    def lookup(self, name):
+        """Resolve name to a path, or None if it can't be found"""
+        if '/' in name:
+            return name
+        self.path_dirs()
+        path = self.table.get(name)
+        if path is None:
+            path = self.search(name)
+            if path is None:
+                return None
+            self.table[name] = path
+            self.hits[name] = 0
+        self.hits[name] += 1
+        return path
+
+    def forget(self, name):
+        self.table.pop(name, None)
+        self.hits.pop(name, None)
+
+class Completer:
+    """readline completion for commands, paths, $VARS and per-command arguments.
+
+    Directory listings are kept sorted per directory and reused until the
+    directory's mtime changes, and command names come from the CommandHash
+    PATH index merged into one sorted list, so after the first Tab a
+    completion costs a stat per directory and a bisect.
+    """
+
+    BREAK_CHARS = ' \t\n;|&<>'
+
+    def __init__(self, command_hash, extra_commands, shell_variables=lambda: ()):
+        self.command_hash = command_hash
+        self.extra_commands = extra_commands  # () -> builtin and alias names
+        self.shell_variables = shell_variables  # () -> unexported variable names
+        self.listings = {}      # dir -> (mtime, sorted names, set of subdirectory names)
+        self.commands = []
+        self.commands_key = None
+        self.completers = {}    # command -> fn(text, args) -> candidates
+        self.matches = []
+
+    def register(self, command, completer):
+        self.completers[command] = completer
+
+    def unregister(self, command):
+        return self.completers.pop(command, None) is not None
+
+    def prefixed(self, names, prefix):
+        """Names in a sorted list that start with prefix"""
+        i = bisect.bisect_left(names, prefix)
+        out = []
+        while i < len(names) and names[i].startswith(prefix):
+            out.append(names[i])
+            i += 1
+        return out
+
+    def listing(self, directory):
+        """(sorted names, subdirectory names) for directory, rescanned when its mtime moves"""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.listings.pop(directory, None)
+            return [], set()
+        cached = self.listings.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        names = []
+        dirs = set()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    names.append(entry.name)
+                    try:
+                        if entry.is_dir():
+                            dirs.add(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
             pass
+        names.sort()
+        self.listings[directory] = (mtime, names, dirs)
+        return names, dirs
+
+    def complete_path(self, text, only_dirs=False, executables=False):
+        """Files under text's directory part; directories get a trailing /"""
+        text = text.replace('\\ ', ' ')
+        cut = text.rfind('/') + 1
+        head, base = text[:cut], text[cut:]
+        directory = os.path.expanduser(head) if head else '.'
+        names, dirs = self.listing(directory)
+        out = []
+        for name in self.prefixed(names, base):
+            if name.startswith('.') and not base.startswith('.'):
+                continue
+            is_dir = name in dirs
+            if only_dirs and not is_dir:
+                continue
+            if executables and not is_dir and not os.access(os.path.join(directory, name), os.X_OK):
+                continue
+            out.append((head + name).replace(' ', '\\ ') + ('/' if is_dir else ''))
+        return out
+
+    def command_names(self):
+        """Every name in the PATH directories, sorted, remerged only when one of them changes"""
+        dirs = self.command_hash.path_dirs()
+        for directory in dirs:
+            self.command_hash.dir_names(directory)
+        index = self.command_hash.dir_index
+        key = (self.command_hash.path_value, tuple(index[d][0] if d in index else None for d in dirs))
+        if key != self.commands_key:
+            names = set()
+            for directory in dirs:
+                if directory in index:
+                    names.update(index[directory][1])
+            self.commands = sorted(names)
+            self.commands_key = key
+        return self.commands
+
+    def complete_command(self, text):
+        if '/' in text or text.startswith('~'):
+            return self.complete_path(text, executables=True)
+        # Straight from the PATH index: lookup() would stat each one and fill the hash table
+        matches = {name for name in self.extra_commands() if name.startswith(text)}
+        matches.update(self.prefixed(self.command_names(), text))
+        return sorted(matches)
+
+    def complete_variable(self, text):
+        """$NAME and ${NAME} completion; text without a $ completes bare names"""
+        if text.startswith('${'):
+            lead, tail = '${', '}'
+        elif text.startswith('$'):
+            lead, tail = '$', ''
+        else:
+            lead, tail = '', ''
+        prefix = text[len(lead):]
+        names = sorted(set(os.environ).union(self.shell_variables()))
+        return [lead + name + tail for name in names if name.startswith(prefix)]
+
+    def candidates(self, line, begidx, text):
+        before = line[:begidx]
+        # readline breaks "my\\ fi" at the escaped space; complete the whole word
+        lead = ''
+        while before.endswith('\\ '):
+            k = len(before) - 2
+            while k > 0 and before[k - 1] not in self.BREAK_CHARS:
+                k -= 1
+            lead = before[k:] + lead
+            before = before[:k]
+        if lead:
+            matches = self.candidates(before + lead + text, len(before), lead + text)
+            return [match[len(lead):] for match in matches if match.startswith(lead)]
+        # Only the command the cursor is in matters: after the last |, ;, & or (
+        start = max(before.rfind(sep) for sep in '|;&(') + 1
+        words = before[start:].split()
+        if text.startswith('$'):
+            return self.complete_variable(text)
+        if not words:
+            return self.complete_command(text)
+        completer = self.completers.get(words[0])
+        if completer is not None:
+            return completer(text, words[1:])
+        return self.complete_path(text)
+
+    def complete(self, text, state):
+        """readline completer entry point"""
+        if state == 0:
+            try:
+                matches = self.candidates(readline.get_line_buffer(), readline.get_begidx(), text)
+            except Exception:
+                matches = []
+            # readline doesn't add the space after a unique match for us
+            if len(matches) == 1 and not matches[0].endswith('/'):
+                matches = [matches[0] + ' ']
+            self.matches = matches
+        return self.matches[state] if state < len(self.matches) else None
+
+class Task:
+    """Result slot for one call run on a WorkerPool"""
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.value = None
+        self.error = None
+        self.event = threading.Event()
+        self.callbacks = []
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+        self.event.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds, returning True if the task finished"""
+        return self.event.wait(timeout)
+
+class WorkerPool:
+    """Small daemon thread pool; workers are started on demand.
+
+    Lighter than concurrent.futures, whose import alone (via logging)
+    costs more than the rest of startup.
+    """
+
+    def __init__(self, max_workers=4, name='miku-worker'):
+        self.max_workers = max_workers
+        self.name = name
+        self.queue = queue.SimpleQueue()
+        self.workers = []
+        self.idle = 0
+        self.lock = threading.Lock()
+
+    def worker(self):
+        while True:
+            task = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+            task.run()
+            with self.lock:
+                self.idle += 1
+
+    def submit(self, fn, *args, callback=None):
+        task = Task(fn, args)
+        if callback:
+            task.callbacks.append(callback)
+        with self.lock:
+            if self.idle == 0 and len(self.workers) < self.max_workers:
+                thread = threading.Thread(target=self.worker, name=f"{self.name}-{len(self.workers)}",
+                                          daemon=True)
+                self.workers.append(thread)
+                self.idle += 1
+                thread.start()
+        self.queue.put(task)
+        return task
+
+class DirectoryLister:
+    """ls engine built on os.scandir.
+
+    Every entry costs at most one stat (cached on its DirEntry), sort keys
+    are computed once per entry, and the whole listing is rendered into a
+    single buffer that is written in one go. Huge directories are streamed
+    instead: entries are printed unsorted as scandir yields them, in chunks.
+    """
+    
+    # Past this many entries an ordinary listing switches to streaming
+    STREAM_THRESHOLD = 20000
+    STREAM_CHUNK = 512
+
+    def __init__(self, icon_index, show_all=False, long_format=False, sort_by='name',
+                 reverse=False, one_per_line=False, nya=False):
+        self.icon_index = icon_index
+        self.icon_lookup = icon_index.lookup
+        self.show_all = show_all
+        self.long_format = long_format
+        self.sort_by = sort_by
+        self.reverse = reverse
+        self.one_per_line = one_per_line
+        self.nya = nya
+        self.user_names = {}
+        self.group_names = {}
+
+    def iter_entries(self, target):
+        """Yield (name, is_dir, stat) for each entry, stat only where needed"""
+        with os.scandir(target) as it:
+            for entry in it:
+                name = entry.name
+                if not self.show_all and name.startswith('.'):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    st = entry.stat() if (self.long_format or self.sort_by != 'name' or not is_dir) else None
+                except OSError:
+                    # Dangling symlink: describe the link itself
+                    is_dir = False
+                    st = entry.stat(follow_symlinks=False)
+                yield (name, is_dir, st)
+
+    def scan(self, target):
+        return list(self.iter_entries(target))
+
+    def sort_key(self):
+        if self.sort_by == 'size':
+            return lambda e: (-e[2].st_size, e[0])
+        if self.sort_by == 'time':
+            return lambda e: (-e[2].st_mtime_ns, e[0])
+        return lambda e: e[0]
+
+    def sort(self, entries, limit=None):
+        """Sort on keys computed once per entry; with a limit only limit entries are kept"""
+        key = self.sort_key()
+        if limit is not None:
+            pick = heapq.nlargest if self.reverse else heapq.nsmallest
+            return pick(limit, entries, key=key)
+        return sorted(entries, key=key, reverse=self.reverse)
+
+    def style(self, name, is_dir, st):
+        """Return (colored text, visible width) for an entry"""
+        if is_dir:
+            icon = FileIcons.FOLDER
+            color = Colors.BLUE if self.nya else Colors.BLUE + Colors.BOLD
+            suffix = "/"
+        else:
+            icon, color = self.icon_lookup(name)
+            if st is not None and stat.S_ISREG(st.st_mode) and st.st_mode & 0o111:
+                color = Colors.GREEN if self.nya else Colors.GREEN + Colors.BOLD
+                suffix = "*"
+            else:
+                color = color or Colors.RESET
+                suffix = ""
+        return f"{icon} {color}{name}{suffix}{Colors.RESET}", len(name) + len(suffix) + 2
+
+    def owner(self, uid):
+        name = self.user_names.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            self.user_names[uid] = name
+        return name
+
+    def group(self, gid):
+        name = self.group_names.get(gid)
+        if name is None:
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except KeyError:
+                name = str(gid)
+            self.group_names[gid] = name
+        return name
+
+    def format_long(self, entries):
+        rows = []
+        for name, is_dir, st in entries:
+            text, _ = self.style(name, is_dir, st)
+            rows.append((stat.filemode(st.st_mode), str(st.st_nlink), self.owner(st.st_uid),
+                         self.group(st.st_gid), str(st.st_size),
+                         time.strftime("%b %d %H:%M", time.localtime(st.st_mtime)), text))
+        if not rows:
+            return []
+        widths = [max(len(row[i]) for row in rows) for i in range(5)]
+        return [f"{mode} {nlink:>{widths[1]}} {user:<{widths[2]}} {group:<{widths[3]}} "
+                f"{size:>{widths[4]}} {mtime} {text}"
+                for mode, nlink, user, group, size, mtime, text in rows]
+
+    def format_columns(self, cells, width):
+        """GNU ls-style vertical columns using as few rows as fit in width"""
+        if not cells:
+            return []
+        widths = [w for _, w in cells]
+        count = len(cells)
+        # Most columns first: no more than the narrowest names could fill, and
+        # each try is one max() per column, so it's O(n) per column count.
+        # One column is always the answer when nothing narrower fits
+        for most in range(max(1, min(count, (width + 2) // (min(widths) + 2))), 0, -1):
+            rows = -(-count // most)
+            cols = -(-count // rows)
+            col_widths = [max(widths[c * rows:(c + 1) * rows]) + 2 for c in range(cols)]
+            if sum(col_widths) - 2 <= width:
+                break
+        lines = []
+        for r in range(rows):
+            line = []
+            for c in range(cols):
+                i = c * rows + r
+                if i >= count:
+                    break
+                text, w = cells[i]
+                last = c == cols - 1 or (c + 1) * rows + r >= count
+                line.append(text if last else text + ' ' * (col_widths[c] - w))
+            lines.append(''.join(line))
+        return lines
+
+    def stream_line(self, entry):
+        """Format one entry on its own, without looking at its neighbours"""
+        name, is_dir, st = entry
+        text, _ = self.style(name, is_dir, st)
+        if self.long_format:
+            return (f"{stat.filemode(st.st_mode)} {st.st_nlink:>3} {self.owner(st.st_uid):<8} "
+                    f"{self.group(st.st_gid):<8} {st.st_size:>10} "
+                    f"{time.strftime('%b %d %H:%M', time.localtime(st.st_mtime))} {text}")
+        if self.nya:
+            return f"  {Colors.PINK}♡{Colors.RESET} {text}"
+        return text
+
+    def wait_for_page(self, count):
+        """Pager prompt; returns False when the user wants to stop"""
+        sys.stdout.write(f"{Colors.DIM}-- {count} shown, Enter/Space for more, q to stop --{Colors.RESET}")
+        sys.stdout.flush()
+        fd = sys.stdin.fileno()
+        old = termios.tcgetattr(fd)
+        try:
+            tty.setcbreak(fd)
+            key = os.read(fd, 1)
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, old)
+        sys.stdout.write('\r\033[2K')
+        return key not in (b'q', b'Q', b'\x03', b'\x04')
+
+    def stream(self, entries, limit=None, page_height=None):
+        """Write entries as they arrive, in chunks; returns how many were shown.
+
+        With page_height, only a screenful is pulled from entries at a time.
+        """
+        count = 0
+        buf = []
+        for entry in entries:
+            if limit is not None and count >= limit:
+                break
+            buf.append(self.stream_line(entry))
+            count += 1
+            if page_height and count % page_height == 0:
+                sys.stdout.write('\n'.join(buf) + '\n')
+                buf = []
+                if not self.wait_for_page(count):
+                    break
+            elif len(buf) >= self.STREAM_CHUNK:
+                sys.stdout.write('\n'.join(buf) + '\n')
+                sys.stdout.flush()
+                buf = []
+        if buf:
+            sys.stdout.write('\n'.join(buf) + '\n')
+        sys.stdout.flush()
+        return count
+
+    def render(self, entries, width):
+        if self.long_format:
+            return self.format_long(entries)
+        cells = [self.style(name, is_dir, st) for name, is_dir, st in entries]
+        if self.nya:
+            return [f"  {Colors.PINK}♡{Colors.RESET} {text}" for text, _ in cells]
+        if self.one_per_line:
+            return [text for text, _ in cells]
+        return self.format_columns(cells, width)
+
+class GlobExpander:
+    """Brace and glob expansion (with ** recursion) for command arguments.
+
+    expand() returns sorted matches per word, like bash. iter_args() streams
+    matches unsorted as iglob/scandir finds them, so a huge expansion never
+    has to sit in memory all at once, and batches() cuts such a stream into
+    argument lists that each fit under ARG_MAX.
+    """
+
+    MAGIC = frozenset('*?[')
+    # Characters that make a word a pattern; quoted ones keep it literal
+    PATTERN_CHARS = MAGIC | {'{'}
+
+    def has_magic(self, word):
+        return not self.MAGIC.isdisjoint(word)
+
+    def split_brace_body(self, body):
+        """Alternatives for the inside of {...}, or None if it isn't a brace expression"""
+        parts = []
+        depth = 0
+        start = 0
+        for i, ch in enumerate(body):
+            if ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+            elif ch == ',' and depth == 0:
+                parts.append(body[start:i])
+                start = i + 1
+        if parts:
+            parts.append(body[start:])
+            return parts
         
-        # Set history length
-        readline.set_history_length(1000)
-        
-        # Save history on exit
-        atexit.register(readline.write_history_file, self.history_file)
+        # Sequence expressions: {1..10}, {10..1..2}, {a..e}
+        bounds = body.split('..')
+        if len(bounds) not in (2, 3):
+            return None
+        try:
+            step = abs(int(bounds[2])) or 1 if len(bounds) == 3 else 1
+        except ValueError:
+            return None
+        first, last = bounds[0], bounds[1]
+        try:
+            lo, hi = int(first), int(last)
+            as_text = str
+        except ValueError:
+            if len(first) != 1 or len(last) != 1:
+                return None
+            lo, hi = ord(first), ord(last)
+            as_text = chr
+        direction = 1 if hi >= lo else -1
+        return [as_text(n) for n in range(lo, hi + direction, step * direction)]
 
-    def setup_signals(self):
-        """Handle Ctrl+C gracefully"""
-        def signal_handler(sig, frame):
-            print(f"\n{Colors.YELLOW}B-baka! Don't interrupt me like that! >_<{Colors.RESET}")
-            self.show_prompt()
+    def expand_braces(self, word):
+        """Expand the brace expressions in word into a list of words"""
+        depth = 0
+        start = -1
+        for i, ch in enumerate(word):
+            if ch == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif ch == '}' and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    options = self.split_brace_body(word[start + 1:i])
+                    if options is not None:
+                        prefix, suffix = word[:start], word[i + 1:]
+                        words = []
+                        for option in options:
+                            words.extend(self.expand_braces(prefix + option + suffix))
+                        return words
+        return [word]
+
+    def iter_word(self, word, sort=True):
+        """Yield the expansions of one word; an unmatched pattern is kept as is"""
+        for candidate in self.expand_braces(word):
+            if not self.has_magic(candidate):
+                yield candidate
+                continue
+            matches = glob.iglob(candidate, recursive=True)
+            if sort:
+                matches = sorted(matches)
+            found = False
+            for match in matches:
+                found = True
+                yield match
+            if not found:
+                yield candidate
+
+    def expand(self, args, globs=None):
+        """Expand every argument, sorting each word's matches. Where globs[i] is false
+        (the pattern characters were quoted) args[i] is kept as is."""
+        expanded_args = []
+        for i, arg in enumerate(args):
+            if globs is None or globs[i]:
+                expanded_args.extend(self.iter_word(arg))
+            else:
+                expanded_args.append(arg)
+        return expanded_args
+
+    def iter_args(self, args, globs=None):
+        """Stream the expansion of args without sorting or buffering; globs as for expand()"""
+        for i, arg in enumerate(args):
+            if globs is None or globs[i]:
+                yield from self.iter_word(arg, sort=False)
+            else:
+                yield arg
+
+    def arg_limit(self):
+        """Bytes available for argv: ARG_MAX minus the environment and some headroom"""
+        try:
+            arg_max = os.sysconf('SC_ARG_MAX')
+        except (ValueError, OSError):
+            arg_max = 131072
+        env_size = sum(len(k) + len(v) + 2 + 8 for k, v in os.environ.items())
+        return max(4096, arg_max - env_size - 4096)
+
+    def batches(self, prefix, stream, suffix, limit=None):
+        """Cut stream into prefix + chunk + suffix argument lists under limit bytes each"""
+        limit = limit or self.arg_limit()
+        cost = lambda arg: len(os.fsencode(arg)) + 1 + 8  # string, NUL and argv pointer
+        base = sum(cost(arg) for arg in prefix) + sum(cost(arg) for arg in suffix)
+        chunk = []
+        size = base
+        for arg in stream:
+            arg_cost = cost(arg)
+            if chunk and size + arg_cost > limit:
+                yield prefix + chunk + suffix
+                chunk = []
+                size = base
+            chunk.append(arg)
+            size += arg_cost
+        if chunk:
+            yield prefix + chunk + suffix
+
+# '2>&1' as a redirection target; the same value as subprocess.STDOUT, so Popen takes it as is
+STDERR_TO_STDOUT = -2
+
+class ShellSyntaxError(ValueError):
+    """A command line that can't be parsed; the message is ready to show"""
+
+class Word:
+    """One shell word: its quote-removed text and the parts it was built from.
+
+    parts is a tuple of (kind, text) where kind is 'plain' (unquoted),
+    'double' (inside double quotes) or 'single' (literal: single quoted or
+    backslash escaped), so later stages know what was quoted.
+    """
+
+    def __init__(self, text, parts):
+        self.text = text
+        self.parts = parts
+
+    def dump(self):
+        return (self.text, self.parts)
+
+    @classmethod
+    def load(cls, data):
+        return cls(*data)
+
+    def is_plain(self):
+        """True if the word had no quoting at all"""
+        return len(self.parts) == 1 and self.parts[0][0] == 'plain'
+
+    def source(self):
+        return self.text if self.is_plain() else shlex.quote(self.text)
+
+    def globbable(self):
+        """False if a quoted part holds glob or brace characters: '{a,b}' and "*.txt" stay literal"""
+        return all(kind == 'plain' or GlobExpander.PATTERN_CHARS.isdisjoint(text) for kind, text in self.parts)
+
+class SimpleCommand:
+    """argv words plus the redirections that came with them"""
+
+    def __init__(self, words, redirects):
+        self.words = words
+        self.redirects = redirects  # [(operator, Word or None)]
+
+    def dump(self):
+        return ([word.dump() for word in self.words],
+                [(op, target.dump() if target else None) for op, target in self.redirects])
+
+    @classmethod
+    def load(cls, data):
+        words, redirects = data
+        return cls([Word(*word) for word in words],
+                   [(op, Word(*target) if target else None) for op, target in redirects])
+
+    def argv(self):
+        return [word.text for word in self.words]
+
+    def source(self):
+        """Roughly the text this was parsed from, for job names"""
+        return ' '.join([word.source() for word in self.words] +
+                        [op if target is None else f"{op} {target.source()}" for op, target in self.redirects])
+
+class Subshell:
+    """( list ) with its own redirections, run in a forked copy of the shell"""
+
+    def __init__(self, body, redirects):
+        self.body = body
+        self.redirects = redirects
+
+    def source(self):
+        return ' '.join([f"( {self.body.source()} )"] +
+                        [op if target is None else f"{op} {target.source()}" for op, target in self.redirects])
+
+    def dump(self):
+        return (self.body.dump(), [(op, target.dump() if target else None) for op, target in self.redirects])
+
+    @classmethod
+    def load(cls, data):
+        body, redirects = data
+        return cls(CommandList.load(body), [(op, Word(*target) if target else None) for op, target in redirects])
+
+class Pipeline:
+    """Commands (SimpleCommand or Subshell) joined by |, optionally run in the background"""
+
+    def __init__(self, commands, background=False):
+        self.commands = commands
+        self.background = background
+
+    def source(self):
+        return ' | '.join(command.source() for command in self.commands) + (' &' if self.background else '')
+
+    def dump(self):
+        return ([(type(command) is Subshell, command.dump()) for command in self.commands], self.background)
+
+    @classmethod
+    def load(cls, data):
+        commands, background = data
+        return cls([Subshell.load(command) if subshell else SimpleCommand.load(command)
+                    for subshell, command in commands], background)
+
+class CommandList:
+    """Pipelines in sequence: items are (operator, Pipeline), the operator being ';', '&&' or '||'
+    (the first item's is ';'). A trailing '&' is on the pipeline itself."""
+
+    def __init__(self, items):
+        self.items = items
+
+    def source(self):
+        text = ''
+        for op, pipeline in self.items:
+            if text:
+                text += ' ' if text.endswith('&') else ('; ' if op == ';' else f" {op} ")
+            text += pipeline.source()
+        return text
+
+    def dump(self):
+        return [(op, pipeline.dump()) for op, pipeline in self.items]
+
+    @classmethod
+    def load(cls, data):
+        return cls([(op, Pipeline.load(pipeline)) for op, pipeline in data])
+
+class CommandParser:
+    """Tokenizer and parser from a command line to a CommandList AST.
+
+    parse() is an LRU cache over the raw line, so re-running a history
+    entry or an alias skips tokenizing entirely; parse results are shared
+    and must never be modified. dump()/load() turn ASTs into plain data
+    for marshal, for the on-disk rc cache.
+    """
+
+    # Bump whenever the AST changes shape, to invalidate on-disk caches
+    VERSION = 4
+    # Longest first, so '>>' wins over '>'
+    OPERATORS = ('2>&1', '&&', '||', '>>', '2>', '|', '&', ';', '(', ')', '>', '<')
+    # Tokens that end a simple command
+    TERMINATORS = frozenset(('|', '&&', '||', ';', '&', ')'))
+    REDIRECTS = {
+        '>': "Baka! You need to specify a file after '>' >_<",
+        '>>': "Hmph! You need a file after '>>' >_<",
+        '<': "D-dummy! You need a file after '<' >_<",
+        '2>': "Idiot! You need a file after '2>' >_<",
+    }
+    # Lines without any of these are just whitespace separated words
+    SPECIAL = frozenset('\'"\\|&<>;()`')
+    NODES = {cls.__name__: cls for cls in (Word, SimpleCommand, Subshell, Pipeline, CommandList)}
+
+    def __init__(self, cache_size=1024):
+        self.parse = functools.lru_cache(maxsize=cache_size)(self.parse_line)
+
+    def word(self, parts):
+        return Word(''.join(text for _, text in parts), tuple(parts))
+
+    def tokenize(self, line):
+        """Words and operators, in order: a list of Word and operator strings"""
+        if self.SPECIAL.isdisjoint(line) and '${' not in line:
+            return [Word(text, (('plain', text),)) for text in line.split()]
         
-        signal.signal(signal.SIGINT, signal_handler)
+        tokens = []
+        parts = []   # finished parts of the current word
+        plain = []   # unquoted characters not yet in parts
+        in_word = False
+        i = 0
+        n = len(line)
+        while i < n:
+            c = line[i]
+            if c in ' \t\n':
+                if in_word:
+                    if plain:
+                        parts.append(('plain', ''.join(plain)))
+                        plain = []
+                    tokens.append(self.word(parts))
+                    parts = []
+                    in_word = False
+                i += 1
+            elif c == "'":
+                end = line.find("'", i + 1)
+                if end == -1:
+                    raise ShellSyntaxError("Baka! You forgot to close your ' quote >_<")
+                if plain:
+                    parts.append(('plain', ''.join(plain)))
+                    plain = []
+                parts.append(('single', line[i + 1:end]))
+                in_word = True
+                i = end + 1
+            elif c == '"':
+                if plain:
+                    parts.append(('plain', ''.join(plain)))
+                    plain = []
+                chunk = []
+                i += 1
+                while True:
+                    if i >= n:
+                        raise ShellSyntaxError('Baka! You forgot to close your " quote >_<')
+                    d = line[i]
+                    if d == '"':
+                        break
+                    if d == '`' or (d == '$' and line.startswith('$(', i)):
+                        end = CommandParser.substitution_end(line, i)
+                        chunk.append(line[i:end])
+                        i = end
+                        continue
+                    if d == '\\' and i + 1 < n and line[i + 1] in '\\"$`\n':
+                        if chunk:
+                            parts.append(('double', ''.join(chunk)))
+                            chunk = []
+                        parts.append(('single', line[i + 1]))
+                        i += 2
+                        continue
+                    chunk.append(d)
+                    i += 1
+                if chunk or not parts:
+                    parts.append(('double', ''.join(chunk)))
+                in_word = True
+                i += 1
+            elif c == '\\':
+                if i + 1 >= n:
+                    raise ShellSyntaxError("Hmph! A lonely backslash at the end? What's it escaping, baka? >_<")
+                if plain:
+                    parts.append(('plain', ''.join(plain)))
+                    plain = []
+                parts.append(('single', line[i + 1]))
+                in_word = True
+                i += 2
+            elif c == '`' or (c == '$' and line.startswith('$(', i)):
+                # $(...) and `...` stay whole for the expander, whatever is inside
+                end = CommandParser.substitution_end(line, i)
+                plain.append(line[i:end])
+                in_word = True
+                i = end
+            elif c == '$' and line.startswith('${', i):
+                # ${VAR:-some default} stays one word, spaces and all
+                end = CommandParser.closing_brace(line, i + 2)
+                plain.append(line[i:end + 1])
+                in_word = True
+                i = end + 1
+            elif c in '|&<>;()' or (c == '2' and not in_word and line.startswith('2>', i)):
+                op = next(op for op in self.OPERATORS if line.startswith(op, i))
+                if in_word:
+                    if plain:
+                        parts.append(('plain', ''.join(plain)))
+                        plain = []
+                    tokens.append(self.word(parts))
+                    parts = []
+                    in_word = False
+                tokens.append(op)
+                i += len(op)
+            else:
+                plain.append(c)
+                in_word = True
+                i += 1
+        if in_word:
+            if plain:
+                parts.append(('plain', ''.join(plain)))
+            tokens.append(self.word(parts))
+        return tokens
 
-    def load_rc_file(self):
-        """Load .mikurc file if it exists"""
-        if os.path.exists(self.rc_file):
-            try:
-                with open(self.rc_file, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            self.execute_command(line, suppress_output=True)
-            except Exception as e:
-                print(f"{Colors.RED}Hmph! Couldn't load .mikurc: {e} >_<{Colors.RESET}")
+    @staticmethod
+    def substitution_end(line, start):
+        """Index just past the $(...) or `...` starting at start, skipping quotes and nested ones"""
+        n = len(line)
+        if line[start] == '`':
+            i = start + 1
+            while i < n:
+                if line[i] == '\\':
+                    i += 2
+                elif line[i] == '`':
+                    return i + 1
+                else:
+                    i += 1
+            raise ShellSyntaxError("Baka! You forgot to close your ` quote >_<")
+        depth = 0
+        i = start + 1
+        while i < n:
+            c = line[i]
+            if c == '\\':
+                i += 2
+                continue
+            if c == "'":
+                i = line.find("'", i + 1)
+                if i == -1:
+                    break
+            elif c == '"':
+                i += 1
+                while i < n and line[i] != '"':
+                    if line[i] == '\\':
+                        i += 1
+                    elif line[i] == '`' or line.startswith('$(', i):
+                        i = CommandParser.substitution_end(line, i) - 1
+                    i += 1
+            elif c == '`':
+                i = CommandParser.substitution_end(line, i) - 1
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if not depth:
+                    return i + 1
+            i += 1
+        raise ShellSyntaxError("Baka! You forgot to close your '$(' >_<")
+
+    @staticmethod
+    def closing_brace(line, start):
+        """Index of the '}' closing a '${' whose body starts at start"""
+        depth = 1
+        for i in range(start, len(line)):
+            if line[i] == '{':
+                depth += 1
+            elif line[i] == '}':
+                depth -= 1
+                if not depth:
+                    return i
+        raise ShellSyntaxError("Baka! You forgot to close your '${' >_<")
+
+    def parse_line(self, line):
+        """CommandList for line, or None if there's nothing to run"""
+        tokens = self.tokenize(line)
+        if not tokens:
+            return None
+        commands, pos = self.parse_list(tokens, 0)
+        if pos < len(tokens):
+            raise ShellSyntaxError(f"Baka! What's that '{tokens[pos]}' doing there? >_<")
+        return commands
+
+    def parse_list(self, tokens, pos):
+        """list := and_or ((';' | '&') and_or)* [';' | '&'], up to the end or a ')'"""
+        items = []
+        chain = []  # the and_or being built: [(operator, Pipeline)]
+        op = ';'
+        n = len(tokens)
+        while pos < n and tokens[pos] != ')':
+            pipeline, pos = self.parse_pipeline(tokens, pos)
+            chain.append((op, pipeline))
+            if pos >= n or tokens[pos] == ')':
+                break
+            token = tokens[pos]
+            pos += 1
+            if token in ('&&', '||'):
+                if pos >= n or tokens[pos] in self.TERMINATORS:
+                    raise ShellSyntaxError(f"Hmph! '{token}' needs a command after it, baka! >_<")
+                op = token
+                continue
+            # ';' or '&' ends the and_or
+            items.extend(self.background(chain) if token == '&' else chain)
+            chain = []
+            op = ';'
+        items.extend(chain)
+        if not items:
+            token = tokens[pos] if pos < n else None
+            raise ShellSyntaxError("Baka! There's nothing inside those ( ) >_<" if token == ')'
+                                   else "Baka! There's nothing to run there >_<")
+        return CommandList(items), pos
+
+    def background(self, chain):
+        """An and_or ended by '&': one pipeline is just backgrounded, a longer chain runs in a background subshell"""
+        if len(chain) == 1:
+            op, pipeline = chain[0]
+            return [(op, Pipeline(pipeline.commands, True))]
+        body = CommandList([(';', chain[0][1])] + chain[1:])
+        return [(chain[0][0], Pipeline([Subshell(body, [])], True))]
+
+    def parse_pipeline(self, tokens, pos):
+        commands = []
+        while True:
+            node, pos = self.parse_command(tokens, pos)
+            commands.append(node)
+            if pos < len(tokens) and tokens[pos] == '|':
+                pos += 1
+                if pos >= len(tokens) or tokens[pos] in self.TERMINATORS:
+                    raise ShellSyntaxError("Baka! There's an empty command in your pipeline! >_<")
+                continue
+            return Pipeline(commands), pos
+
+    def parse_command(self, tokens, pos):
+        """A SimpleCommand, or a Subshell for '( list )', each with any redirections after it"""
+        n = len(tokens)
+        subshell = pos < n and tokens[pos] == '('
+        if subshell:
+            body, pos = self.parse_list(tokens, pos + 1)
+            if pos >= n:
+                raise ShellSyntaxError("Baka! You forgot to close your '(' >_<")
+            pos += 1
+        words = []
+        redirects = []
+        while pos < n:
+            token = tokens[pos]
+            if isinstance(token, Word):
+                if subshell:
+                    raise ShellSyntaxError(f"Hmph! What's '{token.text}' doing after ')'? >_<")
+                words.append(token)
+            elif token in self.REDIRECTS:
+                pos += 1
+                if pos >= n or not isinstance(tokens[pos], Word):
+                    raise ShellSyntaxError(self.REDIRECTS[token])
+                redirects.append((token, tokens[pos]))
+            elif token == '2>&1':
+                redirects.append((token, None))
+            elif token == '(':
+                raise ShellSyntaxError("Baka! A '(' can only start a command >_<")
+            else:
+                break
+            pos += 1
+        if subshell:
+            return Subshell(body, redirects), pos
+        if not words and not redirects:
+            token = tokens[pos] if pos < n else None
+            if token == '&':
+                raise ShellSyntaxError("Baka! Background what? There's nothing before '&' >_<")
+            if token == '|':
+                raise ShellSyntaxError("Baka! There's an empty command in your pipeline! >_<")
+            raise ShellSyntaxError(f"Baka! What's that '{token}' doing there? >_<")
+        return SimpleCommand(words, redirects), pos
+
+    def dump(self, node):
+        """AST -> nested lists/tuples of strings, as marshal likes them"""
+        return (type(node).__name__, node.dump())
+
+    def load(self, data):
+        """Inverse of dump()"""
+        name, payload = data
+        return self.NODES[name].load(payload)
+
+class ParameterExpander:
+    """$VAR, ${VAR...}, $?, $$, $#, $@, $1..., $(...), `...` and ~ expansion plus field splitting,
+    in one scan per word.
+
+    Works on Word.parts, so quoting decides what happens: 'single' parts are
+    literal, 'double' parts expand but stay one field, 'plain' parts expand
+    and the results split on IFS. lookup(name) returns a variable's value
+    (a list of the positional parameters for '@' and '*') or None,
+    assign(name, value) is what ${VAR:=word} calls and substitute(command)
+    runs a command substitution and returns its output.
+    """
+
+    NAME_START = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_')
+    NAME_CHARS = NAME_START | frozenset('0123456789')
+    SPECIAL = frozenset('?$#@*!-')
+    OPERATORS = (':-', ':=', ':+', '-', '=', '+')
+    BLANKS = ' \t\n'
+
+    def __init__(self, lookup, assign, substitute):
+        self.lookup = lookup
+        self.assign = assign
+        self.substitute = substitute
+
+    def needs_expansion(self, word):
+        text = word.text
+        return '$' in text or '`' in text or text.startswith('~')
+
+    def next_expansion(self, text, i, backticks):
+        """Index of the next '$' (or '`' if backticks) at or after i, -1 if none"""
+        j = text.find('$', i)
+        if backticks:
+            k = text.find('`', i)
+            if k != -1 and (j == -1 or k < j):
+                return k
+        return j
+
+    def substitutions(self, word):
+        """The commands of the word's own $(...) and `...` (not those in ${VAR:-...} defaults), in order"""
+        commands = []
+        for kind, text in word.parts:
+            if kind == 'single':
+                continue
+            backticks = '`' in text
+            i = 0
+            while True:
+                j = self.next_expansion(text, i, backticks)
+                if j == -1:
+                    break
+                if text[j] == '`':
+                    i = CommandParser.substitution_end(text, j)
+                    commands.append(self.backtick_command(text[j + 1:i - 1]))
+                elif text.startswith('$(', j):
+                    i = CommandParser.substitution_end(text, j)
+                    commands.append(text[j + 2:i - 1])
+                elif text.startswith('${', j):
+                    i = CommandParser.closing_brace(text, j + 2) + 1
+                else:
+                    i = j + 1
+        return commands
+
+    def backtick_command(self, body):
+        """Inside `...` a backslash only escapes $, ` and itself"""
+        if '\\' not in body:
+            return body
+        out = []
+        i = 0
+        while i < len(body):
+            if body[i] == '\\' and i + 1 < len(body) and body[i + 1] in '$`\\':
+                i += 1
+            out.append(body[i])
+            i += 1
+        return ''.join(out)
+
+    def expand(self, word, split=True):
+        """The (field, globbable) pairs a word expands to (none for an unquoted empty expansion);
+        one string if not split. A field isn't globbable once quoted text put a glob or brace
+        character in it: "$X" stays literal, $X and "$dir"/* don't."""
+        pattern = GlobExpander.PATTERN_CHARS
+        fields = []
+        current = []
+        quoted = False   # The current field exists even if it's empty, as "" does
+        literal = False  # ...and has quoted pattern characters
+        for index, (kind, text) in enumerate(word.parts):
+            if kind == 'single':
+                current.append(text)
+                quoted = True
+                literal = literal or not pattern.isdisjoint(text)
+                continue
+            double = kind == 'double'
+            if not text:
+                quoted = quoted or double
+                continue
+            if index == 0 and not double and text[0] == '~':
+                text = self.tilde(text)
+            backticks = '`' in text
+            i = 0
+            while True:
+                j = self.next_expansion(text, i, backticks)
+                if j == -1:
+                    break
+                value, end = self.parameter(text, j)
+                if end == j:
+                    j += 1  # A lone '$' is just a dollar sign
+                    end = j
+                if j > i:
+                    current.append(text[i:j])
+                    if double:
+                        quoted = True
+                        literal = literal or not pattern.isdisjoint(text[i:j])
+                i = end
+                if value is None:
+                    continue
+                if isinstance(value, list):
+                    if double and split:
+                        # "$@": one field per positional parameter
+                        for n, field in enumerate(value):
+                            if n:
+                                fields.append((''.join(current), not literal))
+                                current = []
+                                literal = False
+                            current.append(field)
+                            quoted = True
+                            literal = literal or not pattern.isdisjoint(field)
+                        continue
+                    value = ' '.join(value)
+                if double or not split:
+                    current.append(value)
+                    if double:
+                        quoted = True
+                        literal = literal or not pattern.isdisjoint(value)
+                elif value:
+                    pieces, before, after = self.split_fields(value)
+                    if before and (current or quoted):
+                        fields.append((''.join(current), not literal))
+                        current = []
+                        quoted = literal = False
+                    for n, piece in enumerate(pieces):
+                        if n:
+                            fields.append((''.join(current), not literal))
+                            current = []
+                            literal = False
+                        current.append(piece)
+                        quoted = True
+                    if after and (current or quoted):
+                        fields.append((''.join(current), not literal))
+                        current = []
+                        quoted = literal = False
+            if i < len(text):
+                current.append(text[i:])
+                if double:
+                    quoted = True
+                    literal = literal or not pattern.isdisjoint(text[i:])
+        if not split:
+            return ''.join(current)
+        if quoted or any(current):
+            fields.append((''.join(current), not literal))
+        return fields
+
+    def tilde(self, text):
+        """~ and ~user at the start of an unquoted word, up to the first '/'"""
+        slash = text.find('/')
+        name = text[1:] if slash == -1 else text[1:slash]
+        if not name:
+            home = self.lookup('HOME')
+        else:
+            try:
+                home = pwd.getpwnam(name).pw_dir
+            except KeyError:
+                home = None
+        if home is None:
+            return text
+        return home if slash == -1 else home + text[slash:]
+
+    def parameter(self, text, start):
+        """Value of the expansion at text[start] ('$' or '`') and the index after it; (None, start) if it isn't one"""
+        if text[start] == '`':
+            end = CommandParser.substitution_end(text, start)
+            return self.substitute(self.backtick_command(text[start + 1:end - 1])), end
+        i = start + 1
+        if i >= len(text):
+            return None, start
+        c = text[i]
+        if c == '(':
+            end = CommandParser.substitution_end(text, start)
+            return self.substitute(text[i + 1:end - 1]), end
+        if c == '{':
+            end = CommandParser.closing_brace(text, i + 1)
+            return self.braced(text[i + 1:end], text[start:end + 1]), end + 1
+        if c in self.NAME_START:
+            end = i + 1
+            while end < len(text) and text[end] in self.NAME_CHARS:
+                end += 1
+            value = self.lookup(text[i:end])
+            return value if value is not None else '', end
+        if c in self.SPECIAL or c.isdigit():
+            value = self.lookup(c)
+            return value if value is not None else '', i + 1
+        return None, start
+
+    def name_length(self, body):
+        """Length of the parameter name body starts with"""
+        if not body:
+            return 0
+        if body[0] in self.SPECIAL:
+            return 1
+        chars = '0123456789' if body[0].isdigit() else self.NAME_CHARS if body[0] in self.NAME_START else ''
+        end = 0
+        while end < len(body) and body[end] in chars:
+            end += 1
+        return end
+
+    def braced(self, body, source):
+        """${NAME}, ${#NAME} and ${NAME op word} for op in :- := :+ - = +"""
+        if body[:1] == '#' and len(body) > 1:
+            if self.name_length(body[1:]) != len(body) - 1:
+                raise ShellSyntaxError(f"Baka! Bad substitution: {source} >_<")
+            value = self.lookup(body[1:])
+            return str(len(value) if value is not None else 0)
+        end = self.name_length(body)
+        if not end:
+            raise ShellSyntaxError(f"Baka! Bad substitution: {source} >_<")
+        name = body[:end]
+        value = self.lookup(name)
+        if isinstance(value, list):
+            value = ' '.join(value) if value else None
+        if end == len(body):
+            return value if value is not None else ''
+        op = next((op for op in self.OPERATORS if body.startswith(op, end)), None)
+        if op is None:
+            raise ShellSyntaxError(f"Baka! Bad substitution: {source} >_<")
+        # With the colon, empty counts as unset
+        unset = value is None or (op[0] == ':' and not value)
+        if (op[-1] == '+') == unset:
+            return '' if unset else value
+        word = body[end + len(op):]
+        word = self.expand(Word(word, (('double', word),)), split=False)
+        if op[-1] == '=':
+            if name[0] not in self.NAME_START:
+                raise ShellSyntaxError(f"Hmph! You can't assign to ${name} like that, baka! >_<")
+            self.assign(name, word)
+        return word
+
+    def split_fields(self, value):
+        """IFS field splitting of an unquoted expansion: (fields, whether it split before, and after)"""
+        ifs = self.lookup('IFS')
+        if ifs is None:
+            ifs = self.BLANKS
+        if not ifs:
+            return [value], False, False
+        before = value[0] in ifs and value[0] in self.BLANKS
+        after = value[-1] in ifs
+        if ifs == self.BLANKS:
+            return value.split(), before, after
+        if all(c in self.BLANKS for c in ifs):
+            sep = ifs[0]
+            return [field for field in value.translate({ord(c): sep for c in ifs}).split(sep) if field], before, after
+        # Other IFS characters each end a field, empty or not; blanks around them don't add another
+        fields = []
+        current = []
+        in_field = False
+        after_blank = False
+        for c in value:
+            if c not in ifs:
+                current.append(c)
+                in_field = True
+                after_blank = False
+            elif c in self.BLANKS:
+                if in_field:
+                    fields.append(''.join(current))
+                    current = []
+                    in_field = False
+                    after_blank = True
+            elif after_blank:
+                after_blank = False
+            else:
+                fields.append(''.join(current))
+                current = []
+                in_field = False
+        if in_field:
+            fields.append(''.join(current))
+        return fields, before, after
+
+class NeedsExternal(Exception):
+    """A fast builtin was asked for something only the real utility does"""
+
+class TestError(Exception):
+    """A malformed test/[ expression; the message is ready to show"""
+
+class CoreUtils:
+    """In-process cat, head, tail, wc, true, false, test/[, basename, dirname, sleep and printf.
+
+    They talk to fds 0-2 directly: os.sendfile where the kernel allows it,
+    otherwise os.readv into one reusable buffer, so a hot loop of `cat`,
+    `head` or `[` never forks. Output and exit codes follow GNU coreutils
+    for the common flags; anything else raises NeedsExternal before doing
+    any work, and the shell runs the real binary instead. With interactive
+    set, reading the terminal and sleeping are left to the real binaries
+    too, so Ctrl-C, Ctrl-Z and Ctrl-D behave.
+    """
+
+    NAMES = ('cat', 'head', 'tail', 'wc', 'true', 'false', 'test', '[', 'basename', 'dirname', 'sleep', 'printf')
+    BUFFER_SIZE = 128 * 1024
+    SENDFILE_CHUNK = 1 << 30
+    # bytes.translate(None, CONTINUATION_DELETE) keeps only UTF-8 continuation bytes
+    CONTINUATION_DELETE = bytes(range(0x80)) + bytes(range(0xC0, 0x100))
+    UNARY_TESTS = frozenset('-b -c -d -e -f -g -G -h -k -L -n -O -p -r -s -S -t -u -w -x -z'.split())
+    BINARY_TESTS = frozenset('= == != < > -eq -ne -lt -le -gt -ge -nt -ot -ef'.split())
+    ESCAPES = {'\\': '\\', 'a': '\a', 'b': '\b', 'e': '\x1b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+               'v': '\v', '"': '"'}
+
+    def __init__(self):
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.interactive = False
+
+    def commands(self):
+        """name -> builtin function, for MikuShell.builtins"""
+        return {
+            'cat': self.cat,
+            'head': self.head,
+            'tail': self.tail,
+            'wc': self.wc,
+            'true': lambda args: 0,
+            'false': lambda args: 1,
+            'test': self.test,
+            '[': self.bracket,
+            'basename': self.basename,
+            'dirname': self.dirname,
+            'sleep': self.sleep,
+            'printf': self.printf,
+        }
+
+    # Plumbing
+
+    @staticmethod
+    def write(fd, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def error(self, name, message):
+        self.write(2, os.fsencode(f"{name}: {message}\n"))
+        return 1
+
+    @staticmethod
+    def quote(text):
+        """Quote a name for a message the way GNU does: curly quotes in a UTF-8 locale"""
+        locale = (os.environ.get('LC_ALL') or os.environ.get('LC_CTYPE') or os.environ.get('LANG') or '').lower()
+        return f"\u2018{text}\u2019" if 'utf-8' in locale or 'utf8' in locale else f"'{text}'"
+
+    def usage_error(self, name, message):
+        self.error(name, message)
+        self.write(2, os.fsencode(f"Try '{name} --help' for more information.\n"))
+        return 1
+
+    def options(self, args, flags, valued=''):
+        """GNU-style short options: ({letter: True or value}, operands); unknown ones need the real binary"""
+        opts = {}
+        operands = []
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg == '--':
+                operands.extend(args[i + 1:])
+                break
+            if not arg.startswith('-') or arg == '-':
+                operands.append(arg)
+            elif arg.startswith('--'):
+                raise NeedsExternal(arg)
+            else:
+                j = 1
+                while j < len(arg):
+                    letter = arg[j]
+                    if letter in valued:
+                        value = arg[j + 1:]
+                        if not value:
+                            i += 1
+                            if i >= len(args):
+                                raise NeedsExternal(arg)
+                            value = args[i]
+                        opts[letter] = value
+                        break
+                    if letter not in flags:
+                        raise NeedsExternal(arg)
+                    opts[letter] = True
+                    j += 1
+            i += 1
+        return opts, operands
+
+    def check_inputs(self, files):
+        """Hand the whole command to the real binary if it would read the user's terminal"""
+        if self.interactive and '-' in files and os.isatty(0):
+            raise NeedsExternal('-')
+
+    def open(self, path):
+        return 0 if path == '-' else os.open(path, os.O_RDONLY)
+
+    def close(self, fd):
+        if fd != 0:
+            os.close(fd)
+
+    def read(self, fd):
+        """One chunk from fd, as a view of the shared buffer; empty at EOF"""
+        return self.view[:os.readv(fd, [self.buffer])]
+
+    def chunks(self, fd):
+        while True:
+            chunk = self.read(fd)
+            if not chunk:
+                return
+            yield chunk
+
+    def lines(self, fd):
+        """fd's lines as bytes, newline included (the last one may lack it)"""
+        pending = b''
+        for chunk in self.chunks(fd):
+            data = pending + bytes(chunk)
+            start = 0
+            while True:
+                end = data.find(b'\n', start)
+                if end == -1:
+                    break
+                yield data[start:end + 1]
+                start = end + 1
+            pending = data[start:]
+        if pending:
+            yield pending
+
+    def copy(self, fd, limit=None):
+        """fd's contents (at most limit bytes) to stdout: sendfile when the kernel takes it, else through the buffer"""
+        if limit is None:
+            try:
+                while os.sendfile(1, fd, None, self.SENDFILE_CHUNK):
+                    pass
+                return
+            except OSError as e:
+                # Pipes as input, O_APPEND output and older kernels; nothing was sent
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ESPIPE):
+                    raise
+        while limit is None or limit > 0:
+            chunk = self.read(fd)
+            if not chunk:
+                return
+            if limit is not None:
+                chunk = chunk[:limit]
+                limit -= len(chunk)
+            self.write(1, chunk)
+
+    def each_file(self, name, files, run, headers=False):
+        """Call run(fd) for each file (or stdin), reporting open/read errors GNU-style; returns the exit code"""
+        code = 0
+        for i, path in enumerate(files):
+            try:
+                fd = self.open(path)
+            except OSError as e:
+                code = self.error(name, f"cannot open '{path}' for reading: {os.strerror(e.errno)}"
+                                  if name in ('head', 'tail') else f"{path}: {os.strerror(e.errno)}")
+                continue
+            try:
+                if headers:
+                    label = 'standard input' if path == '-' else path
+                    self.write(1, os.fsencode(f"{'' if i == 0 else chr(10)}==> {label} <==\n"))
+                run(fd)
+            except OSError as e:
+                code = self.error(name, f"{'error reading ' + self.quote(path) if name != 'cat' else path}: "
+                                        f"{os.strerror(e.errno)}")
+            finally:
+                self.close(fd)
+        return code
+
+    # The utilities
+
+    def cat(self, args):
+        """cat [-nbsE] [FILE...]"""
+        opts, files = self.options(args, 'nbsEu')
+        files = files or ['-']
+        self.check_inputs(files)
+        if not any(opts.get(letter) for letter in 'nbsE'):
+            return self.each_file('cat', files, self.copy)
+
+        state = {'number': 0, 'blank': False, 'start': True}
+        number_all = opts.get('n') and not opts.get('b')
+
+        def decorate(fd):
+            out = []
+            size = 0
+            for line in self.lines(fd):
+                blank = line == b'\n'
+                if opts.get('s') and blank and state['blank']:
+                    continue
+                state['blank'] = blank
+                start = state['start']
+                state['start'] = line.endswith(b'\n')
+                if start and (number_all or (opts.get('b') and not blank)):
+                    state['number'] += 1
+                    line = b'%6d\t' % state['number'] + line
+                if opts.get('E') and line.endswith(b'\n'):
+                    line = line[:-1] + b'$\n'
+                out.append(line)
+                size += len(line)
+                if size >= self.BUFFER_SIZE:
+                    self.write(1, b''.join(out))
+                    out = []
+                    size = 0
+            self.write(1, b''.join(out))
+        return self.each_file('cat', files, decorate)
+
+    def count_option(self, name, args):
+        """head/tail's -N shorthand, then their options: (opts, files)"""
+        if args and len(args[0]) > 1 and args[0][0] == '-' and args[0][1:].isdigit():
+            args = ['-n', args[0][1:]] + args[1:]
+        return self.options(args, 'qv', valued='nc')
+
+    def parse_count(self, name, value, what):
+        """Count for -n/-c: (number, from_start); suffixes like 1K and negative counts need the real binary"""
+        from_start = value.startswith('+')
+        digits = value[1:] if from_start else value
+        if not digits.isdigit():
+            if digits.startswith('-') or digits[-1:].isalpha():
+                raise NeedsExternal(value)
+            raise ValueError(f"invalid number of {what}: {self.quote(value)}")
+        return int(digits), from_start
+
+    def head(self, args):
+        """head [-n N|-N|-c N] [-qv] [FILE...]"""
+        opts, files = self.count_option('head', args)
+        files = files or ['-']
+        try:
+            if 'c' in opts:
+                count, _ = self.parse_count('head', opts['c'], 'bytes')
+            else:
+                count, _ = self.parse_count('head', opts.get('n', '10'), 'lines')
+        except ValueError as e:
+            return self.error('head', e)
+        self.check_inputs(files)
+        headers = opts.get('v') or (len(files) > 1 and not opts.get('q'))
+
+        def head_lines(fd):
+            remaining = count
+            while remaining > 0:
+                chunk = self.read(fd)
+                if not chunk:
+                    return
+                end = 0
+                while remaining > 0:
+                    end = self.buffer.find(b'\n', end, len(chunk)) + 1
+                    if end == 0:
+                        break
+                    remaining -= 1
+                self.write(1, chunk[:end] if end else chunk)
+
+        if 'c' in opts:
+            return self.each_file('head', files, lambda fd: self.copy(fd, count), headers)
+        return self.each_file('head', files, head_lines, headers)
+
+    def tail(self, args):
+        """tail [-n [+]N|-N|-c [+]N] [-qv] [FILE...]; -f goes to the real tail"""
+        opts, files = self.count_option('tail', args)
+        files = files or ['-']
+        try:
+            if 'c' in opts:
+                count, from_start = self.parse_count('tail', opts['c'], 'bytes')
+            else:
+                count, from_start = self.parse_count('tail', opts.get('n', '10'), 'lines')
+        except ValueError as e:
+            return self.error('tail', e)
+        self.check_inputs(files)
+        headers = opts.get('v') or (len(files) > 1 and not opts.get('q'))
+        by_bytes = 'c' in opts
+
+        def tail_file(fd):
+            st = os.fstat(fd)
+            seekable = stat.S_ISREG(st.st_mode)
+            if from_start:
+                # +N: everything from line/byte N on
+                skip = max(count - 1, 0)
+                if by_bytes:
+                    if seekable:
+                        os.lseek(fd, skip, os.SEEK_CUR)
+                    else:
+                        while skip > 0:
+                            chunk = self.read(fd)
+                            if not chunk:
+                                return
+                            if len(chunk) > skip:
+                                self.write(1, chunk[skip:])
+                            skip -= len(chunk)
+                    self.copy(fd)
+                    return
+                while skip > 0:
+                    chunk = self.read(fd)
+                    if not chunk:
+                        return
+                    data = bytes(chunk)
+                    start = 0
+                    while skip > 0:
+                        start = data.find(b'\n', start) + 1
+                        if start == 0:
+                            break
+                        skip -= 1
+                    if skip == 0 and start:
+                        self.write(1, data[start:])
+                self.copy(fd)
+                return
+
+            if seekable:
+                end = st.st_size
+                base = os.lseek(fd, 0, os.SEEK_CUR)
+                start = max(base, end - count) if by_bytes else self.tail_offset(fd, base, end, count)
+                os.lseek(fd, start, os.SEEK_SET)
+                self.copy(fd)
+                return
+            data = bytearray()
+            for chunk in self.chunks(fd):
+                data += chunk
+                if by_bytes and len(data) > 2 * count + self.BUFFER_SIZE:
+                    del data[:len(data) - count]
+            if by_bytes:
+                self.write(1, data[len(data) - count:] if count else b'')
+                return
+            self.write(1, data[self.tail_start(data, count):])
+
+        return self.each_file('tail', files, tail_file, headers)
+
+    @staticmethod
+    def tail_start(data, count):
+        """Index where the last count lines of data begin"""
+        if count == 0:
+            return len(data)
+        pos = len(data) - 1 if data.endswith(b'\n') else len(data)
+        for _ in range(count):
+            pos = data.rfind(b'\n', 0, pos)
+            if pos == -1:
+                return 0
+        return pos + 1
+
+    def tail_offset(self, fd, base, end, count):
+        """File offset of the last count lines, reading backwards block by block"""
+        if count == 0:
+            return end
+        pos = end
+        wanted = count
+        trailing = True  # The file's own final newline doesn't start a line
+        while pos > base:
+            size = min(self.BUFFER_SIZE, pos - base)
+            pos -= size
+            block = os.pread(fd, size, pos)
+            stop = len(block)
+            if trailing:
+                trailing = False
+                if block.endswith(b'\n'):
+                    stop -= 1
+            while True:
+                stop = block.rfind(b'\n', 0, stop)
+                if stop == -1:
+                    break
+                wanted -= 1
+                if wanted == 0:
+                    return pos + stop + 1
+        return base
+
+    def wc(self, args):
+        """wc [-lwmc] [FILE...]"""
+        opts, files = self.options(args, 'lwmc')
+        show = [letter for letter in 'lwmc' if opts.get(letter)] or ['l', 'w', 'c']
+        named = bool(files)
+        files = files or ['-']
+        self.check_inputs(files)
+
+        width = self.wc_width(files, show)
+        totals = dict.fromkeys('lwmc', 0)
+        code = 0
+        for path in files:
+            try:
+                fd = self.open(path)
+            except OSError as e:
+                code = self.error('wc', f"{path}: {os.strerror(e.errno)}")
+                continue
+            try:
+                counts = self.wc_counts(fd, show)
+            except OSError as e:
+                code = self.error('wc', f"{path}: {os.strerror(e.errno)}")
+                continue
+            finally:
+                self.close(fd)
+            for letter in totals:
+                totals[letter] += counts[letter]
+            self.write(1, os.fsencode(self.wc_line(counts, show, width, path if named else None)))
+        if len(files) > 1:
+            self.write(1, os.fsencode(self.wc_line(totals, show, width, 'total')))
+        return code
+
+    def wc_counts(self, fd, show):
+        counts = dict.fromkeys('lwmc', 0)
+        st = os.fstat(fd)
+        if show == ['c'] and stat.S_ISREG(st.st_mode):
+            counts['c'] = max(st.st_size - os.lseek(fd, 0, os.SEEK_CUR), 0)
+            return counts
+        in_word = False
+        for chunk in self.chunks(fd):
+            size = len(chunk)
+            counts['c'] += size
+            counts['l'] += self.buffer.count(b'\n', 0, size)
+            if 'm' in show or 'w' in show:
+                data = bytes(chunk)
+                if 'm' in show:
+                    counts['m'] += size - len(data.translate(None, self.CONTINUATION_DELETE))
+                if 'w' in show:
+                    words = len(data.split())
+                    if words and in_word and not data[:1].isspace():
+                        words -= 1  # The word carried over from the last chunk
+                    counts['w'] += words
+                    in_word = not data[-1:].isspace()
+        return counts
+
+    @staticmethod
+    def wc_width(files, show):
+        """GNU's column width: the digits of the regular files' sizes together, at least 7 if any
+        input isn't a regular file; none for one count of one input"""
+        if len(show) == 1 and len(files) == 1:
+            return 1
+        sizes = 0
+        minimum = 1
+        for path in files:
+            try:
+                st = os.fstat(0) if path == '-' else os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                sizes += st.st_size
+            else:
+                minimum = 7
+        return max(len(str(sizes)), minimum)
+
+    @staticmethod
+    def wc_line(counts, show, width, name):
+        line = ' '.join(f"{counts[letter]:>{width}}" for letter in show)
+        return f"{line} {name}\n" if name is not None else f"{line}\n"
+
+    def basename(self, args):
+        """basename NAME [SUFFIX], or basename -a [-s SUFFIX] NAME..."""
+        opts, names = self.options(args, 'a', valued='s')
+        if not names:
+            return self.usage_error('basename', 'missing operand')
+        suffix = opts.get('s', '')
+        if not opts.get('a') and 's' not in opts:
+            if len(names) > 2:
+                return self.usage_error('basename', f"extra operand {self.quote(names[2])}")
+            if len(names) == 2:
+                names, suffix = names[:1], names[1]
+        out = []
+        for name in names:
+            stripped = name.rstrip('/')
+            if not stripped:
+                out.append('/' if name else '')
+                continue
+            base = stripped.rsplit('/', 1)[-1]
+            if suffix and base != suffix and base.endswith(suffix):
+                base = base[:-len(suffix)]
+            out.append(base)
+        self.write(1, os.fsencode(''.join(f"{name}\n" for name in out)))
+        return 0
+
+    def dirname(self, args):
+        """dirname NAME..."""
+        _, names = self.options(args, '')
+        if not names:
+            return self.usage_error('dirname', 'missing operand')
+        out = []
+        for name in names:
+            stripped = name.rstrip('/')
+            if '/' not in stripped:
+                out.append('/' if name.startswith('/') else '.')
+                continue
+            parent = stripped.rsplit('/', 1)[0].rstrip('/')
+            out.append(parent or '/')
+        self.write(1, os.fsencode(''.join(f"{name}\n" for name in out)))
+        return 0
+
+    def sleep(self, args):
+        """sleep NUMBER[smhd]..."""
+        if self.interactive:
+            raise NeedsExternal('sleep')
+        if not args:
+            return self.usage_error('sleep', 'missing operand')
+        total = 0.0
+        for arg in args:
+            number, unit = (arg[:-1], arg[-1]) if arg[-1:] in 'smhd' else (arg, 's')
+            try:
+                value = float(number)
+                if value < 0 or value != value or '_' in number:
+                    raise ValueError(arg)
+            except ValueError:
+                return self.usage_error('sleep', f"invalid time interval {self.quote(arg)}")
+            total += value * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+        time.sleep(total)
+        return 0
+
+    # printf
+
+    def unescape(self, text, octal_digits):
+        """Backslash escapes in text: (expanded, stop) where stop means a \\c was hit"""
+        if '\\' not in text:
+            return text, False
+        out = []
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if c != '\\' or i + 1 >= n:
+                out.append(c)
+                i += 1
+                continue
+            d = text[i + 1]
+            if d in self.ESCAPES:
+                out.append(self.ESCAPES[d])
+                i += 2
+            elif d == 'c':
+                return ''.join(out), True
+            elif d == 'x' and i + 2 < n and text[i + 2] in '0123456789abcdefABCDEF':
+                j = i + 2
+                while j < min(i + 4, n) and text[j] in '0123456789abcdefABCDEF':
+                    j += 1
+                out.append(chr(int(text[i + 2:j], 16)))
+                i = j
+            elif d in '01234567':
+                # %b allows a leading 0 before up to three octal digits
+                start = i + 2 if octal_digits == 4 and d == '0' else i + 1
+                j = start
+                while j < min(start + 3, n) and text[j] in '01234567':
+                    j += 1
+                out.append(chr(int(text[start:j] or '0', 8) & 0xFF))
+                i = j
+            elif d in 'uU':
+                raise NeedsExternal('\\' + d)
+            else:
+                out.append('\\' + d)
+                i += 2
+        return ''.join(out), False
+
+    def printf_number(self, arg, conversion):
+        """An argument for a numeric conversion, GNU-style: (value, error message or None)"""
+        if arg[:1] in '\'"' and len(arg) > 1:
+            return ord(arg[1]), None
+        text = arg.strip()
+        if conversion in 'feEgGaA':
+            try:
+                return float(text) if text else 0.0, None
+            except ValueError:
+                return 0.0, f"{self.quote(arg)}: expected a numeric value"
+        sign = -1 if text.startswith('-') else 1
+        digits = text.lstrip('+-')
+        # The prefix picks the base, like strtol: 0x hex, 0 octal, else decimal
+        hexdigits = '0123456789abcdefABCDEF'
+        if digits[:2].lower() == '0x' and digits[2:3] and digits[2] in hexdigits:
+            base, digits, valid = 16, digits[2:], hexdigits
+        elif digits.startswith('0'):
+            base, valid = 8, '01234567'
+        else:
+            base, valid = 10, '0123456789'
+        good = len(digits) - len(digits.lstrip(valid))
+        if good == len(digits) and good:
+            return sign * int(digits, base), None
+        # Leading digits still count, with a complaint
+        if good:
+            return sign * int(digits[:good], base), f"{self.quote(arg)}: value not completely converted"
+        return 0, f"{self.quote(arg)}: expected a numeric value"
+
+    def printf(self, args):
+        """printf FORMAT [ARGUMENT...]"""
+        if not args:
+            return self.usage_error('printf', 'missing operand')
+        fmt, rest = args[0], args[1:]
+        out = []
+        code = 0
+        index = 0
+        while True:
+            consumed = False
+            i = 0
+            n = len(fmt)
+            stop = False
+            while i < n:
+                percent = fmt.find('%', i)
+                literal = fmt[i:] if percent == -1 else fmt[i:percent]
+                if literal:
+                    text, stop = self.unescape(literal, 3)
+                    out.append(text)
+                    if stop:
+                        break
+                if percent == -1:
+                    break
+                # %[flags][width][.precision]conversion
+                j = percent + 1
+                while j < n and fmt[j] in '-+ #0':
+                    j += 1
+                while j < n and fmt[j].isdigit():
+                    j += 1
+                if j < n and fmt[j] == '.':
+                    j += 1
+                    while j < n and fmt[j].isdigit():
+                        j += 1
+                if j >= n:
+                    self.error('printf', f"{fmt[percent:]}: invalid conversion specification")
+                    return 1
+                spec, conversion = fmt[percent:j], fmt[j]
+                i = j + 1
+                if conversion == '%' and spec == '%':
+                    out.append('%')
+                    continue
+                if conversion in '*qaA' or fmt[percent + 1:j + 1].count('*'):
+                    raise NeedsExternal(spec + conversion)
+                if conversion not in 'sbcdiouxXfeEgG':
+                    self.error('printf', f"{fmt[percent:j + 1]}: invalid conversion specification")
+                    return 1
+                arg = rest[index] if index < len(rest) else None
+                if arg is not None:
+                    index += 1
+                    consumed = True
+                if conversion == 'b':
+                    text, stop = self.unescape(arg or '', 4)
+                    out.append(f"{spec}s" % text)
+                    if stop:
+                        break
+                elif conversion == 's':
+                    out.append(f"{spec}s" % (arg or ''))
+                elif conversion == 'c':
+                    out.append(f"{spec}s" % (arg or '')[:1])
+                else:
+                    value, problem = self.printf_number(arg or '0', conversion)
+                    if problem:
+                        self.write(1, os.fsencode(''.join(out)))
+                        out = []
+                        code = self.error('printf', problem)
+                    if conversion in 'iu':
+                        conversion = 'd'
+                    out.append(f"{spec}{conversion}" % value)
+            if stop or not consumed or index >= len(rest):
+                break
+        if rest and index == 0 and not stop:
+            self.write(1, os.fsencode(''.join(out)))
+            out = []
+            self.error('printf', f"warning: ignoring excess arguments, starting with {self.quote(rest[0])}")
+        self.write(1, os.fsencode(''.join(out)))
+        return code
+
+    # test and [
+
+    def bracket(self, args):
+        if not args or args[-1] != ']':
+            self.error('[', f"missing {self.quote(']')}")
+            return 2
+        return self.run_test('[', args[:-1])
+
+    def test(self, args):
+        return self.run_test('test', args)
+
+    def run_test(self, name, args):
+        try:
+            return 0 if self.evaluate(args) else 1
+        except TestError as e:
+            self.error(name, e)
+            return 2
+
+    def evaluate(self, args):
+        """POSIX's rules by argument count, then a full -a/-o/!/( ) parser beyond four"""
+        n = len(args)
+        if n == 0:
+            return False
+        if n == 1:
+            return args[0] != ''
+        if n == 2:
+            if args[0] == '!':
+                return args[1] == ''
+            if args[0] in self.UNARY_TESTS:
+                return self.unary(args[0], args[1])
+            raise TestError(f"{self.quote(args[0])}: unary operator expected")
+        if n == 3:
+            if args[1] in self.BINARY_TESTS:
+                return self.binary(args[0], args[1], args[2])
+            if args[0] == '!':
+                return not self.evaluate(args[1:])
+            if args[0] == '(' and args[2] == ')':
+                return args[1] != ''
+            if args[1] in ('-a', '-o'):
+                left, right = args[0] != '', args[2] != ''
+                return (left and right) if args[1] == '-a' else (left or right)
+            raise TestError(f"{self.quote(args[1])}: binary operator expected")
+        if n == 4:
+            if args[0] == '!':
+                return not self.evaluate(args[1:])
+            if args[0] == '(' and args[3] == ')':
+                return self.evaluate(args[1:3])
+        value, pos = self.parse_or(args, 0)
+        if pos != n:
+            raise TestError(f"extra argument {self.quote(args[pos])}")
+        return value
+
+    def parse_or(self, args, pos):
+        value, pos = self.parse_and(args, pos)
+        while pos < len(args) and args[pos] == '-o':
+            right, pos = self.parse_and(args, pos + 1)
+            value = value or right
+        return value, pos
+
+    def parse_and(self, args, pos):
+        value, pos = self.parse_not(args, pos)
+        while pos < len(args) and args[pos] == '-a':
+            right, pos = self.parse_not(args, pos + 1)
+            value = value and right
+        return value, pos
+
+    def parse_not(self, args, pos):
+        if pos < len(args) and args[pos] == '!':
+            value, pos = self.parse_not(args, pos + 1)
+            return not value, pos
+        return self.parse_primary(args, pos)
+
+    def parse_primary(self, args, pos):
+        n = len(args)
+        if pos >= n:
+            raise TestError(f"missing argument after {self.quote(args[-1])}")
+        if args[pos] == '(':
+            value, pos = self.parse_or(args, pos + 1)
+            if pos >= n or args[pos] != ')':
+                raise TestError(f"missing argument after {self.quote(args[pos - 1])}")
+            return value, pos + 1
+        if pos + 2 < n and args[pos + 1] in self.BINARY_TESTS:
+            return self.binary(args[pos], args[pos + 1], args[pos + 2]), pos + 3
+        if args[pos] in self.UNARY_TESTS:
+            if pos + 1 >= n:
+                raise TestError(f"missing argument after {self.quote(args[pos])}")
+            return self.unary(args[pos], args[pos + 1]), pos + 2
+        return args[pos] != '', pos + 1
+
+    def integer(self, text):
+        digits = text.strip()
+        body = digits[1:] if digits[:1] in '+-' else digits
+        if not body.isdigit() or not body.isascii():
+            raise TestError(f"invalid integer {self.quote(text)}")
+        return int(digits)
+
+    def unary(self, op, arg):
+        if op == '-n':
+            return arg != ''
+        if op == '-z':
+            return arg == ''
+        if op == '-t':
+            try:
+                return os.isatty(self.integer(arg))
+            except OSError:
+                return False
+        if op in ('-r', '-w', '-x'):
+            return os.access(arg, {'-r': os.R_OK, '-w': os.W_OK, '-x': os.X_OK}[op])
+        try:
+            st = os.lstat(arg) if op in ('-h', '-L') else os.stat(arg)
+        except (OSError, ValueError):
+            return False
+        mode = st.st_mode
+        return {
+            '-e': True,
+            '-f': stat.S_ISREG(mode),
+            '-d': stat.S_ISDIR(mode),
+            '-b': stat.S_ISBLK(mode),
+            '-c': stat.S_ISCHR(mode),
+            '-p': stat.S_ISFIFO(mode),
+            '-S': stat.S_ISSOCK(mode),
+            '-h': stat.S_ISLNK(mode),
+            '-L': stat.S_ISLNK(mode),
+            '-s': st.st_size > 0,
+            '-g': bool(mode & stat.S_ISGID),
+            '-u': bool(mode & stat.S_ISUID),
+            '-k': bool(mode & stat.S_ISVTX),
+            '-O': st.st_uid == os.geteuid(),
+            '-G': st.st_gid == os.getegid(),
+        }[op]
+
+    def binary(self, left, op, right):
+        if op in ('=', '=='):
+            return left == right
+        if op == '!=':
+            return left != right
+        if op == '<':
+            return os.fsencode(left) < os.fsencode(right)
+        if op == '>':
+            return os.fsencode(left) > os.fsencode(right)
+        if op in ('-nt', '-ot', '-ef'):
+            try:
+                a = os.stat(left)
+            except OSError:
+                a = None
+            try:
+                b = os.stat(right)
+            except OSError:
+                b = None
+            if op == '-ef':
+                return a is not None and b is not None and (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+            if op == '-nt':
+                return a is not None and (b is None or a.st_mtime_ns > b.st_mtime_ns)
+            return b is not None and (a is None or a.st_mtime_ns < b.st_mtime_ns)
+        a, b = self.integer(left), self.integer(right)
+        return {'-eq': a == b, '-ne': a != b, '-lt': a < b, '-le': a <= b, '-gt': a > b, '-ge': a >= b}[op]
+
+class ParallelRunner:
+    """Run commands with at most max_jobs alive at once, capturing each one's output.
+
+    One selector loop reads every child's pipe without blocking, so there
+    is no thread per job; on_done(index, argv, code, output) is called as
+    each command finishes.
+    """
+
+    def __init__(self, spawn, max_jobs):
+        self.spawn = spawn
+        self.max_jobs = max_jobs
+
+    def run(self, commands, on_done):
+        selector = selectors.DefaultSelector()
+        running = {}  # fd -> [index, argv, proc, chunks]
+        commands = iter(commands)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(running) < self.max_jobs:
+                    try:
+                        index, argv = next(commands)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    try:
+                        proc = self.spawn(argv, stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    except OSError as e:
+                        on_done(index, argv, 127, f"{argv[0]}: {e.strerror or 'command not found'}\n".encode())
+                        continue
+                    fd = proc.stdout.fileno()
+                    os.set_blocking(fd, False)
+                    state = [index, argv, proc, []]
+                    running[fd] = state
+                    selector.register(fd, selectors.EVENT_READ, state)
+                
+                if not running:
+                    break
+                
+                for key, _ in selector.select():
+                    index, argv, proc, chunks = key.data
+                    try:
+                        data = os.read(key.fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    if data:
+                        chunks.append(data)
+                        continue
+                    # EOF: the command is done writing, collect it
+                    selector.unregister(key.fd)
+                    del running[key.fd]
+                    proc.stdout.close()
+                    code = proc.wait()
+                    on_done(index, argv, 128 - code if code < 0 else code, b''.join(chunks))
+        finally:
+            for index, argv, proc, chunks in running.values():
+                proc.kill()
+                proc.wait()
+            selector.close()
+
+class JobProcess:
+    """One process of a job, or a stage that failed before it could start"""
+    
+    # Status for a process reaped behind our back: its real exit code is gone
+    LOST = 127
+
+    def __init__(self, name, pid=None, popen=None, status=None):
+        self.name = name
+        self.pid = pid
+        self.popen = popen
+        self.status = status  # exit code once finished
+        self.stopped = False
+        self.started = time.monotonic()
+        self.ended = None
+        self.rusage = None    # from wait4, once reaped
+
+    def update(self, wait_status, rusage=None):
+        if os.WIFSTOPPED(wait_status):
+            self.stopped = True
+        elif os.WIFCONTINUED(wait_status):
+            self.stopped = False
+        else:
+            code = os.waitstatus_to_exitcode(wait_status)
+            # Signal deaths are reported bash-style as 128 + signal number
+            self.status = 128 - code if code < 0 else code
+            self.stopped = False
+            self.ended = time.monotonic()
+            self.rusage = rusage
+            if self.popen is not None:
+                # We reaped it ourselves; keep Popen from trying again
+                self.popen.returncode = self.status
+
+    def lost(self):
+        """Someone else reaped us, so the exit code is unknown; never count that as success"""
+        self.status = self.LOST
+        self.stopped = False
+        if self.popen is not None:
+            self.popen.returncode = self.status
+
+class ShellJob:
+    """A foreground or background job: one command or a whole pipeline"""
+
+    def __init__(self, command, processes, pgid=None):
+        self.id = None
+        self.command = command
+        self.processes = processes
+        self.pgid = pgid
+        self.accounted = False
+
+    def live(self):
+        return [p for p in self.processes if p.status is None]
+
+    def is_done(self):
+        return not self.live()
+
+    def is_stopped(self):
+        live = self.live()
+        return bool(live) and any(p.stopped for p in live)
+
+    def codes(self):
+        return [p.status for p in self.processes]
+
+    def state(self):
+        if self.is_done():
+            code = self.processes[-1].status
+            if code == 0:
+                return 'Done'
+            if code > 128:
+                try:
+                    return signal.Signals(code - 128).name
+                except ValueError:
+                    pass
+            return f'Exit {code}'
+        return 'Stopped' if self.is_stopped() else 'Running'
+
+    def poll(self):
+        """Collect status changes without blocking"""
+        for process in self.live():
+            try:
+                pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+            except ChildProcessError:
+                process.lost()
+                continue
+            if pid:
+                process.update(wait_status, rusage)
+
+    def wait(self):
+        """Block until every process finishes, or until one is stopped"""
+        for process in self.live():
+            try:
+                _, wait_status, rusage = os.wait4(process.pid, os.WUNTRACED)
+            except ChildProcessError:
+                process.lost()
+                continue
+            process.update(wait_status, rusage)
+            if process.stopped:
+                return
+
+    def stats(self):
+        """CommandStats for the whole job: wall clock start to finish, CPU summed, peak RSS of the largest process"""
+        reaped = [p for p in self.processes if p.rusage is not None]
+        if not reaped:
+            return None
+        wall = max(p.ended for p in reaped) - min(p.started for p in reaped)
+        return CommandStats(self.command, wall,
+                            sum(p.rusage.ru_utime for p in reaped),
+                            sum(p.rusage.ru_stime for p in reaped),
+                            max(CommandStats.maxrss_kib(p.rusage) for p in reaped))
+
+    def signal(self, sig):
+        if self.pgid is not None:
+            os.killpg(self.pgid, sig)
+        else:
+            for process in self.live():
+                os.kill(process.pid, sig)
+
+class CommandStats:
+    """Wall time, user/sys CPU seconds and peak RSS (KiB) of one finished command"""
+
+    def __init__(self, name, wall, user, sys_time, maxrss):
+        self.name = name
+        self.wall = wall
+        self.user = user
+        self.sys = sys_time
+        self.maxrss = maxrss
+
+    @staticmethod
+    def maxrss_kib(rusage):
+        # Linux reports ru_maxrss in KiB, macOS in bytes
+        return rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+
+    @staticmethod
+    def format_size(kib):
+        if kib >= 1024 * 1024:
+            return f"{kib / 1024 / 1024:.1f}G"
+        if kib >= 1024:
+            return f"{kib / 1024:.1f}M"
+        return f"{kib}K"
+
+    def format(self):
+        text = f"{self.wall:.3f}s real, {self.user:.3f}s user, {self.sys:.3f}s sys"
+        if self.maxrss is not None:
+            text += f", {self.format_size(self.maxrss)} rss"
+        return text
+
+    def env_value(self):
+        """$MIKU_LAST_STATS: space separated key=value pairs"""
+        value = f"wall={self.wall:.6f} user={self.user:.6f} sys={self.sys:.6f}"
+        if self.maxrss is not None:
+            value += f" maxrss_kb={self.maxrss}"
+        return value
+
+class CommandStatsTable:
+    """Per-command-name totals of CommandStats, for the stats builtin"""
+
+    def __init__(self):
+        self.totals = {}  # name -> [runs, wall, user, sys, peak rss]
+
+    def add(self, name, stats):
+        total = self.totals.get(name)
+        if total is None:
+            total = self.totals[name] = [0, 0.0, 0.0, 0.0, 0]
+        total[0] += 1
+        total[1] += stats.wall
+        total[2] += stats.user
+        total[3] += stats.sys
+        total[4] = max(total[4], stats.maxrss or 0)
+
+    def add_job(self, job):
+        """Account each reaped process of a job under its own command name"""
+        for process in job.processes:
+            if process.rusage is not None:
+                self.add(os.path.basename(process.name), CommandStats(
+                    process.name, process.ended - process.started, process.rusage.ru_utime,
+                    process.rusage.ru_stime, CommandStats.maxrss_kib(process.rusage)))
+
+    def top(self, key='wall', limit=None):
+        """(name, totals) sorted by total wall time, CPU time or run count"""
+        keys = {
+            'wall': lambda item: item[1][1],
+            'cpu': lambda item: item[1][2] + item[1][3],
+            'runs': lambda item: item[1][0],
+            'rss': lambda item: item[1][4],
+        }
+        items = sorted(self.totals.items(), key=keys[key], reverse=True)
+        return items[:limit] if limit else items
+
+    def clear(self):
+        self.totals.clear()
+
+class JobTable:
+    """Numbered jobs, with bash-style %n / %% / %+ / %- job specs"""
+
+    def __init__(self, on_done=None):
+        self.jobs = {}
+        self.order = []  # job ids, most recently used last
+        self.on_done = on_done  # called with each finished job as it leaves the table
+
+    def add(self, job):
+        if job.id is None:
+            job.id = 1
+            while job.id in self.jobs:
+                job.id += 1
+            self.jobs[job.id] = job
+        self.touch(job)
+        return job.id
+
+    def touch(self, job):
+        if job.id in self.order:
+            self.order.remove(job.id)
+        self.order.append(job.id)
+
+    def remove(self, job):
+        if self.jobs.pop(job.id, None) is not None:
+            self.order.remove(job.id)
+            if self.on_done is not None and job.is_done():
+                self.on_done(job)
+
+    def marker(self, job):
+        if self.order and self.order[-1] == job.id:
+            return '+'
+        if len(self.order) > 1 and self.order[-2] == job.id:
+            return '-'
+        return ' '
+
+    def get(self, spec=None):
+        """Look up a job spec, or None if there is no such job"""
+        if spec in (None, '%', '%%', '%+'):
+            return self.jobs[self.order[-1]] if self.order else None
+        if spec == '%-':
+            return self.jobs[self.order[-2]] if len(self.order) > 1 else None
+        number = spec[1:] if spec.startswith('%') else spec
+        if number.isdigit():
+            return self.jobs.get(int(number))
+        # %name: the job whose command starts with name
+        for job_id in reversed(self.order):
+            if self.jobs[job_id].command.startswith(number):
+                return self.jobs[job_id]
+        return None
+
+    def poll(self):
+        for job in list(self.jobs.values()):
+            job.poll()
+
+    def has_stopped(self):
+        return any(job.is_stopped() for job in self.jobs.values())
+
+class PromptTemplate:
+    """PS1-style prompt template, compiled once into literal and dynamic parts.
+
+    Escapes: \\u user, \\h short host, \\H host, \\w cwd (with ~), \\W cwd basename,
+    \\$ '#' for root else '$', \\t time, \\d date, \\? last exit code, \\j job count,
+    \\g prompt segments (git, venv, ...), \\n newline, \\e escape, \\\\ backslash and
+    \\{NAME} for a Colors attribute such as \\{CYAN} or \\{RESET}.
+
+    Everything that can't change during a session is folded into the
+    literals at compile time. Each dynamic part keeps the input it was last
+    rendered from (cwd, clock second, ...) and is only recomputed when that
+    input changes.
+    """
+
+    DEFAULT = ("\\{CYAN}→ \\{RESET}\\{DIM}[\\t \\d]\\{RESET} - \\{GREEN}[\\u - \\H]\\{RESET}\\g\\n"
+               "\\{CYAN}→ \\{PINK}nya~(\\w)\\$>\\{RESET} ")
+    DYNAMIC = {'w': 'cwd', 'W': 'cwd_base', 't': 'time', 'd': 'date', '?': 'status',
+               'j': 'jobs', 'g': 'segments'}
+
+    def __init__(self, source, static_values):
+        self.source = source
+        self.parts = self.compile(source, static_values)
+        self.dynamic = {part for part in self.parts if not isinstance(part, str)}
+        self.uses = {key for key, in self.dynamic}
+        self.cache = {}  # key -> (input, rendered value)
+
+    def compile(self, source, static_values):
+        """Split source into a list of literal strings and 1-tuples naming dynamic parts"""
+        parts = []
+        literal = []
+        i = 0
+        while i < len(source):
+            ch = source[i]
+            if ch != '\\' or i + 1 == len(source):
+                literal.append(ch)
+                i += 1
+                continue
+            code = source[i + 1]
+            i += 2
+            if code in self.DYNAMIC:
+                if literal:
+                    parts.append(''.join(literal))
+                    literal = []
+                parts.append((self.DYNAMIC[code],))
+            elif code == '{':
+                end = source.find('}', i)
+                name = source[i:end] if end != -1 else ''
+                if not name or not hasattr(Colors, name.upper()):
+                    raise ValueError(f"Unknown color: {name}")
+                literal.append(getattr(Colors, name.upper()))
+                i = end + 1
+            elif code in static_values:
+                literal.append(static_values[code])
+            else:
+                literal.append('\\' + code)
+        if literal:
+            parts.append(''.join(literal))
+        return parts
+
+    def render(self, inputs, compute):
+        """inputs maps each dynamic key to its current input; compute(key, input) renders it"""
+        out = []
+        cache = self.cache
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            key = part[0]
+            value = inputs[key]
+            cached = cache.get(key)
+            if cached is None or cached[0] != value:
+                cached = (value, compute(key, value))
+                cache[key] = cached
+            out.append(cached[1])
+        return ''.join(out)
+
+class HistoryRecord:
+    """One history entry; legacy plain-text lines only have a command"""
+
+    def __init__(self, command, timestamp=None, session=None, duration=None, exit_code=None, cwd=None):
+        self.command = command
+        self.timestamp = timestamp
+        self.session = session
+        self.duration = duration
+        self.exit_code = exit_code
+        self.cwd = cwd
+
+class HistoryStore:
+    """Append-only history file shared between sessions.
+
+    Each command is written as soon as it finishes, with one write() on an
+    O_APPEND descriptor, so a crash loses at most the running command and
+    concurrent sessions never overwrite each other. A line holds
+    timestamp, session, duration, exit code, cwd and command, tab separated.
+    Startup reads only the tail of the file, and every prompt picks up
+    whatever other sessions appended since the last look.
+    """
+
+    TAIL_BYTES = 256 * 1024
+    READ_CHUNK = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.session = str(os.getpid())
+        self.fd = None
+        self.offset = 0
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        return self.fd
+
+    def escape(self, text):
+        return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    def unescape(self, text):
+        if '\\' not in text:
+            return text
+        out = []
+        i = 0
+        while i < len(text):
+            ch = text[i]
+            if ch == '\\' and i + 1 < len(text):
+                nxt = text[i + 1]
+                out.append('\t' if nxt == 't' else '\n' if nxt == 'n' else nxt)
+                i += 2
+            else:
+                out.append(ch)
+                i += 1
+        return ''.join(out)
+
+    def parse(self, line):
+        """Parse one line; anything that isn't a full record is a legacy command-only line"""
+        fields = line.split('\t')
+        if len(fields) == 6:
+            try:
+                return HistoryRecord(self.unescape(fields[5]), float(fields[0]), fields[1],
+                                     float(fields[2]), int(fields[3]), self.unescape(fields[4]))
+            except ValueError:
+                pass
+        return HistoryRecord(line)
+
+    def append(self, command, cwd, duration, exit_code, timestamp=None):
+        line = (f"{timestamp or time.time():.3f}\t{self.session}\t{duration:.3f}\t{exit_code}\t"
+                f"{self.escape(cwd)}\t{self.escape(command)}\n")
+        try:
+            os.write(self.open(), line.encode('utf-8', 'surrogateescape'))
+        except OSError:
+            pass
+
+    def scan(self, start, end, track=True):
+        """Yield records for the complete lines between start and end.
+
+        With track, self.offset ends up just past the last complete line, so
+        a line that is still being written is picked up whole on the next read.
+        """
+        partial = b''
+        offset = start
+        while offset < end:
+            chunk = os.pread(self.fd, min(self.READ_CHUNK, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            if track:
+                self.offset = offset - len(partial)
+            for raw in lines:
+                if raw:
+                    yield self.parse(raw.decode('utf-8', 'surrogateescape'))
+
+    def load_tail(self):
+        """Records from the last TAIL_BYTES of the file"""
+        try:
+            end = os.fstat(self.open()).st_size
+        except OSError:
+            return []
+        start = max(0, end - self.TAIL_BYTES)
+        if start:
+            # Skip the (probably cut) first line
+            head = os.pread(self.fd, self.READ_CHUNK, start)
+            newline = head.find(b'\n')
+            start = start + newline + 1 if newline != -1 else end
+        self.offset = start
+        return list(self.scan(start, end))
+
+    def load_all(self):
+        """Every record up to what the tail/merge reads have already seen"""
+        if self.fd is None:
+            return iter(())
+        return self.scan(0, self.offset, track=False)
+
+    def read_new(self):
+        """Records appended since the last read, this session's included"""
+        if self.fd is None:
+            return []
+        try:
+            end = os.fstat(self.fd).st_size
+        except OSError:
+            return []
+        if end <= self.offset:
+            return []
+        return list(self.scan(self.offset, end))
+
+class HistoryIndex:
+    """Trigram index over every distinct command in the history file.
+
+    Each distinct command gets an id, and each lowercased trigram maps to an
+    array of the ids containing it, so a query only looks at the commands
+    sharing its rarest trigram. Run counts, last use, cwds and exit codes are
+    kept per command for ranking and filtering, and every run is logged in
+    order so broad queries can stop after the most recent matches instead
+    of ranking the whole history. New records are fed in as they show up,
+    nothing is ever rebuilt.
+    """
+
+    # How much larger than the current candidate set a posting list may be
+    # and still be worth intersecting instead of checking substrings
+    INTERSECT_RATIO = 8
+    # Broad queries rank only this many of the most recently used matches
+    MAX_RANKED = 5000
+
+    def __init__(self):
+        self.ids = {}
+        self.commands = []
+        self.lowered = []
+        self.counts = []
+        self.last_used = []
+        self.cwds = []
+        self.codes = []
+        self.postings = {}
+        self.uses = array.array('I')
+
+    def __len__(self):
+        return len(self.commands)
+
+    def trigrams(self, text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, record):
+        command = record.command.strip()
+        if not command:
+            return
+        entry = self.ids.get(command)
+        if entry is None:
+            entry = len(self.commands)
+            self.ids[command] = entry
+            lowered = command.lower()
+            self.commands.append(command)
+            self.lowered.append(lowered)
+            self.counts.append(0)
+            self.last_used.append(0.0)
+            self.cwds.append(set())
+            self.codes.append(set())
+            for gram in self.trigrams(lowered):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array.array('I')
+                posting.append(entry)
+        self.uses.append(entry)
+        self.counts[entry] += 1
+        if record.timestamp and record.timestamp > self.last_used[entry]:
+            self.last_used[entry] = record.timestamp
+        if record.cwd is not None:
+            self.cwds[entry].add(record.cwd)
+        if record.exit_code is not None:
+            self.codes[entry].add(record.exit_code)
+
+    def candidates(self, terms):
+        """Ids that can contain every term, from the rarest trigrams; None means all"""
+        grams = set()
+        for term in terms:
+            grams |= self.trigrams(term)
+        if not grams:
+            return None
+        postings = []
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if not result or len(posting) > len(result) * self.INTERSECT_RATIO:
+                break
+            result.intersection_update(posting)
+        return result
+
+    def recent(self, ids):
+        """Distinct ids (restricted to ids unless None), most recently used first"""
+        seen = set()
+        uses = self.uses
+        for i in range(len(uses) - 1, -1, -1):
+            entry = uses[i]
+            if entry in seen or (ids is not None and entry not in ids):
+                continue
+            seen.add(entry)
+            yield entry
+
+    def quality(self, lowered, term):
+        """Exact > prefix > word start > anywhere"""
+        if lowered == term:
+            return 4
+        pos = lowered.find(term)
+        if pos == 0:
+            return 3
+        if lowered[pos - 1] in ' /-_.=|;&':
+            return 2
+        return 1
+
+    def search(self, query, limit=20, cwd=None, exit_code=None, failed=None, now=None):
+        """Best matching commands as (score, id), highest first.
+
+        Every whitespace separated term has to appear (case-insensitively).
+        cwd/exit_code/failed keep only commands that were run there / with
+        that status.
+        """
+        terms = query.lower().split()
+        ids = self.candidates(terms)
+        broad = ids is None or len(ids) > self.MAX_RANKED
+        entries = self.recent(ids) if broad else ids
+        now = now or time.time()
+        lowered = self.lowered
+        scored = []
+        for entry in entries:
+            text = lowered[entry]
+            if not all(term in text for term in terms):
+                continue
+            if cwd is not None and cwd not in self.cwds[entry]:
+                continue
+            codes = self.codes[entry]
+            if exit_code is not None and exit_code not in codes:
+                continue
+            if failed is not None and not any((code != 0) == failed for code in codes):
+                continue
+            quality = self.quality(text, terms[0]) if terms else 1
+            age = max(0.0, now - self.last_used[entry]) if self.last_used[entry] else 10 * 365 * 86400.0
+            recency = 1.0 / (1.0 + age / 86400.0)
+            score = quality + 2.0 * recency + 0.5 * math.log1p(self.counts[entry])
+            scored.append((score, entry))
+            if broad and len(scored) >= self.MAX_RANKED:
+                break
+        return heapq.nlargest(limit, scored)
+
+class PromptSegment:
+    """A single piece of the prompt, computed by a provider on a background thread"""
+
+    def __init__(self, name, provider, budget=0.05, color=Colors.CYAN, fmt=' [{name} - {value}]', per_cwd=True):
+        self.name = name
+        self.provider = provider
+        self.budget = budget
+        self.color = color
+        self.fmt = fmt
+        self.per_cwd = per_cwd
+
+    def render(self, value):
+        if not value:
+            return ''
+        return f"{self.color}{self.fmt.format(name=self.name, value=value)}{Colors.RESET}"
+
+class PromptSegmentManager:
+    """Runs prompt segment providers on a thread pool with per-segment time budgets.
+
+    Values are served stale-while-revalidate: if a provider misses its budget
+    the last known value is rendered, and on_update is called once the fresh
+    value arrives so the prompt can be redrawn.
+    """
+
+    def __init__(self, max_workers=4):
+        self.segments = {}
+        self.pool = WorkerPool(max_workers, name='miku-segment')
+        self.lock = threading.Lock()
+        self.values = {}   # (name, context) -> last known value
+        self.pending = {}  # (name, context) -> in-flight task
+        self.context = None
+        self.on_update = None
+
+    def register(self, segment):
+        self.segments[segment.name] = segment
+
+    def unregister(self, name):
+        return self.segments.pop(name, None) is not None
+
+    def cache_key(self, segment, cwd):
+        return (segment.name, cwd if segment.per_cwd else None)
+
+    def refresh(self, segment, key, cwd):
+        """Submit a provider run unless one is already in flight for this key"""
+        with self.lock:
+            task = self.pending.get(key)
+            if task is not None and not task.done():
+                return task
+            task = self.pool.submit(segment.provider, cwd, callback=lambda t: self.store(key, t))
+            self.pending[key] = task
+        return task
+
+    def store(self, key, task):
+        value = task.value if task.error is None else None
+        with self.lock:
+            if self.pending.get(key) is task:
+                del self.pending[key]
+            changed = self.values.get(key) != value
+            self.values[key] = value
+            current = key[1] == self.context or key[1] is None
+        if changed and current and self.on_update:
+            self.on_update()
+
+    def collect(self, cwd):
+        """Return {name: value} for every segment, waiting at most each segment's budget"""
+        self.context = cwd
+        start = time.monotonic()
+        tasks = []
+        for segment in list(self.segments.values()):
+            key = self.cache_key(segment, cwd)
+            tasks.append((segment, key, self.refresh(segment, key, cwd)))
+
+        results = {}
+        for segment, key, task in tasks:
+            remaining = segment.budget - (time.monotonic() - start)
+            task.wait(max(0.0, remaining))
+            with self.lock:
+                results[segment.name] = self.values.get(key)
+        return results
+
+    def prefetch(self, cwd):
+        """Start every provider for cwd without waiting on any of them"""
+        for segment in list(self.segments.values()):
+            self.refresh(segment, self.cache_key(segment, cwd), cwd)
+
+    def collect_cached(self, cwd):
+        """Return the last known values for cwd without running any provider"""
+        with self.lock:
+            return {name: self.values.get(self.cache_key(segment, cwd))
+                    for name, segment in self.segments.items()}
+
+    def render(self, values):
+        return ''.join(segment.render(values.get(name)) for name, segment in self.segments.items())
+
+class ScriptReader:
+    """Lines of a script, read a chunk at a time as they're needed.
+
+    With share (the script is the shell's own stdin), the file offset is
+    put back at the end of each line before it runs, so commands that read
+    stdin get the rest of the file like they would under sh. That only
+    works on seekable input; a pipe is read ahead a chunk at a time.
+    """
+
+    CHUNK = 64 * 1024
+    SHARED_CHUNK = 4096
+
+    def __init__(self, fd, share=False):
+        self.fd = fd
+        self.share = False
+        if share:
+            try:
+                os.lseek(fd, 0, os.SEEK_CUR)
+                self.share = True
+            except OSError:
+                pass
+
+    def __iter__(self):
+        buf = b''
+        chunk = self.SHARED_CHUNK if self.share else self.CHUNK
+        while True:
+            newline = buf.find(b'\n')
+            if newline == -1:
+                data = os.read(self.fd, chunk)
+                if not data:
+                    if buf:
+                        yield buf.decode('utf-8', 'surrogateescape')
+                    return
+                buf += data
+                continue
+            line, buf = buf[:newline], buf[newline + 1:]
+            if self.share and buf:
+                os.lseek(self.fd, -len(buf), os.SEEK_CUR)
+                buf = b''
+            yield line.decode('utf-8', 'surrogateescape')
+
+class MikuShell:
+    # What the Ctrl-R binding puts in front of the line
+    HISTORY_SEARCH_KEY = '\x12'
+
+    def __init__(self, profile=None, interactive=True):
+        # Non-interactive shells (-c, scripts, stdin) skip readline, the rc
+        # file, prompt segments and the per-command status lines
+        self.interactive = interactive
+        self.profile = profile or StartupProfile()
+        self.latency = LatencyProfile(os.environ.get('MIKU_PROFILE', '') not in ('', '0'))
+        self.history_file = os.path.expanduser("~/.miku_history")
+        self.history_index = None
+        self.history_index_thread = None
+        self.history_built = None
+        self.history_backlog = []
+        self.rc_file = os.path.expanduser("~/.mikurc")
+        self.builtins = {
+            'cd': self.builtin_cd,
+            'ls': self.builtin_ls,
+            'pwd': self.builtin_pwd,
+            'exit': self.builtin_exit,
+            'history': self.builtin_history,
+            'clear': self.builtin_clear,
+            'help': self.builtin_help,
+            'echo': self.builtin_echo,
+            'export': self.builtin_export,
+            'unset': self.builtin_unset,
+            'alias': self.builtin_alias,
+            'which': self.builtin_which,
+            'segment': self.builtin_segment,
+            'hash': self.builtin_hash,
+            'type': self.builtin_type,
+            'icon': self.builtin_icon,
+            'batch': self.builtin_batch,
+            'jobs': self.builtin_jobs,
+            'fg': self.builtin_fg,
+            'bg': self.builtin_bg,
+            'wait': self.builtin_wait,
+            'kill': self.builtin_kill,
+            'parallel': self.builtin_parallel,
+            'prompt': self.builtin_prompt,
+            'complete': self.builtin_complete,
+            'time': self.builtin_time,
+            'stats': self.builtin_stats,
+            'profile': self.builtin_profile,
+            'enable': self.builtin_enable,
+        }
+        # In-process coreutils; `enable -n NAME` hands NAME back to the real binary
+        self.coreutils = CoreUtils()
+        self.coreutils.interactive = interactive
+        self.builtins.update(self.coreutils.commands())
+        self.disabled_builtins = {}
+        self.aliases = {}
+        self.last_exit_code = 0
+        self.pipeline_status = []
+        self.list_depth = 0  # Inside a ; && || list, whose steps get no status line of their own
+        self.command_stats = CommandStatsTable()
+        self.last_stats = None
+        self.jobs = JobTable(on_done=self.account_job)
+        self.job_control = False
+        self.shell_pgid = None
+        self.tty_fd = None
+        self.tty_modes = None
+        self.sigchld_pending = False
+        self.exit_warned = False
+        self.git_resolver = GitHeadResolver()
+        self.icon_index = IconIndex(FileIcons.ICONS)
+        self.globber = GlobExpander()
+        # Shell variables stay out of the environment children get, until exported
+        self.variables = {}
+        self.positional = []
+        self.script_name = 'mikush'
+        self.shell_pid = os.getpid()
+        self.last_background_pid = None
+        self.expander = ParameterExpander(self.lookup_variable, self.set_variable, self.substitute)
+        self.captured = collections.deque()  # (command, output, status) run ahead of the expander
+        self.capture_status = None
+        self.arg_globs = None  # see call_builtin()
+        self.command_hash = CommandHash()
+        self.at_prompt = False
+        self.prompt_stale = False
+        self.prefill = None
+        self.setup_segments()
+        self.set_prompt_template(PromptTemplate.DEFAULT)
+        # Probed lazily on the first command-not-found
+        self.thefuck_available = None
+        # External commands start through os.posix_spawn where there is one
+        self.use_posix_spawn = hasattr(os, 'posix_spawn')
+        self.spawn_env = None  # see spawn_environ()
+        self.profile.mark('init')
+        
+        self.history = HistoryStore(self.history_file)
+        self.history_thread = None
+        self.setup_completion()
+        if not interactive:
+            return
+        
+        # Kick off the first prompt's segments and the history load so they
+        # overlap with running the rc file
+        self.segments.prefetch(os.getcwd())
+        self.setup_history()
+        self.setup_signals()
+        self.profile.mark('history/signals')
+        self.load_rc_file()
+        self.profile.mark('rc file')
+
+    def setup_history(self):
+        """Setup readline history, loading the tail of the history file in the background"""
+        def load():
+            try:
+                records = self.history.load_tail()
+            except OSError:
+                return
+            for record in records:
+                readline.add_history(record.command)
+        
+        self.history_thread = threading.Thread(target=load, name='miku-history', daemon=True)
+        self.history_thread.start()
+        
+        # Set history length
+        readline.set_history_length(1000)
+        
+        # Ctrl-R: mark the current line and accept it, show_prompt takes it from there
+        readline.parse_and_bind(r'"\C-r": "\C-a\C-v\C-r\C-j"')
+
+    def setup_completion(self):
+        """Set up the completion engine with argument completers for the builtins; hook it into readline when interactive"""
+        self.parser = CommandParser()
+        self.completer = Completer(self.command_hash, lambda: itertools.chain(self.builtins, self.aliases),
+                                   lambda: self.variables)
+        completer = self.completer
+        
+        def directories(text, args):
+            return completer.complete_path(text, only_dirs=True)
+        
+        def command_then_paths(text, args):
+            return completer.complete_path(text) if args else completer.complete_command(text)
+        
+        def variables(text, args):
+            return completer.complete_variable(text)
+        
+        def job_specs(text, args):
+            return [spec for spec in (f"%{job.id}" for job in self.jobs.jobs.values()) if spec.startswith(text)]
+        
+        completer.register('cd', directories)
+        for name in ('which', 'type', 'hash', 'sudo', 'time', 'nohup', 'exec', 'batch', 'parallel'):
+            completer.register(name, command_then_paths)
+        for name in ('export', 'unset'):
+            completer.register(name, variables)
+        for name in ('fg', 'bg', 'wait', 'kill'):
+            completer.register(name, job_specs)
+        
+        if not self.interactive:
+            return
+        readline.set_completer(completer.complete)
+        readline.set_completer_delims(Completer.BREAK_CHARS)
+        if 'libedit' in (readline.__doc__ or ''):
+            readline.parse_and_bind('bind ^I rl_complete')
+        else:
+            readline.parse_and_bind('tab: complete')
+
+    def wait_for_history(self):
+        """Block until the background history load is done"""
+        if self.history_thread is not None:
+            self.history_thread.join()
+            self.history_thread = None
+
+    def merge_history(self):
+        """Pull in commands other sessions ran since the last prompt, and feed the search index"""
+        for record in self.history.read_new():
+            if record.session != self.history.session:
+                readline.add_history(record.command)
+            if self.history_index is not None:
+                self.history_index.add(record)
+            elif self.history_index_thread is not None:
+                # The index build only covers what was read before it started
+                self.history_backlog.append(record)
+
+    def start_history_index(self):
+        """Build the search index over the whole history file in the background"""
+        if self.history_index is not None or self.history_index_thread is not None:
+            return
+        self.wait_for_history()
+        records = self.history.load_all()
+        
+        def build():
+            index = HistoryIndex()
+            try:
+                for record in records:
+                    index.add(record)
+            except OSError:
+                pass
+            self.history_built = index
+        
+        self.history_index_thread = threading.Thread(target=build, name='miku-history-index', daemon=True)
+        self.history_index_thread.start()
+
+    def get_history_index(self):
+        """The search index, waiting for the background build if it's still going"""
+        if self.history_index is None:
+            self.start_history_index()
+            self.history_index_thread.join()
+            index = self.history_built
+            for record in self.history_backlog:
+                index.add(record)
+            self.history_backlog = []
+            self.history_index = index
+            self.history_built = None
+        return self.history_index
+
+    def record_history(self, command, cwd, started):
+        """Append a finished command to the history file"""
+        self.history.append(command, cwd, time.monotonic() - started, self.last_exit_code)
+
+    def setup_segments(self):
+        """Register the builtin prompt segments"""
+        self.segments = PromptSegmentManager()
+        self.segments.register(PromptSegment(
+            'git', self.get_git_branch,
+            color=Colors.YELLOW, fmt=f' ({FileIcons.GIT} - {{value}})'))
+        self.segments.register(PromptSegment(
+            'venv', lambda cwd: os.path.basename(self.get_venv() or ''),
+            color=Colors.MAGENTA, fmt=f' [{FileIcons.PYTHON} - {{value}}]', per_cwd=False))
+        self.segments.on_update = self.prompt_changed
+
+    def command_segment(self, argv):
+        """Provider that runs argv in the segment's cwd and returns its first line of output"""
+        def provider(cwd):
+            result = subprocess.run(argv, cwd=cwd, capture_output=True, text=True,
+                                    stdin=subprocess.DEVNULL)
+            if result.returncode != 0:
+                return None
+            return result.stdout.strip().split('\n', 1)[0]
+        return provider
+
+    def setup_signals(self):
+        """Handle Ctrl+C gracefully"""
+        def signal_handler(sig, frame):
+            print(f"\n{Colors.YELLOW}B-baka! Don't interrupt me like that! >_<{Colors.RESET}")
+            # Unwind to whatever was running (a builtin, or the prompt's
+            # input()); the main loop then starts a fresh prompt
+            raise KeyboardInterrupt
+        
+        signal.signal(signal.SIGINT, signal_handler)
+        
+        # Finished background jobs are collected before the next prompt
+        def sigchld_handler(sig, frame):
+            self.sigchld_pending = True
+        
+        signal.signal(signal.SIGCHLD, sigchld_handler)
+        
+        # A late prompt segment value; see prompt_changed()
+        signal.signal(signal.SIGUSR1, lambda sig, frame: self.redraw_prompt())
+        
+        # Ctrl+Z at the prompt must not stop the shell itself. A handler
+        # (unlike SIG_IGN) is reset to the default in exec'd children.
+        signal.signal(signal.SIGTSTP, lambda sig, frame: None)
+
+    def setup_job_control(self):
+        """Put the shell in its own process group and take the terminal"""
+        if not sys.stdin.isatty():
+            return
+        fd = sys.stdin.fileno()
+        try:
+            # Wait until we've been put in the foreground
+            while os.tcgetpgrp(fd) != os.getpgrp():
+                os.kill(-os.getpgrp(), signal.SIGTTIN)
+            try:
+                os.setpgid(0, 0)
+            except PermissionError:
+                pass  # Already a session leader
+            self.shell_pgid = os.getpgrp()
+            self.tty_fd = fd
+            self.give_terminal(self.shell_pgid)
+            self.tty_modes = termios.tcgetattr(fd)
+            self.job_control = True
+        except OSError:
+            self.job_control = False
+
+    def give_terminal(self, pgid):
+        """Make pgid the terminal's foreground process group"""
+        if not self.job_control and self.tty_fd is None:
+            return
+        # A background process group may only do this with SIGTTOU blocked
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+        try:
+            os.tcsetpgrp(self.tty_fd, pgid)
+        except OSError:
+            pass
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+    def wait_for_job(self, job):
+        """Wait for a foreground job with the terminal handed to it; returns its exit code"""
+        if self.job_control and job.pgid is not None:
+            self.give_terminal(job.pgid)
+        try:
+            job.wait()
+        finally:
+            if self.job_control:
+                self.take_terminal()
+        
+        if job.is_stopped():
+            self.jobs.add(job)
+            print(f"\n{Colors.YELLOW}[{job.id}]{self.jobs.marker(job)}  Stopped    {job.command}{Colors.RESET}")
+            return 128 + signal.SIGTSTP
+        self.jobs.remove(job)
+        self.account_job(job)
+        return job.processes[-1].status
+
+    def take_terminal(self):
+        """Back to the shell after a foreground job, with the terminal modes it left us in undone"""
+        self.give_terminal(self.shell_pgid)
+        try:
+            termios.tcsetattr(self.tty_fd, termios.TCSADRAIN, self.tty_modes)
+        except OSError:
+            pass
+
+    def account_job(self, job):
+        """Add a finished job's processes to the per-command totals, once"""
+        if job.accounted or not job.is_done():
+            return
+        job.accounted = True
+        self.command_stats.add_job(job)
+
+    def set_last_stats(self, stats):
+        """Remember a foreground command's resource usage; returns the note for its status line"""
+        if stats is None:
+            return ''
+        self.last_stats = stats
+        self.setenv('MIKU_LAST_STATS', stats.env_value())
+        # MIKU_SHOW_STATS=N shows them for commands that ran N seconds or more
+        threshold = os.environ.get('MIKU_SHOW_STATS')
+        try:
+            if threshold is None or stats.wall < float(threshold):
+                return ''
+        except ValueError:
+            return ''
+        return f" {Colors.DIM}({stats.format()}){Colors.RESET}"
+
+    def start_background(self, job):
+        self.jobs.add(job)
+        pid = job.pgid if job.pgid is not None else job.processes[-1].pid
+        self.last_background_pid = job.processes[-1].pid
+        print(f"{Colors.CYAN}[{job.id}] {pid}{Colors.RESET}")
+
+    def notify_jobs(self):
+        """Report background jobs that finished or stopped since the last prompt"""
+        if not self.sigchld_pending:
+            return
+        self.sigchld_pending = False
+        self.jobs.poll()
+        for job in sorted(self.jobs.jobs.values(), key=lambda j: j.id):
+            if job.is_done():
+                color = Colors.GREEN if job.processes[-1].status == 0 else Colors.RED
+                print(f"{color}[{job.id}]{self.jobs.marker(job)}  {job.state():<10} {job.command}{Colors.RESET}")
+                self.jobs.remove(job)
+
+    def rc_cache_path(self):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        return os.path.join(cache_home, 'mikush', 'mikurc.cache')
+
+    def parse_rc_file(self):
+        """The rc file as (line, parsed node or None) pairs, from the marshal cache when it's still fresh"""
+        st = os.stat(self.rc_file)
+        key = (CommandParser.VERSION, os.path.abspath(self.rc_file), st.st_mtime_ns, st.st_size)
+        cache_path = self.rc_cache_path()
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_key, entries = marshal.loads(f.read())
+            if tuple(cached_key) == key:
+                return [(line, self.parser.load(node) if node is not None else None) for line, node in entries]
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        
+        entries = []
+        with open(self.rc_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    node = self.parser.parse(line)
+                except ShellSyntaxError:
+                    node = None  # Re-parsed when run so the error shows up where it belongs
+                entries.append((line, node))
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = f"{cache_path}.{os.getpid()}"
+            with open(tmp, 'wb') as f:
+                marshal.dump((key, [(line, self.parser.dump(node) if node is not None else None)
+                                    for line, node in entries]), f)
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass
+        return entries
+
+    def load_rc_file(self):
+        """Load .mikurc file if it exists"""
+        if os.path.exists(self.rc_file):
+            try:
+                for line, node in self.parse_rc_file():
+                    if node is None:
+                        self.execute_command(line, suppress_output=True)
+                    else:
+                        self.execute_parsed(node, line, suppress_output=True)
+            except Exception as e:
+                print(f"{Colors.RED}Hmph! Couldn't load .mikurc: {e} >_<{Colors.RESET}")
+
+    def run_script(self, lines):
+        """Run commands line by line without prompts or status lines; returns the last exit code"""
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                self.execute_command(line)
+            except ValueError as e:
+                # A builtin's own argument parsing gave up (time's shlex.join and such)
+                print(f"{Colors.RED}Baka! I can't parse that: {e} >_<{Colors.RESET}", file=sys.stderr)
+                self.last_exit_code = 2
+        return self.last_exit_code
+
+    def check_thefuck(self):
+        """Check if thefuck is installed (a PATH lookup, no need to run it)"""
+        return self.command_hash.lookup('thefuck') is not None
+
+    def get_git_branch(self, cwd=None):
+        """Get current git branch if in a git repo"""
+        try:
+            return self.git_resolver.get_branch(cwd or os.getcwd())
+        except OSError:
+            return None
+
+    def get_venv(self):
+        """Check if we're in a virtual environment"""
+        return os.environ.get('VIRTUAL_ENV')
+
+    def get_current_path_display(self, current_path=None):
+        """Get current path with proper home substitution"""
+        current_path = current_path or os.getcwd()
+        home_path = os.path.expanduser("~")
+        
+        if current_path == home_path or current_path.startswith(home_path.rstrip('/') + '/'):
+            return "~" + current_path[len(home_path.rstrip('/')):]
+        return current_path
+
+    def set_prompt_template(self, source):
+        """Compile a prompt template; values fixed for the whole session are baked in here"""
+        hostname = os.uname().nodename
+        static_values = {
+            'u': os.environ.get('USER', 'unknown'),
+            'h': hostname.split('.', 1)[0],
+            'H': hostname,
+            '$': '#' if os.geteuid() == 0 else '$',
+            'n': '\n',
+            'e': '\033',
+            '\\': '\\',
+        }
+        self.prompt_template = PromptTemplate(source, static_values)
+
+    def render_prompt_part(self, key, value):
+        """Render one dynamic prompt part from its input"""
+        if key == 'cwd':
+            return self.get_current_path_display(value)
+        if key == 'cwd_base':
+            display = self.get_current_path_display(value)
+            return display if display in ('/', '~') else os.path.basename(display)
+        if key == 'time':
+            return time.strftime("%H:%M:%S", time.localtime(value))
+        if key == 'date':
+            return time.strftime("%Y-%m-%d", time.localtime(value))
+        if key == 'segments':
+            return self.segments.render(value)
+        return str(value)
+
+    def render_prompt(self, cwd, segment_values):
+        now = int(time.time())
+        inputs = {
+            'cwd': cwd,
+            'cwd_base': cwd,
+            'time': now,
+            'date': now,
+            'status': self.last_exit_code,
+            'jobs': len(self.jobs.jobs),
+            'segments': segment_values,
+        }
+        return self.prompt_template.render(inputs, self.render_prompt_part)
+
+    def prompt_changed(self):
+        """Segment worker callback: mark the prompt stale and wake the main thread.
+
+        Only the main thread may touch the terminal while readline owns it.
+        Python runs signal handlers there, and readline's wait for a key is
+        interrupted by the signal, so SIGUSR1 gets redraw_prompt() run between
+        keystrokes. Until the prompt is up, the pre-input hook picks it up.
+        """
+        self.prompt_stale = True
+        if self.at_prompt:
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+
+    def redraw_prompt(self):
+        """Repaint the prompt lines above the input line when a late segment value arrives"""
+        if not (self.at_prompt and self.prompt_stale):
+            return
+        self.prompt_stale = False
+        cwd = os.getcwd()
+        values = self.segments.collect_cached(cwd)
+        if values == self.segment_values:
+            return
+        self.segment_values = values
+        # readline owns the input line; only the lines above it can be repainted
+        lines = self.render_prompt(cwd, values).split('\n')[:-1]
+        if not lines:
+            return
+        # Save cursor, go up to the first line, rewrite each one, restore cursor
+        out = [f"\0337\033[{len(lines)}A\r"]
+        for line in lines:
+            out.append(f"\033[2K{line}\r\033[1B")
+        out.append("\0338")
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+        readline.redisplay()
+
+    def get_prompt(self):
+        """Generate the tsundere prompt"""
+        cwd = os.getcwd()
+        if 'segments' in self.prompt_template.uses:
+            self.segment_values = self.segments.collect(cwd)
+        else:
+            self.segment_values = {}
+        return self.render_prompt(cwd, self.segment_values)
+
+    def show_prompt(self):
+        """Display prompt and wait for input"""
+        try:
+            self.notify_jobs()
+            started = self.latency.start()
+            prompt = self.get_prompt()
+            self.latency.stop('prompt', started)
+            self.wait_for_history()
+            self.merge_history()
+            self.profile.mark('first prompt')
+            self.profile.report()
+            self.start_history_index()
+            while True:
+                readline.set_pre_input_hook(self.pre_input)
+                try:
+                    command = input(prompt)
+                finally:
+                    self.at_prompt = False
+                if not command.startswith(self.HISTORY_SEARCH_KEY):
+                    return command
+                # Ctrl-R; drop the marked line from readline's history and
+                # come back with the picked command already typed in
+                readline.remove_history_item(readline.get_current_history_length() - 1)
+                text = self.interactive_history_search(command[1:])
+                sys.stdout.write(f"\033[{prompt.count(chr(10)) + 1}A\r\033[J")
+                sys.stdout.flush()
+                self.prefill_input(text)
+        except EOFError:
+            print(f"\n{Colors.YELLOW}S-see you later... baka! ^-^{Colors.RESET}")
+            sys.exit(0)
+
+    def prefill_input(self, text):
+        """Start the next input() with text already on the line"""
+        self.prefill = text
+
+    def pre_input(self):
+        """readline pre-input hook: the prompt is on screen now"""
+        self.at_prompt = True
+        if self.prefill is not None:
+            readline.insert_text(self.prefill)
+            readline.redisplay()
+            self.prefill = None
+        self.redraw_prompt()
+
+    def interactive_history_search(self, query):
+        """Ctrl-R search screen; returns the picked command, or query when cancelled.
+
+        Typing narrows the results, Up/Down or Ctrl-R/Ctrl-S move the
+        selection, Tab toggles only showing commands run in this directory,
+        Enter picks and Esc/Ctrl-G/Ctrl-C cancel.
+        """
+        index = self.get_history_index()
+        original = query
+        cwd = os.getcwd()
+        here = False
+        selected = 0
+        try:
+            size = os.get_terminal_size()
+            rows, width = max(1, min(10, size.lines - 4)), size.columns
+        except OSError:
+            rows, width = 10, 80
+        fd = sys.stdin.fileno()
+        old = termios.tcgetattr(fd)
+        chosen = None
+        try:
+            tty.setcbreak(fd)
+            while True:
+                results = index.search(query, rows, cwd=cwd if here else None)
+                selected = max(0, min(selected, len(results) - 1))
+                label = '(miku-search here)' if here else '(miku-search)'
+                lines = [f"{Colors.PINK}{label}{Colors.RESET} {query}"]
+                for i, (score, entry) in enumerate(results):
+                    text = index.commands[entry][:max(10, width - 4)]
+                    if i == selected:
+                        lines.append(f"{Colors.CYAN}> {Colors.BOLD}{text}{Colors.RESET}")
+                    else:
+                        lines.append(f"  {Colors.DIM}{text}{Colors.RESET}")
+                out = '\r\033[J' + '\n'.join(lines)
+                if results:
+                    out += f"\033[{len(results)}A"
+                out += f"\r\033[{len(label) + 1 + len(query)}C"
+                sys.stdout.write(out)
+                sys.stdout.flush()
+                
+                key = os.read(fd, 32)
+                if key in (b'\r', b'\n'):
+                    chosen = index.commands[results[selected][1]] if results else query
+                    break
+                elif key in (b'\x1b', b'\x07', b'\x03', b'\x04'):
+                    break
+                elif key in (b'\x1b[A', b'\x1bOA', b'\x13'):
+                    selected -= 1
+                elif key in (b'\x1b[B', b'\x1bOB', b'\x12'):
+                    selected += 1
+                elif key == b'\t':
+                    here = not here
+                    selected = 0
+                elif key in (b'\x7f', b'\x08'):
+                    query = query[:-1]
+                    selected = 0
+                elif key == b'\x15':
+                    query = ''
+                    selected = 0
+                elif not key.startswith(b'\x1b') and key >= b' ':
+                    query += key.decode('utf-8', 'ignore')
+                    selected = 0
+        except KeyboardInterrupt:
+            pass
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, old)
+            sys.stdout.write('\r\033[J')
+            sys.stdout.flush()
+        return original if chosen is None else chosen
+
+    def get_file_icon(self, filename, is_dir=False):
+        """Get appropriate nerd font icon for file"""
+        if is_dir:
+            return FileIcons.FOLDER
+        return self.icon_index.lookup(filename)[0]
+
+    def redirections(self, node):
+        """(stdin, stdout, stderr, append) targets of a SimpleCommand; stderr is STDERR_TO_STDOUT for 2>&1"""
+        stdin_file = None
+        stdout_file = None
+        stderr_file = None
+        append_mode = False
+        for op, target in node.redirects:
+            if op == '<':
+                stdin_file = self.expand_word(target)
+            elif op == '>' or op == '>>':
+                stdout_file = self.expand_word(target)
+                append_mode = op == '>>'
+            elif op == '2>':
+                stderr_file = self.expand_word(target)
+            elif op == '2>&1':
+                stderr_file = STDERR_TO_STDOUT
+        return stdin_file, stdout_file, stderr_file, append_mode
+
+    def open_redirections(self, stdin_file, stdout_file, stderr_file, append_mode):
+        """Open redirection targets, returning (stdin, stdout, stderr) files or None on error"""
+        files = [None, None, None]
+        try:
+            if stdin_file:
+                files[0] = open(stdin_file, 'r')
+            if stdout_file:
+                files[1] = open(stdout_file, 'a' if append_mode else 'w')
+            if stderr_file and stderr_file != STDERR_TO_STDOUT:
+                files[2] = open(stderr_file, 'w')
+        except FileNotFoundError:
+            print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.FILE_NOT_FOUND)}{Colors.RESET}")
+            self.close_redirections(files)
+            return None
+        except PermissionError:
+            print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.PERMISSION_DENIED)}{Colors.RESET}")
+            self.close_redirections(files)
+            return None
+        return tuple(files)
+
+    def redirect_fds(self, stdin_file, stdout_file, stderr_file, append_mode):
+        """Point fds 0-2 at an in-process builtin's redirection targets.
+
+        Returns the saved originals for restore_fds(), or None (after
+        complaining) if a target couldn't be opened.
+        """
+        saved = []
+        if not (stdin_file or stdout_file or stderr_file):
+            return saved
+        sys.stdout.flush()
+        targets = [(0, stdin_file, os.O_RDONLY)]
+        if stdout_file:
+            targets.append((1, stdout_file, os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append_mode else os.O_TRUNC)))
+        if stderr_file and stderr_file != STDERR_TO_STDOUT:
+            targets.append((2, stderr_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC))
+        try:
+            for target, path, flags in targets:
+                if not path:
+                    continue
+                fd = os.open(path, flags, 0o666)
+                saved.append((target, os.dup(target)))
+                os.dup2(fd, target)
+                os.close(fd)
+            if stderr_file == STDERR_TO_STDOUT:
+                saved.append((2, os.dup(2)))
+                os.dup2(1, 2)
+        except OSError as e:
+            self.restore_fds(saved)
+            if isinstance(e, FileNotFoundError):
+                print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.FILE_NOT_FOUND)}{Colors.RESET}")
+            elif isinstance(e, PermissionError):
+                print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.PERMISSION_DENIED)}{Colors.RESET}")
+            else:
+                raise
+            return None
+        return saved
+
+    def restore_fds(self, saved):
+        if saved:
+            sys.stdout.flush()
+        for target, fd in reversed(saved):
+            os.dup2(fd, target)
+            os.close(fd)
+
+    def close_redirections(self, files):
+        for f in files:
+            if f:
+                f.close()
+
+    def expand_globs(self, args, globs=None):
+        """Expand braces and glob patterns (including **) in arguments, except where globs says they were quoted"""
+        return self.globber.expand(args, globs)
+
+    def call_builtin(self, cmd, args, globs=None):
+        """Run builtin cmd on args[1:]. Builtins that expand patterns themselves (batch,
+        parallel) find out from arg_patterns() which of their arguments were quoted."""
+        self.arg_globs = None if globs is None else globs[1:]
+        return self.builtins[cmd](args[1:])
+
+    def arg_patterns(self, args):
+        """For args, a tail of the running builtin's arguments, whether each may be expanded"""
+        globs = self.arg_globs
+        return None if globs is None else globs[len(globs) - len(args):]
+
+    def resolve_command(self, args):
+        """Resolve argv[0] through the hash table, raising FileNotFoundError if it's unknown"""
+        path = self.command_hash.lookup(args[0])
+        if path is None:
+            raise FileNotFoundError(args[0])
+        return path
+
+    def spawn(self, args, pgid=None, **kwargs):
+        """Start an external command from the hash table, re-searching once if a hashed path went stale.
+
+        With job control the child joins process group pgid (or leads a new one).
+        """
+        if self.job_control:
+            if sys.version_info >= (3, 11):
+                kwargs['process_group'] = pgid or 0
+            else:
+                kwargs['preexec_fn'] = lambda: os.setpgid(0, pgid or 0)
+        # Anything we printed has to come out before the child's output
+        sys.stdout.flush()
+        try:
+            proc = subprocess.Popen(args, executable=self.resolve_command(args), **kwargs)
+        except FileNotFoundError:
+            if '/' in args[0] or args[0] not in self.command_hash.table:
+                raise
+            self.command_hash.forget(args[0])
+            proc = subprocess.Popen(args, executable=self.resolve_command(args), **kwargs)
+        if self.job_control:
+            self.join_group(proc.pid, pgid)
+        return proc
+
+    # Python starts up ignoring these; exec'd children must get the defaults back
+    SPAWN_SIGDEF = tuple(getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name))
+
+    def posix_spawn(self, args, file_actions=(), pgid=None):
+        """Start an external command with os.posix_spawn (vfork + exec on glibc); returns its pid.
+
+        Like spawn(), a hashed path that went stale is searched for again once.
+        """
+        kwargs = {'file_actions': file_actions, 'setsigdef': self.SPAWN_SIGDEF}
+        if self.job_control:
+            kwargs['setpgroup'] = pgid or 0
+        sys.stdout.flush()
+        path = self.resolve_command(args)
+        try:
+            pid = os.posix_spawn(path, args, self.spawn_environ(), **kwargs)
+        except FileNotFoundError:
+            if '/' in args[0] or args[0] not in self.command_hash.table or os.path.exists(path):
+                raise
+            self.command_hash.forget(args[0])
+            pid = os.posix_spawn(self.resolve_command(args), args, self.spawn_environ(), **kwargs)
+        if self.job_control:
+            self.join_group(pid, pgid)
+        return pid
+
+    def spawn_environ(self):
+        """os.environ as a plain dict: posix_spawn converts that in C, but os.environ key by key in Python.
+
+        The shell changes its environment through setenv()/unsetenv(), which
+        keep this copy in step.
+        """
+        if self.spawn_env is None:
+            self.spawn_env = dict(os.environ)
+        return self.spawn_env
+
+    def setenv(self, key, value):
+        os.environ[key] = value
+        if self.spawn_env is not None:
+            self.spawn_env[key] = value
+
+    def unsetenv(self, key):
+        os.environ.pop(key, None)
+        if self.spawn_env is not None:
+            self.spawn_env.pop(key, None)
+
+    def redirect_actions(self, stdin_file, stdout_file, stderr_file, append_mode):
+        """posix_spawn file actions that open the redirection targets in the child"""
+        actions = []
+        if stdin_file:
+            actions.append((os.POSIX_SPAWN_OPEN, 0, stdin_file, os.O_RDONLY, 0))
+        if stdout_file:
+            flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append_mode else os.O_TRUNC)
+            actions.append((os.POSIX_SPAWN_OPEN, 1, stdout_file, flags, 0o666))
+        if stderr_file == STDERR_TO_STDOUT:
+            actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+        elif stderr_file:
+            actions.append((os.POSIX_SPAWN_OPEN, 2, stderr_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+        return actions
+
+    def launch(self, args, stdin_file=None, stdout_file=None, stderr_file=None, append_mode=False, pgid=None):
+        """Start a foreground command with its redirections; returns its JobProcess, or None if a redirection failed.
+
+        With job control it joins process group pgid, or leads a new one.
+
+        posix_spawn opens the redirection targets itself, as file actions. If
+        it fails while there are any, the error could be about the command or
+        about a file, so the Popen path below runs instead and reports which.
+        It's also the fallback where there's no posix_spawn at all.
+        """
+        if self.use_posix_spawn:
+            actions = self.redirect_actions(stdin_file, stdout_file, stderr_file, append_mode)
+            try:
+                return JobProcess(args[0], self.posix_spawn(args, actions, pgid))
+            except OSError:
+                if not actions:
+                    raise
+        
+        files = self.open_redirections(stdin_file, stdout_file, stderr_file, append_mode)
+        if files is None:
+            return None
+        stdin_fd, stdout_fd, stderr_fd = files
+        if stderr_file == STDERR_TO_STDOUT:
+            stderr_fd = STDERR_TO_STDOUT
+        try:
+            proc = self.spawn(args, pgid, stdin=stdin_fd, stdout=stdout_fd, stderr=stderr_fd)
+        finally:
+            self.close_redirections(files)
+        return JobProcess(args[0], proc.pid, proc)
+
+    def join_group(self, pid, pgid):
+        """Parent-side setpgid, so the group exists before the terminal is handed over"""
+        try:
+            os.setpgid(pid, pgid or pid)
+        except OSError:
+            pass  # Child already exec'd or exited; it set its own group
+
+    def fork_child(self, name, run, stdin_fd, stdout_fd, stderr_fd, pgid=None):
+        """Call run() in a forked child (a builtin or subshell as pipeline stage or background job),
+        streaming straight into the pipe; its return value is the exit code"""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            if self.job_control:
+                self.join_group(pid, pgid)
+            return pid
+        
+        code = 0
+        try:
+            if self.job_control:
+                os.setpgid(0, pgid or 0)
+            for sig in (signal.SIGINT, signal.SIGPIPE, signal.SIGTSTP, signal.SIGCHLD):
+                signal.signal(sig, signal.SIG_DFL)
+            for fd, target in ((stdin_fd, 0), (stdout_fd, 1), (stderr_fd, 2)):
+                if fd is not None and fd != target:
+                    os.dup2(fd, target)
+            os.closerange(3, os.sysconf('SC_OPEN_MAX') if hasattr(os, 'sysconf') else 256)
+            result = run()
+            code = result if isinstance(result, int) else 0
+        except NeedsExternal as e:
+            os.write(2, os.fsencode(f"{name}: {e}: only the real {name} does that, and there isn't one\n"))
+            code = 2
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            code = 1
+        finally:
+            try:
+                sys.stdout.flush()
+            except BaseException:
+                pass
+            os._exit(code)
+
+    def run_subshell(self, body):
+        """A subshell's body, in the forked child: no job control, prompts or status lines of its own"""
+        self.job_control = False
+        self.tty_fd = None
+        self.interactive = False
+        self.coreutils.interactive = False
+        self.run_list(body, body.source())
+        return self.last_exit_code
+
+    def run_substitution(self, body):
+        """A $(...) body in its forked child. Nothing could resume it if Ctrl+Z stopped it, so Ctrl+Z doesn't"""
+        signal.signal(signal.SIGTSTP, signal.SIG_IGN)
+        return self.run_subshell(body)
+
+    def execute_pipeline(self, pipeline, suppress_output=False, command=None):
+        """Run every stage concurrently, connected by kernel pipes, as one job"""
+        background = pipeline.background
+        started = self.latency.start()
+        parsed = [(self.argv(node) if type(node) is SimpleCommand else (node, None)) + self.redirections(node)
+                  for node in pipeline.commands]
+        self.latency.stop('redirect', started)
+        
+        processes = []
+        pgid = None
+        open_files = []
+        prev_read = None
+        try:
+            for i, (clean_args, globs, stdin_file, stdout_file, stderr_file, append_mode) in enumerate(parsed):
+                if not clean_args:
+                    print(f"{Colors.RED}Baka! There's an empty command in your pipeline! >_<{Colors.RESET}")
+                    processes.append(JobProcess('', status=2))
+                    continue
+                
+                files = self.open_redirections(stdin_file, stdout_file, stderr_file, append_mode)
+                if files is None:
+                    files = (None, None, None)
+                    failed = True
+                else:
+                    failed = False
+                    open_files.extend(f for f in files if f)
+                
+                stdin_fd = files[0].fileno() if files[0] else prev_read
+                if stdin_fd is None and background and not self.job_control:
+                    # Without job control nothing stops a background job reading the terminal
+                    devnull = open(os.devnull, 'r')
+                    open_files.append(devnull)
+                    stdin_fd = devnull.fileno()
+                if i < len(parsed) - 1:
+                    next_read, write_end = os.pipe()
+                else:
+                    next_read, write_end = None, None
+                stdout_fd = files[1].fileno() if files[1] else write_end
+                stderr_fd = files[2].fileno() if files[2] else None
+                if stderr_file == STDERR_TO_STDOUT:
+                    stderr_fd = stdout_fd if stdout_fd is not None else 1
+                
+                subshell = type(clean_args) is Subshell
+                cmd = '(' if subshell else clean_args[0]
+                if failed:
+                    processes.append(JobProcess(cmd, status=1))
+                elif subshell:
+                    started = self.latency.start()
+                    pid = self.fork_child(cmd, lambda: self.run_subshell(clean_args.body),
+                                          stdin_fd, stdout_fd, stderr_fd, pgid)
+                    self.latency.stop('spawn', started)
+                    processes.append(JobProcess(cmd, pid))
+                elif cmd in self.builtins and not (cmd in CoreUtils.NAMES and self.command_hash.lookup(cmd)):
+                    # (Forking the whole shell for a coreutil costs more than spawning the real one)
+                    started = self.latency.start()
+                    args = self.expand_globs(clean_args, globs) if cmd in CoreUtils.NAMES else clean_args
+                    pid = self.fork_child(cmd, lambda: self.call_builtin(cmd, args, None if cmd in CoreUtils.NAMES else globs),
+                                          stdin_fd, stdout_fd, stderr_fd, pgid)
+                    self.latency.stop('spawn', started)
+                    processes.append(JobProcess(cmd, pid))
+                else:
+                    try:
+                        started = self.latency.start()
+                        argv = self.expand_globs(clean_args, globs)
+                        self.latency.stop('expand', started)
+                        started = self.latency.start()
+                        if self.use_posix_spawn:
+                            actions = [(os.POSIX_SPAWN_DUP2, fd, target)
+                                       for fd, target in ((stdin_fd, 0), (stdout_fd, 1), (stderr_fd, 2))
+                                       if fd is not None and fd != target]
+                            process = JobProcess(cmd, self.posix_spawn(argv, actions, pgid))
+                        else:
+                            proc = self.spawn(argv, pgid, stdin=stdin_fd, stdout=stdout_fd, stderr=stderr_fd)
+                            process = JobProcess(cmd, proc.pid, proc)
+                        self.latency.stop('spawn', started)
+                        processes.append(process)
+                    except FileNotFoundError:
+                        print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.COMMAND_NOT_FOUND, cmd)}{Colors.RESET}")
+                        processes.append(JobProcess(cmd, status=127))
+                    except PermissionError:
+                        print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.PERMISSION_DENIED)}{Colors.RESET}")
+                        processes.append(JobProcess(cmd, status=126))
+                if self.job_control and pgid is None and processes[-1].pid is not None:
+                    pgid = processes[-1].pid
+                
+                # The children own these ends now
+                if prev_read is not None:
+                    os.close(prev_read)
+                if write_end is not None:
+                    os.close(write_end)
+                prev_read = next_read
+        finally:
+            if prev_read is not None:
+                os.close(prev_read)
+            self.close_redirections(open_files)
+        
+        job = ShellJob(command or pipeline.source().rstrip(' &'), processes, pgid)
+        if background and not job.is_done():
+            self.start_background(job)
+            self.last_exit_code = 0
+            return
+        started = self.latency.start()
+        stopped = self.wait_for_job(job) == 128 + signal.SIGTSTP
+        self.latency.stop('wait', started)
+        note = '' if stopped else self.set_last_stats(job.stats())
+        codes = job.codes()
+        
+        # pipefail: the rightmost failing stage decides the exit code. Upstream
+        # stages killed by SIGPIPE just had their reader exit early (`yes | head`)
+        sigpipe = 128 + signal.SIGPIPE
+        failures = [code for i, code in enumerate(codes)
+                    if code and not (code == sigpipe and i < len(codes) - 1)]
+        self.last_exit_code = 128 + signal.SIGTSTP if stopped else (failures[-1] if failures else 0)
+        self.pipeline_status = codes
+        
+        if suppress_output or stopped or not self.interactive or self.list_depth:
+            return
+        if self.last_exit_code == 0:
+            if not parsed[-1][3]:
+                print(f"{Colors.GREEN}{TsundereMessages.get_random(TsundereMessages.SUCCESS)}{Colors.RESET}{note}")
+        else:
+            status = ' | '.join(str(code) for code in codes)
+            print(f"{Colors.RED} >_< {self.last_exit_code} [{status}]{Colors.RESET}{note}")
+
+    def execute_command(self, command, suppress_output=False):
+        """Execute a command with tsundere flair"""
+        if not command.strip():
+            return
+        started = self.latency.start()
+        try:
+            self.run_command(command, suppress_output)
+        finally:
+            self.latency.stop('command', started)
+
+    def execute_parsed(self, commands, command, suppress_output=False):
+        """execute_command for a line that's already been parsed"""
+        started = self.latency.start()
+        try:
+            self.run_list(commands, command, suppress_output)
+        finally:
+            self.latency.stop('command', started)
+
+    def run_command(self, command, suppress_output=False):
+        """execute_command's body: parse (cached) and run one command line"""
+        started = self.latency.start()
+        try:
+            commands = self.parser.parse(command)
+        except ShellSyntaxError as e:
+            print(f"{Colors.RED}{e}{Colors.RESET}")
+            self.last_exit_code = 2
+            return
+        finally:
+            self.latency.stop('parse', started)
+        if commands is not None:
+            self.run_list(commands, command, suppress_output)
+
+    def run_list(self, commands, command, suppress_output=False):
+        """Run a parsed line's pipelines in order, skipping && and || steps as the last exit code says.
+        A list gets one status line at the end rather than one per step."""
+        if self.aliases:
+            started = self.latency.start()
+            try:
+                commands = self.expand_aliases(commands)
+            except ShellSyntaxError as e:
+                print(f"{Colors.RED}{e}{Colors.RESET}")
+                self.last_exit_code = 2
+                return
+            finally:
+                self.latency.stop('alias', started)
+        
+        items = commands.items
+        if len(items) == 1:
+            self.run_step(items[0][1], command, suppress_output)
+            return
+        self.list_depth += 1
+        try:
+            for op, pipeline in items:
+                if (op == '&&' and self.last_exit_code != 0) or (op == '||' and self.last_exit_code == 0):
+                    continue
+                self.run_step(pipeline, pipeline.source(), suppress_output)
+                if self.last_exit_code == 128 + signal.SIGINT:
+                    break  # Ctrl+C stops the whole line, not just the step it hit
+        finally:
+            self.list_depth -= 1
+        if suppress_output or not self.interactive or self.list_depth:
+            return
+        if self.last_exit_code == 0:
+            print(f"{Colors.GREEN}{TsundereMessages.get_random(TsundereMessages.SUCCESS)}{Colors.RESET}")
+        elif self.last_exit_code != 128 + signal.SIGTSTP:
+            print(f"{Colors.RED} >_< {self.last_exit_code}{Colors.RESET}")
+
+    def run_step(self, pipeline, command, suppress_output):
+        """run_pipeline, with a bad ${...} failing just this step"""
+        try:
+            self.run_pipeline(pipeline, command, suppress_output)
+        except ShellSyntaxError as e:
+            print(f"{Colors.RED}{e}{Colors.RESET}")
+            self.last_exit_code = 1
+
+    def argv(self, node):
+        """A SimpleCommand's (argv, globs): words with variables, command substitutions and ~ expanded
+        and split, and for each argument whether expand_globs may treat it as a pattern"""
+        expander = self.expander
+        words = [word for word in node.words if expander.needs_expansion(word)]
+        if not words:
+            return [word.text for word in node.words], [word.globbable() for word in node.words]
+        
+        # Independent command substitutions run side by side. A ${VAR=...}
+        # could change what a later one sees, so then they go one at a time
+        commands = [command for word in words for command in expander.substitutions(word)]
+        if len(commands) > 1 and not any('${' in word.text and '=' in word.text for word in words):
+            self.captured.extend((command, output, status)
+                                 for command, (output, status) in zip(commands, self.capture(commands)))
+        try:
+            args = []
+            globs = []
+            for word in node.words:
+                if expander.needs_expansion(word):
+                    for field, glob in expander.expand(word):
+                        args.append(field)
+                        globs.append(glob)
+                else:
+                    args.append(word.text)
+                    globs.append(word.globbable())
+            return args, globs
+        finally:
+            self.captured.clear()
+
+    # Largest $(...) output kept, unless MIKU_MAX_CAPTURE says otherwise (bytes, or with a K/M/G suffix)
+    CAPTURE_LIMIT = 16 << 20
+    CAPTURE_CHUNK = 64 << 10
+
+    def substitute(self, command):
+        """Output of $(command), trailing newlines removed; $? becomes its exit status"""
+        if self.captured and self.captured[0][0] == command:
+            _, output, status = self.captured.popleft()
+        else:
+            (output, status), = self.capture([command])
+        self.last_exit_code = self.capture_status = status
+        return output
+
+    def capture_limit(self):
+        value = (self.lookup_variable('MIKU_MAX_CAPTURE') or '').strip().upper()
+        scale = 1
+        if value[-1:] in ('K', 'M', 'G'):
+            scale = 1 << (10 * ('KMG'.index(value[-1]) + 1))
+            value = value[:-1]
+        return int(value) * scale if value.isdigit() else self.CAPTURE_LIMIT
 
-    def check_thefuck(self):
-        """Check if thefuck is installed"""
+    def capture(self, commands):
+        """Run each command in a subshell with stdout to a pipe, all at once; [(output, exit status)] in order.
+
+        The pipes are read in bounded chunks as output arrives, and each
+        capture stops at capture_limit() bytes: the reader closes its end
+        and the command gets SIGPIPE if it keeps writing.
+        """
+        bodies = [self.parser.parse(command) for command in commands]
+        limit = self.capture_limit()
+        children = []  # [JobProcess, read fd, output, command]
+        pgid = None
         try:
-            subprocess.run(['thefuck', '--version'], 
-                         stdout=subprocess.DEVNULL, 
-                         stderr=subprocess.DEVNULL, 
-                         check=True)
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
+            for command, body in zip(commands, bodies):
+                if body is None:
+                    children.append([None, None, bytearray(), command])
+                    continue
+                read_fd, write_fd = os.pipe()
+                try:
+                    pid = self.fork_child('$(', lambda: self.run_substitution(body), None, write_fd, None, pgid)
+                finally:
+                    os.close(write_fd)
+                children.append([JobProcess('$(', pid), read_fd, bytearray(), command])
+                if self.job_control and pgid is None:
+                    # One foreground group for them all, like a job: Ctrl+C goes to them, not to us
+                    pgid = pid
+                    self.give_terminal(pgid)
+            
+            reading = [child for child in children if child[1] is not None]
+            if len(reading) == 1:
+                while self.read_capture(reading[0], limit):
+                    pass
+            elif reading:
+                with selectors.DefaultSelector() as selector:
+                    for child in reading:
+                        selector.register(child[1], selectors.EVENT_READ, child)
+                    while selector.get_map():
+                        for key, _ in selector.select():
+                            if not self.read_capture(key.data, limit):
+                                selector.unregister(key.fd)
+                                # A full capture's writer gets SIGPIPE now, not when the rest are done
+                                os.close(key.fd)
+                                key.data[1] = None
+        except BaseException:
+            for process, _, _, _ in children:
+                if process is not None:
+                    try:
+                        os.kill(process.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+            raise
+        finally:
+            for child in children:
+                if child[1] is not None:
+                    os.close(child[1])
+                    child[1] = None
+                if child[0] is not None:
+                    _, wait_status, rusage = os.wait4(child[0].pid, 0)
+                    child[0].update(wait_status, rusage)
+            if pgid is not None:
+                self.take_terminal()
+        
+        if any(process and process.status == 128 + signal.SIGINT for process, _, _, _ in children):
+            raise KeyboardInterrupt  # Ctrl+C in a substitution drops the whole line, as in sh
+        results = []
+        for process, _, output, _ in children:
+            # Strip in place: only the newlines go, the output isn't copied
+            end = len(output)
+            while end and output[end - 1] == 10:
+                end -= 1
+            del output[end:]
+            if 0 in output:
+                output = output.replace(b'\0', b'')  # No argument can hold a NUL
+            results.append((output.decode(sys.getfilesystemencoding(), 'surrogateescape'),
+                            process.status if process is not None else 0))
+        return results
+
+    def read_capture(self, child, limit):
+        """One bounded read into a capture; False once it's finished (EOF or full)"""
+        _, fd, output, command = child
+        chunk = os.read(fd, min(self.CAPTURE_CHUNK, limit - len(output) + 1))
+        if not chunk:
             return False
+        output += chunk
+        if len(output) <= limit:
+            return True
+        del output[limit:]
+        sys.stdout.flush()
+        print(f"{Colors.YELLOW}Hmph! $({command}) said more than {limit} bytes, I only kept that much. "
+              f"Raise MIKU_MAX_CAPTURE if you really need it >_<{Colors.RESET}", file=sys.stderr)
+        return False
 
-    def get_git_branch(self):
-        """Get current git branch if in a git repo"""
-        try:
-            result = subprocess.run(['git', 'branch', '--show-current'], 
-                                  capture_output=True, text=True, 
-                                  stderr=subprocess.DEVNULL)
-            if result.returncode == 0 and result.stdout.strip():
-                return result.stdout.strip()
-        except FileNotFoundError:
-            pass
-        return None
+    def expand_word(self, word):
+        """One word expanded without splitting, as for a redirection target"""
+        return self.expander.expand(word, split=False) if self.expander.needs_expansion(word) else word.text
 
-    def get_venv(self):
-        """Check if we're in a virtual environment"""
-        return os.environ.get('VIRTUAL_ENV')
+    def lookup_variable(self, name):
+        """A shell or environment variable, or a special parameter ($?, $$, $#, $@, $1...); None if unset"""
+        value = self.variables.get(name)
+        if value is None:
+            value = os.environ.get(name)
+        if value is not None or name[0] in ParameterExpander.NAME_START:
+            return value
+        if name == '?':
+            return str(self.last_exit_code)
+        if name == '$':
+            return str(self.shell_pid)
+        if name == '#':
+            return str(len(self.positional))
+        if name in ('@', '*'):
+            return self.positional
+        if name == '!':
+            return str(self.last_background_pid) if self.last_background_pid else None
+        if name == '-':
+            return 'i' if self.interactive else ''
+        if name == '0':
+            return self.script_name
+        n = int(name)
+        return self.positional[n - 1] if n <= len(self.positional) else None
 
-    def get_current_path_display(self):
-        """Get current path with proper home substitution"""
-        current_path = os.getcwd()
-        home_path = os.path.expanduser("~")
-        
-        if current_path.startswith(home_path):
-            return current_path.replace(home_path, "~", 1)
-        return current_path
+    def set_variable(self, name, value):
+        """NAME=value: exported variables stay exported, anything else is a shell variable"""
+        if name in os.environ:
+            self.setenv(name, value)
+            if name == 'PATH':
+                self.command_hash.clear()
+        else:
+            self.variables[name] = value
 
-    def get_prompt(self):
-        """Generate the tsundere prompt"""
-        current_path = self.get_current_path_display()
-        
-        user = os.environ.get('USER', 'unknown')
-        hostname = socket.gethostname()
-        
-        # Check if root
-        is_root = os.geteuid() == 0
-        prompt_char = '#' if is_root else '$'
-        
-        git_branch = self.get_git_branch()
-        venv = self.get_venv()
-        
-        # Build first line with time, date, user, hostname
-        now = datetime.now()
-        time_str = now.strftime("%H:%M:%S")
-        date_str = now.strftime("%Y-%m-%d")
-        
-        first_line = f"{Colors.CYAN}→ {Colors.RESET}"
-        first_line += f"{Colors.DIM}[{time_str} {date_str}]{Colors.RESET} - "
-        first_line += f"{Colors.GREEN}[{user} - {hostname}]{Colors.RESET}"
-        
-        if git_branch:
-            first_line += f"{Colors.YELLOW} ({FileIcons.GIT} - {git_branch}){Colors.RESET}"
-        
-        if venv:
-            venv_name = os.path.basename(venv)
-            first_line += f"{Colors.MAGENTA} [{FileIcons.PYTHON} - {venv_name}]{Colors.RESET}"
-        
-        # Second line with path and prompt
-        second_line = f"{Colors.CYAN}→ {Colors.PINK}nya~({current_path}){prompt_char}>{Colors.RESET} "
-        
-        return f"{first_line}\n{second_line}"
+    def assignment(self, word):
+        """(name, value word) if word is NAME=value, else None"""
+        if '=' not in word.text:
+            return None
+        kind, text = word.parts[0]
+        eq = text.find('=')
+        if kind != 'plain' or eq <= 0 or text[0] not in ParameterExpander.NAME_START:
+            return None
+        name = text[:eq]
+        if not all(c in ParameterExpander.NAME_CHARS for c in name):
+            return None
+        value = text[eq + 1:]
+        return name, Word(word.text[eq + 1:], ((kind, value),) + word.parts[1:])
 
-    def show_prompt(self):
-        """Display prompt and wait for input"""
-        try:
-            prompt = self.get_prompt()
-            return input(prompt)
-        except EOFError:
-            print(f"\n{Colors.YELLOW}S-see you later... baka! ^-^{Colors.RESET}")
-            sys.exit(0)
+    def expand_aliases(self, commands):
+        """The list with aliased command names replaced, like bash: each alias at most once per command"""
+        items = []
+        changed = False
+        for op, pipeline in commands.items:
+            expanded = self.expand_pipeline_aliases(op, pipeline)
+            if expanded is None:
+                items.append((op, pipeline))
+            else:
+                items.extend(expanded)
+                changed = True
+        return CommandList(items) if changed else commands
 
-    def get_file_icon(self, filename, is_dir=False):
-        """Get appropriate nerd font icon for file"""
-        if is_dir:
-            return FileIcons.FOLDER
-        
-        # Check for exact filename matches first
-        filename_lower = filename.lower()
-        if filename_lower in FileIcons.ICONS:
-            return FileIcons.ICONS[filename_lower]
-        
-        # Check for extension matches
-        if '.' in filename:
-            ext = '.' + filename.split('.')[-1].lower()
-            if ext in FileIcons.ICONS:
-                return FileIcons.ICONS[ext]
-        
-        # Check for compound extensions
-        if filename.endswith('.tar.gz'):
-            return FileIcons.ICONS['.tar.gz']
-        elif filename.endswith('.tar.xz'):
-            return FileIcons.ICONS['.tar.xz']
-        elif filename.endswith('.pkg.tar.xz'):
-            return FileIcons.ICONS['.pkg.tar.xz']
-        
-        return FileIcons.ICONS['default']
-
-    def expand_path(self, path):
-        """Expand ~ and environment variables in path"""
-        return os.path.expanduser(os.path.expandvars(path))
-
-    def handle_redirection(self, args):
-        """Handle input/output redirection"""
-        stdin_file = None
-        stdout_file = None
-        stderr_file = None
-        append_mode = False
-        
-        i = 0
-        clean_args = []
-        
-        while i < len(args):
-            arg = args[i]
-            
-            if arg == '>':
-                if i + 1 < len(args):
-                    stdout_file = self.expand_path(args[i + 1])
-                    i += 2
-                else:
-                    print(f"{Colors.RED}Baka! You need to specify a file after '>' >_<{Colors.RESET}")
-                    return None, None, None, None, True
-            elif arg == '>>':
-                if i + 1 < len(args):
-                    stdout_file = self.expand_path(args[i + 1])
-                    append_mode = True
-                    i += 2
-                else:
-                    print(f"{Colors.RED}Hmph! You need a file after '>>' >_<{Colors.RESET}")
-                    return None, None, None, None, True
-            elif arg == '<':
-                if i + 1 < len(args):
-                    stdin_file = self.expand_path(args[i + 1])
-                    i += 2
-                else:
-                    print(f"{Colors.RED}D-dummy! You need a file after '<' >_<{Colors.RESET}")
-                    return None, None, None, None, True
-            elif arg == '2>':
-                if i + 1 < len(args):
-                    stderr_file = self.expand_path(args[i + 1])
-                    i += 2
+    def expand_pipeline_aliases(self, op, pipeline):
+        """One pipeline's aliases expanded, as list items (an alias can hold a whole list); None if none applied.
+
+        The alias text goes in where its name was: its first pipeline joins the
+        stages before it, its last one takes the rest of the command's words
+        and the stages after it.
+        """
+        items = []
+        stages = []
+        background = pipeline.background
+        changed = False
+        for node in pipeline.commands:
+            seen = set()
+            while type(node) is SimpleCommand and node.words:
+                first = node.words[0]
+                name = first.text
+                if name not in self.aliases or name in seen or not first.is_plain():
+                    break
+                seen.add(name)
+                changed = True
+                alias = self.parser.parse(self.aliases[name])
+                if alias is None:
+                    node = SimpleCommand(node.words[1:], node.redirects)
+                    continue
+                (_, head), *tail = alias.items
+                if tail:
+                    items.append((op, Pipeline(stages + head.commands, head.background)))
+                    items.extend(tail[:-1])
+                    op, head = tail[-1]
+                    stages = []
+                stages.extend(head.commands[:-1])
+                last = head.commands[-1]
+                background = background or head.background
+                if type(last) is SimpleCommand:
+                    node = SimpleCommand(last.words + node.words[1:], last.redirects + node.redirects)
+                elif len(node.words) > 1:
+                    raise ShellSyntaxError(f"Hmph! Alias '{name}' ends in ( ), there's no room for '{node.words[1].text}' >_<")
                 else:
-                    print(f"{Colors.RED}Idiot! You need a file after '2>' >_<{Colors.RESET}")
-                    return None, None, None, None, True
-            else:
-                clean_args.append(arg)
-                i += 1
-        
-        return clean_args, stdin_file, stdout_file, stderr_file, append_mode
+                    node = Subshell(last.body, last.redirects + node.redirects)
+            stages.append(node)
+        if not changed:
+            return None
+        items.append((op, Pipeline(stages, background)))
+        return items
 
-    def execute_command(self, command, suppress_output=False):
-        """Execute a command with tsundere flair"""
-        if not command.strip():
+    def run_pipeline(self, pipeline, command, suppress_output=False):
+        """Run one pipeline of a parsed line: 'time', background, pipelines and subshells, then a single command"""
+        # 'time' covers everything after it, pipelines included
+        first = pipeline.commands[0]
+        subshell = type(first) is Subshell
+        if not subshell and first.words and first.words[0].text == 'time' and first.words[0].is_plain():
+            rest = SimpleCommand(first.words[1:], first.redirects)
+            if not rest.words and len(pipeline.commands) == 1:
+                self.last_exit_code = self.builtin_time([])
+                return
+            timed = Pipeline([rest] + pipeline.commands[1:], pipeline.background)
+            label = rest.words[0].text if rest.words else 'time'
+            self.last_exit_code = self.time_command(
+                label, lambda: self.run_list(CommandList([(';', timed)]), command, suppress_output))
             return
         
-        # Handle aliases
-        parts = shlex.split(command)
-        if parts[0] in self.aliases:
-            command = command.replace(parts[0], self.aliases[parts[0]], 1)
-            parts = shlex.split(command)
+        # Pipelines, background jobs and subshells
+        if pipeline.background or len(pipeline.commands) > 1 or subshell:
+            self.execute_pipeline(pipeline, suppress_output, command.rstrip().rstrip('&').rstrip())
+            return
         
-        # Handle redirection
-        result = self.handle_redirection(parts)
-        if len(result) == 5 and result[4]:  # Error occurred
-            self.last_exit_code = 1
+        # NAME=value ... on its own sets shell variables
+        if first.words and all(self.assignment(word) for word in first.words):
+            self.capture_status = None
+            for word in first.words:
+                name, value = self.assignment(word)
+                self.set_variable(name, self.expand_word(value))
+            # The status of the last $(...) in them, if any
+            self.last_exit_code = self.capture_status or 0
             return
         
-        clean_args, stdin_file, stdout_file, stderr_file, append_mode = result
+        # Handle redirection
+        started = self.latency.start()
+        stdin_file, stdout_file, stderr_file, append_mode = self.redirections(first)
+        clean_args, globs = self.argv(first)
+        self.latency.stop('redirect', started)
         
         if not clean_args:
             return
         
         cmd = clean_args[0]
+        argv = None
         
         # Check for builtin commands
         if cmd in self.builtins:
+            args = clean_args
+            if cmd in CoreUtils.NAMES:
+                # They stand in for the real binaries, so they get globs like them
+                started = self.latency.start()
+                args = argv = self.expand_globs(clean_args, globs)
+                self.latency.stop('expand', started)
             try:
-                self.builtins[cmd](clean_args[1:])
-                if not suppress_output:
-                    print(f"{Colors.GREEN}{TsundereMessages.get_random(TsundereMessages.SUCCESS)}{Colors.RESET}")
-                self.last_exit_code = 0
+                saved = self.redirect_fds(stdin_file, stdout_file, stderr_file, append_mode)
+                if saved is None:
+                    self.last_exit_code = 1
+                    return
+                # Builtins may return an exit code; None means success
+                started = self.latency.start()
+                try:
+                    code = self.call_builtin(cmd, args, None if cmd in CoreUtils.NAMES else globs)
+                finally:
+                    self.latency.stop('builtin', started)
+                    self.restore_fds(saved)
+                self.last_exit_code = code if isinstance(code, int) else 0
+                if not suppress_output and self.interactive and not self.list_depth:
+                    if self.last_exit_code == 0:
+                        print(f"{Colors.GREEN}{TsundereMessages.get_random(TsundereMessages.SUCCESS)}{Colors.RESET}")
+                    elif self.last_exit_code != 128 + signal.SIGTSTP:
+                        print(f"{Colors.RED} >_< {self.last_exit_code}{Colors.RESET}")
+            except NeedsExternal:
+                pass  # Something only the real binary does; run that instead
             except Exception as e:
                 if not suppress_output:
                     print(f"{Colors.RED}B-baka! Error in builtin: {e} >_< {Colors.RESET}")
                 self.last_exit_code = 1
-            return
+                return
+            else:
+                return
         
         # Execute external command
         try:
-            # Setup file descriptors for redirection
-            stdin_fd = None
-            stdout_fd = None
-            stderr_fd = None
-            
-            if stdin_file:
-                try:
-                    stdin_fd = open(stdin_file, 'r')
-                except FileNotFoundError:
-                    print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.FILE_NOT_FOUND)}{Colors.RESET}")
-                    self.last_exit_code = 1
-                    return
-                except PermissionError:
-                    print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.PERMISSION_DENIED)}{Colors.RESET}")
-                    self.last_exit_code = 1
-                    return
-            
-            if stdout_file:
-                mode = 'a' if append_mode else 'w'
-                try:
-                    stdout_fd = open(stdout_file, mode)
-                except PermissionError:
-                    print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.PERMISSION_DENIED)}{Colors.RESET}")
-                    self.last_exit_code = 1
-                    return
-            
-            if stderr_file:
-                try:
-                    stderr_fd = open(stderr_file, 'w')
-                except PermissionError:
-                    print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.PERMISSION_DENIED)}{Colors.RESET}")
-                    self.last_exit_code = 1
-                    return
-            
-            # Handle glob patterns
-            expanded_args = []
-            for arg in clean_args:
-                if any(char in arg for char in ['*', '?', '[', ']']):
-                    matches = glob.glob(arg)
-                    if matches:
-                        expanded_args.extend(sorted(matches))
-                    else:
-                        expanded_args.append(arg)
-                else:
-                    expanded_args.append(arg)
-            
-            result = subprocess.run(expanded_args, 
-                                  stdin=stdin_fd, 
-                                  stdout=stdout_fd, 
-                                  stderr=stderr_fd)
-            
-            # Close file descriptors
-            if stdin_fd: stdin_fd.close()
-            if stdout_fd: stdout_fd.close()
-            if stderr_fd: stderr_fd.close()
+            if argv is None:
+                started = self.latency.start()
+                argv = self.expand_globs(clean_args, globs)
+                self.latency.stop('expand', started)
+            started = self.latency.start()
+            process = self.launch(argv, stdin_file, stdout_file, stderr_file, append_mode)
+            self.latency.stop('spawn', started)
+            if process is None:
+                self.last_exit_code = 1
+                return
             
-            self.last_exit_code = result.returncode
+            job = ShellJob(command, [process], process.pid if self.job_control else None)
+            started = self.latency.start()
+            returncode = self.wait_for_job(job)
+            self.latency.stop('wait', started)
+            self.last_exit_code = returncode
             
-            if result.returncode == 0:
-                if not suppress_output and not stdout_file:
-                    print(f"{Colors.GREEN}{TsundereMessages.get_random(TsundereMessages.SUCCESS)}{Colors.RESET}")
+            if job.is_stopped():
+                return
+            note = self.set_last_stats(job.stats())
+            if suppress_output or not self.interactive or self.list_depth:
+                return
+            if returncode == 0:
+                if not stdout_file:
+                    print(f"{Colors.GREEN}{TsundereMessages.get_random(TsundereMessages.SUCCESS)}{Colors.RESET}{note}")
             else:
-                if not suppress_output:
-                    print(f"{Colors.RED} >_< {result.returncode}{Colors.RESET}")
+                print(f"{Colors.RED} >_< {returncode}{Colors.RESET}{note}")
                 
         except FileNotFoundError:
             if not suppress_output:
                 print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.COMMAND_NOT_FOUND, cmd)}{Colors.RESET}")
                 
                 # Suggest thefuck if available
+                if self.thefuck_available is None and self.interactive:
+                    self.thefuck_available = self.check_thefuck()
                 if self.thefuck_available:
                     try:
                         response = input(f"{Colors.YELLOW}W-want me to try fixing it with thefuck? (y/n): {Colors.RESET}")
@@ -606,6 +5007,16 @@ class MikuShell:
             
             self.last_exit_code = 127
             
+        except OSError as e:
+            if e.errno != errno.E2BIG:
+                if not suppress_output:
+                    print(f"{Colors.RED}Something went wrong, baka! {e} >_<{Colors.RESET}")
+                self.last_exit_code = 1
+                return
+            if not suppress_output:
+                print(f"{Colors.RED}Way too many arguments, baka! Try 'batch {command}' instead >_<{Colors.RESET}")
+            self.last_exit_code = 126
+            
         except Exception as e:
             if not suppress_output:
                 print(f"{Colors.RED}Something went wrong, baka! {e} >_<{Colors.RESET}")
@@ -617,7 +5028,7 @@ class MikuShell:
         if not args:
             target = os.path.expanduser("~")
         else:
-            target = self.expand_path(args[0])
+            target = args[0]
         
         try:
             os.chdir(target)
@@ -636,59 +5047,94 @@ class MikuShell:
         
         # Get directory to list
         target_dir = '.'
-        ls_args = []
+        flags = set()
+        limit = None
+        page = False
         
-        for arg in args:
-            if not arg.startswith('-'):
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg == '--page':
+                page = True
+            elif arg == '--limit' or arg.startswith('--limit='):
+                if '=' in arg:
+                    value = arg.split('=', 1)[1]
+                elif i + 1 < len(args):
+                    i += 1
+                    value = args[i]
+                else:
+                    value = ''
+                if not value.isdigit():
+                    print(f"{Colors.RED}--limit needs a number, baka! >_<{Colors.RESET}")
+                    raise ValueError("Invalid --limit")
+                limit = int(value)
+            elif not arg.startswith('-') or arg == '-':
                 target_dir = arg
             else:
-                ls_args.append(arg)
+                flags.update(arg[1:])
+            i += 1
+        
+        sort_by = 'name'
+        if 'S' in flags:
+            sort_by = 'size'
+        elif 't' in flags:
+            sort_by = 'time'
+        
+        is_tty = sys.stdout.isatty()
+        page = page and is_tty and sys.stdin.isatty()
+        lister = DirectoryLister(self.icon_index,
+                                 show_all='a' in flags,
+                                 long_format='l' in flags,
+                                 sort_by=sort_by,
+                                 reverse='r' in flags,
+                                 one_per_line='1' in flags or not is_tty,
+                                 nya=nya_mode)
         
         try:
-            items = os.listdir(target_dir)
+            if os.path.isdir(target_dir):
+                entries = lister.iter_entries(target_dir)
+            else:
+                entries = iter([(os.path.basename(target_dir), False, os.stat(target_dir))])
+            
+            try:
+                size = os.get_terminal_size(sys.stdout.fileno())
+                width, height = size.columns, size.lines
+            except OSError:
+                width, height = int(os.environ.get('COLUMNS', 80)), 24
+            
+            # Stream when asked to (-U, --page) or when the directory is too big
+            # to sort comfortably; a limited sorted listing only ever keeps
+            # limit entries, so it doesn't need to stream, and an explicit
+            # -t/-S/-r always gets its sort
+            streaming = 'U' in flags or page
+            head = []
+            if not streaming and limit is None and not flags & set('tSr'):
+                head = list(itertools.islice(entries, lister.STREAM_THRESHOLD))
+                if len(head) == lister.STREAM_THRESHOLD:
+                    streaming = True
+                    entries = itertools.chain(head, entries)
+                else:
+                    entries = head
             
             if nya_mode:
                 # Cute nya mode
-                print(f"{Colors.PINK}✧･ﾟ: *✧･ﾟ:* Listing files with love~ *:･ﾟ✧*:･ﾟ✧{Colors.RESET}")
-                print()
-                
-                for item in sorted(items):
-                    item_path = os.path.join(target_dir, item)
-                    is_dir = os.path.isdir(item_path)
-                    icon = self.get_file_icon(item, is_dir)
-                    
-                    if is_dir:
-                        color = Colors.BLUE
-                        suffix = "/"
-                    elif os.access(item_path, os.X_OK):
-                        color = Colors.GREEN
-                        suffix = "*"
-                    else:
-                        color = Colors.RESET
-                        suffix = ""
-                    
-                    print(f"  {Colors.PINK}♡{Colors.RESET} {icon} {color}{item}{suffix}{Colors.RESET}")
-                
-                print()
-                print(f"{Colors.PINK}(◕‿◕)♡ Found {len(items)} items! So many cute files~ {Colors.RESET}")
+                sys.stdout.write(f"{Colors.PINK}✧･ﾟ: *✧･ﾟ:* Listing files with love~ *:･ﾟ✧*:･ﾟ✧{Colors.RESET}\n\n")
+            
+            if streaming:
+                # Names in a huge listing are all unique; don't churn the LRU
+                lister.icon_lookup = self.icon_index.resolve
+                count = lister.stream(entries, limit=limit,
+                                      page_height=max(1, height - 1) if page else None)
             else:
-                # Normal mode with icons
-                for item in sorted(items):
-                    item_path = os.path.join(target_dir, item)
-                    is_dir = os.path.isdir(item_path)
-                    icon = self.get_file_icon(item, is_dir)
-                    
-                    if is_dir:
-                        color = Colors.BLUE + Colors.BOLD
-                        suffix = "/"
-                    elif os.access(item_path, os.X_OK):
-                        color = Colors.GREEN + Colors.BOLD
-                        suffix = "*"
-                    else:
-                        color = Colors.RESET
-                        suffix = ""
-                    
-                    print(f"{icon} {color}{item}{suffix}{Colors.RESET}")
+                entries = lister.sort(entries, limit)
+                count = len(entries)
+                lines = lister.render(entries, width)
+                if lines:
+                    sys.stdout.write('\n'.join(lines) + '\n')
+            
+            if nya_mode:
+                sys.stdout.write(f"\n{Colors.PINK}(◕‿◕)♡ Found {count} items! So many cute files~ {Colors.RESET}\n")
+            sys.stdout.flush()
                     
         except FileNotFoundError:
             print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.DIRECTORY_NOT_FOUND)}{Colors.RESET}")
@@ -711,6 +5157,12 @@ class MikuShell:
                 print(f"{Colors.RED}Exit code must be a number, baka! >_<{Colors.RESET}")
                 return
         
+        self.jobs.poll()
+        if self.jobs.has_stopped() and not self.exit_warned:
+            print(f"{Colors.YELLOW}You still have stopped jobs, baka! Exit again if you really mean it >_<{Colors.RESET}")
+            self.exit_warned = True
+            return 1
+        
         farewell_messages = [
             "F-fine! I'm leaving! It's not like I enjoyed talking to you or anything! ^-^",
             "B-bye! Don't miss me too much, dummy! ^-^",
@@ -719,11 +5171,15 @@ class MikuShell:
             "Hmph! I have better things to do anyway! ^-^"
         ]
         
-        print(f"{Colors.YELLOW}{random.choice(farewell_messages)}{Colors.RESET}")
+        if self.interactive:
+            print(f"{Colors.YELLOW}{random.choice(farewell_messages)}{Colors.RESET}")
         sys.exit(code)
 
     def builtin_history(self, args):
-        """Show command history"""
+        """Show command history, or search it with 'history search'"""
+        if args and args[0] == 'search':
+            return self.history_search(args[1:])
+        self.wait_for_history()
         length = readline.get_current_history_length()
         start = max(1, length - 100) if not args else max(1, length - int(args[0]) if args[0].isdigit() else 1)
         
@@ -732,6 +5188,54 @@ class MikuShell:
             if line:
                 print(f"{Colors.DIM}{i:4d}{Colors.RESET}  {line}")
 
+    def history_search(self, args):
+        """history search [-n N] [--here|-d DIR] [--ok|--failed|-e CODE] TERMS..."""
+        limit = 20
+        cwd = None
+        exit_code = None
+        failed = None
+        terms = []
+        i = 0
+        try:
+            while i < len(args):
+                arg = args[i]
+                if arg == '-n':
+                    i += 1
+                    limit = int(args[i])
+                elif arg == '--here':
+                    cwd = os.getcwd()
+                elif arg == '-d':
+                    i += 1
+                    cwd = os.path.abspath(args[i])
+                elif arg == '-e':
+                    i += 1
+                    exit_code = int(args[i])
+                elif arg == '--ok':
+                    failed = False
+                elif arg == '--failed':
+                    failed = True
+                else:
+                    terms.append(arg)
+                i += 1
+        except (IndexError, ValueError):
+            print(f"{Colors.RED}Usage: history search [-n N] [--here|-d DIR] [--ok|--failed|-e CODE] TERMS... baka!{Colors.RESET}")
+            return 1
+        
+        index = self.get_history_index()
+        results = index.search(' '.join(terms), limit, cwd=cwd, exit_code=exit_code, failed=failed)
+        if not results:
+            print(f"{Colors.YELLOW}N-nothing like that in your history... did you even type it? >_<{Colors.RESET}")
+            return 1
+        
+        lines = []
+        for score, entry in results:
+            used = index.last_used[entry]
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(used)) if used else '?' * 16
+            codes = index.codes[entry]
+            color = Colors.RED if codes and 0 not in codes else Colors.GREEN
+            lines.append(f"{Colors.DIM}{when}{Colors.RESET} {color}x{index.counts[entry]:<4d}{Colors.RESET} {index.commands[entry]}")
+        print('\n'.join(lines))
+
     def builtin_clear(self, args):
         """Clear the screen"""
         os.system('clear')
@@ -741,20 +5245,28 @@ class MikuShell:
         print(' '.join(args))
 
     def builtin_export(self, args):
-        """Set environment variables"""
+        """Set environment variables, or move shell variables into the environment"""
         for arg in args:
             if '=' in arg:
                 key, value = arg.split('=', 1)
-                os.environ[key] = value
-            else:
+                self.variables.pop(key, None)
+                self.setenv(key, value)
+                if key == 'PATH':
+                    self.command_hash.clear()
+            elif arg in self.variables:
+                self.setenv(arg, self.variables.pop(arg))
+            elif arg not in os.environ:
                 print(f"{Colors.RED}Use format: export VAR=value, baka! >_<{Colors.RESET}")
                 raise ValueError("Invalid export format")
 
     def builtin_unset(self, args):
-        """Unset environment variables"""
+        """Unset shell and environment variables"""
         for arg in args:
+            self.variables.pop(arg, None)
             if arg in os.environ:
-                del os.environ[arg]
+                self.unsetenv(arg)
+                if arg == 'PATH':
+                    self.command_hash.clear()
 
     def builtin_alias(self, args):
         """Create command aliases"""
@@ -770,18 +5282,541 @@ class MikuShell:
                     if arg in self.aliases:
                         print(f"alias {arg}='{self.aliases[arg]}'")
 
+    def builtin_enable(self, args):
+        """enable [-n] [NAME...]: list builtins, or switch them off (-n) and back on"""
+        disable = bool(args) and args[0] == '-n'
+        names = args[1:] if disable else args
+        if not names:
+            for name in sorted(self.builtins):
+                print(f"enable {name}")
+            for name in sorted(self.disabled_builtins):
+                print(f"{Colors.DIM}enable -n {name}{Colors.RESET}")
+            return
+        
+        code = 0
+        for name in names:
+            source, target = (self.builtins, self.disabled_builtins) if disable else (self.disabled_builtins, self.builtins)
+            if name in source:
+                target[name] = source.pop(name)
+            elif name not in target:
+                print(f"{Colors.RED}{name}: not a builtin, baka! >_<{Colors.RESET}")
+                code = 1
+        return code
+
     def builtin_which(self, args):
         """Find command location"""
         for cmd in args:
             if cmd in self.builtins:
                 print(f"{cmd}: shell builtin")
             else:
-                result = subprocess.run(['which', cmd], capture_output=True, text=True)
-                if result.returncode == 0:
-                    print(result.stdout.strip())
+                path = self.command_hash.lookup(cmd)
+                if path:
+                    print(path)
                 else:
                     print(f"{Colors.RED}{cmd} not found >_<{Colors.RESET}")
 
+    def builtin_hash(self, args):
+        """Show, fill or reset (-r) the command hash table"""
+        if not args:
+            if not self.command_hash.table:
+                print(f"{Colors.DIM}hash: hash table empty{Colors.RESET}")
+                return
+            print("hits\tcommand")
+            for name, path in sorted(self.command_hash.table.items()):
+                print(f"{self.command_hash.hits.get(name, 0):4d}\t{path}")
+            return
+        
+        missing = False
+        for arg in args:
+            if arg == '-r':
+                self.command_hash.clear()
+            elif self.command_hash.lookup(arg) is None:
+                print(f"{Colors.RED}{TsundereMessages.get_random(TsundereMessages.COMMAND_NOT_FOUND, arg)}{Colors.RESET}")
+                missing = True
+            else:
+                # Entries added by hash itself start without hits, like bash
+                self.command_hash.hits[arg] = 0
+        if missing:
+            raise FileNotFoundError("Command not found")
+
+    def builtin_type(self, args):
+        """Describe how each name would be interpreted"""
+        missing = False
+        for name in args:
+            if name in self.aliases:
+                print(f"{name} is aliased to '{self.aliases[name]}'")
+            elif name in self.builtins:
+                print(f"{name} is a shell builtin")
+            else:
+                hashed = name in self.command_hash.table
+                path = self.command_hash.lookup(name)
+                if path is None:
+                    print(f"{Colors.RED}{name} not found >_<{Colors.RESET}")
+                    missing = True
+                elif hashed:
+                    print(f"{name} is hashed ({path})")
+                else:
+                    print(f"{name} is {path}")
+        if missing:
+            raise FileNotFoundError("Command not found")
+
+    def builtin_segment(self, args):
+        """Manage extra prompt segments: segment [add NAME [-t MS] CMD... | rm NAME]"""
+        if not args:
+            for name, segment in self.segments.segments.items():
+                print(f"{name}: {int(segment.budget * 1000)}ms budget")
+            return
+        
+        action = args[0]
+        if action == 'add' and len(args) >= 3:
+            name = args[1]
+            rest = args[2:]
+            budget = 0.05
+            if rest[0] == '-t' and len(rest) >= 3:
+                budget = int(rest[1]) / 1000
+                rest = rest[2:]
+            argv = shlex.split(rest[0]) if len(rest) == 1 else rest
+            self.segments.register(PromptSegment(name, self.command_segment(argv), budget=budget))
+        elif action == 'rm' and len(args) == 2:
+            if not self.segments.unregister(args[1]):
+                print(f"{Colors.RED}There's no segment called '{args[1]}', baka! >_<{Colors.RESET}")
+                raise ValueError("Unknown segment")
+        else:
+            print(f"{Colors.RED}Use: segment add NAME [-t MS] CMD, or segment rm NAME, baka! >_<{Colors.RESET}")
+            raise ValueError("Invalid segment usage")
+
+    def builtin_icon(self, args):
+        """Add icon/colour rules: icon PATTERN GLYPH [SGR], or icon --colors LS_COLORS-SPEC"""
+        if not args:
+            for table, prefix in ((self.icon_index.names, ''), (self.icon_index.suffixes, '*')):
+                for key, (icon, color) in sorted(table.items()):
+                    if color:
+                        print(f"{prefix}{key}  {color}{icon}{Colors.RESET}")
+            return
+        
+        try:
+            if args[0] == '--colors':
+                self.icon_index.load_ls_colors(args[1] if len(args) > 1 else os.environ.get('LS_COLORS', ''))
+            elif len(args) in (2, 3):
+                self.icon_index.add_rule(args[0], icon=args[1] or None,
+                                         sgr=args[2] if len(args) == 3 else None)
+            else:
+                raise ValueError("Invalid icon usage")
+        except ValueError:
+            print(f"{Colors.RED}Use: icon '*.ext' GLYPH [SGR] or icon --colors '*.ext=SGR:...', baka! >_<{Colors.RESET}")
+            raise
+
+    def builtin_batch(self, args):
+        """xargs-style: batch [-j N] CMD ARGS... runs CMD as often as needed to stay under ARG_MAX"""
+        jobs = 1
+        while args and args[0].startswith('-j'):
+            value = args[0][2:] or (args[1] if len(args) > 1 else '')
+            args = args[1:] if args[0][2:] else args[2:]
+            if not value.isdigit() or int(value) < 1:
+                print(f"{Colors.RED}-j needs a positive number, baka! >_<{Colors.RESET}")
+                raise ValueError("Invalid -j")
+            jobs = int(value)
+        if not args:
+            print(f"{Colors.RED}Batch what?! Give me a command, dummy! >_<{Colors.RESET}")
+            raise ValueError("Missing command")
+        
+        # Words before the first pattern and after the last one are repeated
+        # in every invocation; everything in between is streamed into batches.
+        # Quoted pattern characters are no pattern
+        globs = self.arg_patterns(args) or [True] * len(args)
+        magic = [i for i, arg in enumerate(args)
+                 if globs[i] and (self.globber.has_magic(arg) or '{' in arg)]
+        if not magic:
+            magic = [len(args) - 1]
+        first = max(1, magic[0])
+        last = max(first, magic[-1])
+        prefix, middle, suffix = args[:first], args[first:last + 1], args[last + 1:]
+        stream = self.globber.iter_args(middle, globs[first:last + 1])
+        
+        # The batches run as one foreground job: they share a process group
+        # that gets the terminal, so Ctrl+C and Ctrl+Z reach them and not us
+        command = ' '.join(['batch'] + args)
+        running = []  # JobProcess per batch, oldest first
+        pgid = None
+        state = {'failed': 0, 'interrupted': False, 'stopped': False}
+        
+        def reap():
+            job = ShellJob(command, running[:1], pgid)
+            job.wait()
+            if job.is_stopped():
+                state['stopped'] = True
+                return
+            code = running.pop(0).status
+            state['failed'] += code != 0
+            state['interrupted'] |= code == 128 + signal.SIGINT
+        
+        count = 0
+        try:
+            for argv in self.globber.batches(prefix, stream, suffix):
+                if len(running) >= jobs:
+                    reap()
+                if state['interrupted'] or state['stopped']:
+                    break  # No more batches once one was interrupted
+                if not running:
+                    pgid = None  # The last group is gone with its processes
+                process = self.launch(argv, pgid=pgid)
+                running.append(process)
+                count += 1
+                if self.job_control and pgid is None:
+                    pgid = process.pid
+                    self.give_terminal(pgid)
+        finally:
+            try:
+                while running and not state['stopped']:
+                    reap()
+            finally:
+                if self.job_control:
+                    self.take_terminal()
+        
+        if state['stopped']:
+            job = ShellJob(command, running, pgid)
+            self.jobs.add(job)
+            print(f"\n{Colors.YELLOW}[{job.id}]{self.jobs.marker(job)}  Stopped    {job.command}{Colors.RESET}")
+            return 128 + signal.SIGTSTP
+        if state['interrupted']:
+            return 128 + signal.SIGINT
+        failed = state['failed']
+        if failed:
+            print(f"{Colors.RED}{failed} of {count} batches failed >_<{Colors.RESET}")
+            raise RuntimeError("Batch failed")
+
+    def find_job(self, spec=None):
+        job = self.jobs.get(spec)
+        if job is None:
+            print(f"{Colors.RED}There's no such job, baka! {spec or ''} >_<{Colors.RESET}")
+            raise LookupError("No such job")
+        return job
+
+    def builtin_jobs(self, args):
+        """List background and stopped jobs"""
+        self.jobs.poll()
+        show_pids = '-l' in args
+        for job in sorted(self.jobs.jobs.values(), key=lambda j: j.id):
+            pids = ' '.join(str(p.pid) for p in job.processes if p.pid) + ' ' if show_pids else ''
+            print(f"[{job.id}]{self.jobs.marker(job)}  {pids}{job.state():<10} {job.command}")
+        for job in list(self.jobs.jobs.values()):
+            if job.is_done():
+                self.jobs.remove(job)
+
+    def builtin_fg(self, args):
+        """Bring a job to the foreground"""
+        job = self.find_job(args[0] if args else None)
+        print(job.command)
+        for process in job.live():
+            process.stopped = False
+        job.signal(signal.SIGCONT)
+        return self.wait_for_job(job)
+
+    def builtin_bg(self, args):
+        """Resume stopped jobs in the background"""
+        for spec in args or [None]:
+            job = self.find_job(spec)
+            for process in job.live():
+                process.stopped = False
+            job.signal(signal.SIGCONT)
+            self.jobs.touch(job)
+            print(f"[{job.id}]{self.jobs.marker(job)} {job.command} &")
+
+    def builtin_wait(self, args):
+        """Wait for jobs (%n) or pids to finish; with no arguments, wait for all of them"""
+        if args:
+            targets = []
+            for spec in args:
+                job = self.jobs.get(spec)
+                if job is None and spec.isdigit():
+                    job = next((j for j in self.jobs.jobs.values()
+                                if any(p.pid == int(spec) for p in j.processes)), None)
+                if job is None:
+                    print(f"{Colors.RED}There's no such job, baka! {spec} >_<{Colors.RESET}")
+                    return 127
+                targets.append(job)
+        else:
+            targets = list(self.jobs.jobs.values())
+        
+        code = 0
+        for job in targets:
+            while not job.is_done() and not job.is_stopped():
+                job.wait()
+            code = job.processes[-1].status if job.is_done() else 128 + signal.SIGTSTP
+            if job.is_done():
+                self.jobs.remove(job)
+        return code
+
+    def builtin_kill(self, args):
+        """Send a signal to jobs (%n) or pids: kill [-SIG | -s SIG] target..."""
+        if args and args[0] == '-l':
+            print(' '.join(sig.name[3:] for sig in signal.Signals if not sig.name.startswith('SIG_')))
+            return
+        
+        sig = signal.SIGTERM
+        if args and args[0] == '-s' and len(args) > 1:
+            name, args = args[1], args[2:]
+        elif args and args[0].startswith('-') and len(args[0]) > 1:
+            name, args = args[0][1:], args[1:]
+        else:
+            name = None
+        if name is not None:
+            try:
+                sig = int(name) if name.isdigit() else signal.Signals['SIG' + name.upper().removeprefix('SIG')]
+            except KeyError:
+                print(f"{Colors.RED}What kind of signal is '{name}', baka?! >_<{Colors.RESET}")
+                return 1
+        if not args:
+            print(f"{Colors.RED}Kill who?! Give me a job or pid, dummy! >_<{Colors.RESET}")
+            return 1
+        
+        code = 0
+        for target in args:
+            try:
+                if target.startswith('%'):
+                    job = self.find_job(target)
+                    job.signal(sig)
+                    if sig in (signal.SIGTERM, signal.SIGKILL, signal.SIGHUP) and job.is_stopped():
+                        # A stopped job can't act on SIGTERM until it runs again
+                        job.signal(signal.SIGCONT)
+                else:
+                    os.kill(int(target), sig)
+            except (LookupError, ValueError, ProcessLookupError, PermissionError) as e:
+                if not isinstance(e, LookupError):
+                    print(f"{Colors.RED}Couldn't kill {target}: {e} >_<{Colors.RESET}")
+                code = 1
+        return code
+
+    def builtin_parallel(self, args):
+        """Run a command template over many inputs: parallel [-j N] [-k] CMD [{}] [::: ARGS...]"""
+        try:
+            max_jobs = len(os.sched_getaffinity(0))
+        except AttributeError:
+            max_jobs = os.cpu_count() or 1
+        keep_order = False
+        while args and args[0].startswith('-') and args[0] != ':::':
+            flag = args.pop(0)
+            if flag == '-k':
+                keep_order = True
+            elif flag.startswith('-j'):
+                value = flag[2:] or (args.pop(0) if args else '')
+                if not value.isdigit() or int(value) < 1:
+                    print(f"{Colors.RED}-j needs a positive number, baka! >_<{Colors.RESET}")
+                    return 2
+                max_jobs = int(value)
+            else:
+                print(f"{Colors.RED}I don't know the option '{flag}', dummy! >_<{Colors.RESET}")
+                return 2
+        
+        if ':::' in args:
+            split = args.index(':::')
+            template, inputs = args[:split], iter(self.expand_globs(args[split + 1:], self.arg_patterns(args[split + 1:])))
+        else:
+            # One input per line of stdin, read only as fast as jobs start
+            template = args
+            inputs = (line.rstrip('\n') for line in sys.stdin if line.strip())
+        if len(template) == 1 and ' ' in template[0]:
+            template = shlex.split(template[0])
+        if not template:
+            print(f"{Colors.RED}Parallel what?! Give me a command, dummy! >_<{Colors.RESET}")
+            return 2
+        
+        has_placeholder = any('{}' in word for word in template)
+        def build(arg):
+            if has_placeholder:
+                return [word.replace('{}', arg) for word in template]
+            return template + [arg]
+        
+        results = {'count': 0, 'failed': 0, 'next': 0}
+        finished = {}
+        
+        def show(argv, code, output):
+            color = Colors.DIM if code == 0 else Colors.RED
+            status = '' if code == 0 else f" >_< {code}"
+            sys.stdout.write(f"{color}» {' '.join(argv)}{status}{Colors.RESET}\n")
+            sys.stdout.flush()
+            sys.stdout.buffer.write(output)
+            sys.stdout.buffer.flush()
+        
+        def on_done(index, argv, code, output):
+            results['count'] += 1
+            results['failed'] += code != 0
+            if not keep_order:
+                show(argv, code, output)
+                return
+            finished[index] = (argv, code, output)
+            while results['next'] in finished:
+                show(*finished.pop(results['next']))
+                results['next'] += 1
+        
+        # Children join the shell's process group so Ctrl+C reaches them too;
+        # the shell's own KeyboardInterrupt stops the run, and the runner
+        # kills and reaps whatever is still going
+        spawn = lambda argv, **kwargs: self.spawn(argv, self.shell_pgid, **kwargs)
+        try:
+            ParallelRunner(spawn, max_jobs).run(((i, build(arg)) for i, arg in enumerate(inputs)), on_done)
+        except KeyboardInterrupt:
+            print(f"{Colors.YELLOW}Fine, I'll stop! Only {results['count']} jobs got done >_<{Colors.RESET}")
+            return 128 + signal.SIGINT
+        
+        color = Colors.RED if results['failed'] else Colors.GREEN
+        print(f"{color}{results['count']} jobs, {results['failed']} failed{Colors.RESET}")
+        # Like GNU parallel: the exit status is the number of failed jobs
+        return min(results['failed'], 101)
+
+    def builtin_prompt(self, args):
+        """Show or set the prompt template: prompt ['TEMPLATE' | --reset]"""
+        if not args:
+            print(self.prompt_template.source)
+            return
+        source = PromptTemplate.DEFAULT if args[0] == '--reset' else ' '.join(args)
+        try:
+            self.set_prompt_template(source)
+        except ValueError as e:
+            print(f"{Colors.RED}That prompt is broken, baka! {e} >_<{Colors.RESET}")
+            raise
+
+    def builtin_complete(self, args):
+        """Set how a command's arguments are completed"""
+        usage = f"{Colors.RED}Usage: complete [-W 'WORDS' | -d | -c | -f | -r] CMD... baka!{Colors.RESET}"
+        completer = self.completer
+        if not args:
+            names = ' '.join(sorted(completer.completers))
+            print(f"{Colors.CYAN}Commands with their own completion:{Colors.RESET} {names}")
+            return
+        
+        mode = args[0]
+        names = args[1:]
+        if mode == '-W':
+            if not names:
+                print(usage)
+                return 1
+            words = sorted(names[0].split())
+            names = names[1:]
+            def fn(text, rest):
+                return [word for word in words if word.startswith(text)]
+        elif mode == '-d':
+            def fn(text, rest):
+                return completer.complete_path(text, only_dirs=True)
+        elif mode == '-c':
+            def fn(text, rest):
+                return completer.complete_command(text)
+        elif mode == '-f':
+            def fn(text, rest):
+                return completer.complete_path(text)
+        elif mode == '-r':
+            fn = None
+        else:
+            print(usage)
+            return 1
+        if not names:
+            print(usage)
+            return 1
+        
+        for name in names:
+            if fn is None:
+                completer.unregister(name)
+            else:
+                completer.register(name, fn)
+
+    def builtin_time(self, args):
+        """Run a command and report its wall time, CPU time and peak RSS"""
+        if not args:
+            print(f"{Colors.RED}Time what, baka? Usage: time COMMAND >_<{Colors.RESET}")
+            return 2
+        return self.time_command(args[0], lambda: self.execute_command(shlex.join(args)))
+
+    def time_command(self, name, run):
+        """Call run() and report the time and memory it took; returns the exit code"""
+        self.last_stats = None
+        before = os.times()
+        started = time.monotonic()
+        run()
+        wall = time.monotonic() - started
+        after = os.times()
+        
+        # The shell's own CPU (for builtins) plus every child reaped meanwhile
+        user = after.user - before.user + after.children_user - before.children_user
+        sys_time = after.system - before.system + after.children_system - before.children_system
+        maxrss = self.last_stats.maxrss if self.last_stats else None
+        stats = CommandStats(name, wall, user, sys_time, maxrss)
+        self.setenv('MIKU_LAST_STATS', stats.env_value())
+        
+        lines = [f"real    {int(wall // 60)}m{wall % 60:.3f}s",
+                 f"user    {int(user // 60)}m{user % 60:.3f}s",
+                 f"sys     {int(sys_time // 60)}m{sys_time % 60:.3f}s"]
+        if maxrss is not None:
+            lines.append(f"maxrss  {CommandStats.format_size(maxrss)}")
+        sys.stdout.flush()
+        sys.stderr.write(f"{Colors.CYAN}" + '\n'.join(lines) + f"{Colors.RESET}\n")
+        return self.last_exit_code
+
+    def builtin_stats(self, args):
+        """Show which commands took the most time this session"""
+        if '-r' in args:
+            self.command_stats.clear()
+            return
+        key = 'wall'
+        limit = 15
+        for arg in args:
+            if arg in ('-c', '--cpu'):
+                key = 'cpu'
+            elif arg in ('-n', '--runs'):
+                key = 'runs'
+            elif arg in ('-m', '--rss'):
+                key = 'rss'
+            elif arg.isdigit():
+                limit = int(arg)
+            else:
+                print(f"{Colors.RED}Usage: stats [-c|-n|-m] [N] | stats -r, baka! >_<{Colors.RESET}")
+                return 2
+        
+        rows = self.command_stats.top(key, limit)
+        if not rows:
+            print(f"{Colors.YELLOW}You haven't even run anything yet... hmph.{Colors.RESET}")
+            return
+        lines = [f"{Colors.CYAN}{'command':<20} {'runs':>6} {'total':>10} {'avg':>9} {'cpu':>10} {'peak rss':>9}{Colors.RESET}"]
+        for name, (runs, wall, user, sys_time, maxrss) in rows:
+            lines.append(f"{name[:20]:<20} {runs:>6} {wall:>9.3f}s {wall / runs:>8.3f}s "
+                         f"{user + sys_time:>9.3f}s {CommandStats.format_size(maxrss):>9}")
+        print('\n'.join(lines))
+
+    def builtin_profile(self, args):
+        """Turn latency profiling on/off, report it or export it"""
+        usage = f"{Colors.RED}Usage: profile on|off|reset|report|export [--chrome] FILE, baka!{Colors.RESET}"
+        action = args[0] if args else 'report'
+        if action == 'on':
+            self.latency.enabled = True
+            print(f"{Colors.CYAN}F-fine, I'll time everything I do. Don't stare!{Colors.RESET}")
+        elif action == 'off':
+            self.latency.enabled = False
+        elif action == 'reset':
+            self.latency.reset()
+        elif action == 'report':
+            summary = self.latency.summary()
+            if not summary:
+                state = 'on' if self.latency.enabled else "off (try 'profile on')"
+                print(f"{Colors.YELLOW}Nothing recorded yet, profiling is {state}{Colors.RESET}")
+                return
+            lines = [f"{Colors.CYAN}{'phase':<10} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms){Colors.RESET}"]
+            for phase, row in sorted(summary.items(), key=lambda item: -item[1]['p50_ms'] * item[1]['count']):
+                lines.append(f"{phase:<10} {row['count']:>7} {row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} "
+                             f"{row['p99_ms']:>9.3f} {row['max_ms']:>9.3f}")
+            print('\n'.join(lines))
+        elif action == 'export':
+            rest = args[1:]
+            chrome = '--chrome' in rest
+            rest = [arg for arg in rest if arg != '--chrome']
+            if len(rest) != 1:
+                print(usage)
+                return 2
+            data = self.latency.to_chrome_trace() if chrome else self.latency.to_json()
+            with open(rest[0], 'w') as f:
+                f.write(data)
+        else:
+            print(usage)
+            return 2
+
     def builtin_help(self, args):
         """Show help - with tsundere attitude"""
         help_text = f"""
@@ -790,22 +5825,47 @@ class MikuShell:
 
 {Colors.CYAN}Built-in commands:{Colors.RESET}
   cd [dir]     - Change directory (I-it's not like I want to go there!)
-  ls [args]    - List files (Fine, I'll show you...)
+  ls [-alSt1rU] - List files (Fine, I'll show you...)
+    ls -U      - Stream entries unsorted (for huge directories)
+    ls --limit N / --page - Show only N entries / one screen at a time
     ls --nya   - List files in cute mode~ (◕‿◕)♡
   pwd          - Print working directory  
   exit [code]  - Exit shell (Don't think I'll miss you!)
   history [n]  - Show command history
+    history search [--here] [--failed] TERMS - Ranked search (Ctrl-R too!)
   clear        - Clear screen
   echo [args]  - Print arguments
-  export VAR=val - Set environment variable
-  unset VAR    - Unset environment variable
+  VAR=val      - Set a shell variable (not passed to commands)
+  export VAR[=val] - Set environment variable (or export a shell variable)
+  unset VAR    - Unset a shell or environment variable
   alias [name=cmd] - Create/show aliases
   which [cmd]  - Find command location
+  type [cmd]   - Tell how a command would be run
+  cmd &        - Run in the background (jobs, fg, bg, wait, kill %n)
+  parallel [-j N] [-k] cmd {{}} ::: args - Run cmd for each arg across all cores
+  batch [-j N] cmd args - Split huge argument lists under ARG_MAX (like xargs)
+  icon PAT GLYPH [SGR] - Add an ls icon/colour rule (or: icon --colors LS_COLORS)
+  hash [-r]    - Show (or reset) remembered command paths
+  cat head tail wc test [ printf basename dirname sleep true false - Built in, no fork!
+    enable -n NAME - Use the real NAME instead (enable NAME to switch back)
+  time cmd     - Run cmd and show its real/user/sys time and peak memory
+  stats [-c|-n|-m] - Which commands ate your time (or CPU, runs, memory)
+  profile on|report|export [--chrome] F - Time my own phases, p50/p95/p99 (or MIKU_PROFILE=1)
+  complete -W 'a b' cmd - Tab-complete cmd's arguments from words (-d dirs, -c commands, -r remove)
+  prompt 'TEMPLATE' - Set the prompt (\\u \\H \\w \\t \\? \\g \\{{CYAN}} ...)
+  segment add NAME [-t MS] CMD - Add a prompt segment (try it in ~/.mikurc!)
   help         - Show this help (Obviously!)
 
 {Colors.YELLOW}Features:{Colors.RESET}
-  • Redirection: >, >>, <, 2>
+  • Redirection: >, >>, <, 2>, 2>&1 (builtins too!)
+  • Pipelines: cmd1 | cmd2 | cmd3 (builtins too!)
+  • Lists: cmd1; cmd2, cmd1 && cmd2, cmd1 || cmd2
+  • Variables: $VAR ${{VAR:-default}} ${{#VAR}} $? $$ $# $@ $1 and ~, split like sh unless quoted
+  • Command substitution: $(cmd) and `cmd`, side by side when there are several (MIKU_MAX_CAPTURE=16M caps each)
+  • Subshells: (cd dir; make) | less runs in a copy of the shell
+  • Globs with ** recursion and {{a,b}} / {{1..9}} brace expansion
   • Tab completion and history (stored in ~/.miku_history)
+  • MIKU_SHOW_STATS=N shows time/CPU/memory for commands slower than N seconds
   • Git branch display: {FileIcons.GIT} branch-name
   • Virtual environment display: {FileIcons.PYTHON} venv-name
   • File icons with nerd fonts for everything!
@@ -835,11 +5895,18 @@ class MikuShell:
 {Colors.CYAN}Type 'help' if you're too dumb to figure things out yourself!{Colors.RESET}
         """)
         
+        self.setup_job_control()
+        
         while True:
             try:
                 command = self.show_prompt()
-                if command:
-                    self.execute_command(command)
+                if command and command.strip():
+                    cwd = os.getcwd()
+                    started = time.monotonic()
+                    try:
+                        self.execute_command(command)
+                    finally:
+                        self.record_history(command, cwd, started)
             except KeyboardInterrupt:
                 print()
                 continue
@@ -864,6 +5931,10 @@ def show_help():
 {Colors.GREEN}Usage:{Colors.RESET}
   mikush          - Start the shell (obviously!)
   mikush --help   - Show this help (you're here now, baka!)
+  mikush --startup-profile - Show how long I took to wake up
+  mikush -c 'cmd' - Run cmd and leave, no chit-chat
+  mikush script.miku - Run a script line by line
+  mikush < cmds.txt - Same, from stdin (great for CI, hmph)
 
 {Colors.YELLOW}Features I'm proud of:{Colors.RESET}
 • Prompt shows current path: {Colors.CYAN}→ nya~(/your/path/)$>{Colors.RESET}
@@ -888,28 +5959,59 @@ def show_help():
 
 def main():
     """Entry point"""
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('--help', action='store_true', help='Show help')
+    profile = StartupProfile()
+    command = None
+    script = None
+    name = None
     
-    try:
-        args, unknown = parser.parse_known_args()
-        
-        if args.help:
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '--help':
             show_help()
             sys.exit(0)
-        
-        if unknown:
+        elif arg == '--startup-profile':
+            profile.enabled = True
+        elif arg == '-c' and args:
+            command = args.pop(0)
+            # Like sh -c: the next argument is $0, the rest $1...
+            if args:
+                name = args.pop(0)
+            break
+        elif arg == '-' or not arg.startswith('-'):
+            script = name = arg
+            break
+        else:
             print(f"{Colors.RED}I don't understand those arguments, baka! Use --help if you're confused! >_<{Colors.RESET}")
             sys.exit(1)
-        
-    except SystemExit:
-        raise
-    except:
-        # If argument parsing fails, just run the shell
-        pass
     
-    shell = MikuShell()
-    shell.run()
+    profile.mark('imports')
+    if command is None and script is None and sys.stdin.isatty():
+        shell = MikuShell(profile)
+        shell.run()
+        return
+    
+    # Non-interactive: -c, a script file, or commands piped into stdin
+    if command is not None:
+        lines = command.split('\n')
+    elif script is None or script == '-':
+        lines = ScriptReader(sys.stdin.fileno(), share=True)
+    else:
+        try:
+            lines = ScriptReader(os.open(script, os.O_RDONLY))
+        except OSError as e:
+            print(f"{Colors.RED}I can't read {script}, baka! {e.strerror} >_<{Colors.RESET}", file=sys.stderr)
+            sys.exit(127)
+    shell = MikuShell(profile, interactive=False)
+    shell.script_name = name or shell.script_name
+    shell.positional = args
+    profile.report()
+    try:
+        code = shell.run_script(lines)
+    except KeyboardInterrupt:
+        code = 128 + signal.SIGINT
+    sys.stdout.flush()
+    sys.exit(code)
 
 if __name__ == "__main__":
     main()